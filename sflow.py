@@ -1,5 +1,7 @@
+from collections import OrderedDict, namedtuple
 from socket import AF_INET, AF_INET6, inet_ntop
-from struct import unpack
+from struct import Struct, unpack, unpack_from
+from time import perf_counter_ns
 from uuid import UUID
 
 # The sFlow Collector is a class for parsing sFlow data.
@@ -55,6 +57,26 @@ class sFlowRecordBase:
 
 # Flow Record Types
 
+# Ethernet VLAN tags: 802.1Q 0x8100, 802.1ad service tag 0x88A8 and the pre standard Q-in-Q 0x9100.
+VLAN_TPIDS = (33024, 34984, 37120)
+
+
+def ethernet_vlans(header):
+    """Returns (offset of the EtherType after the tags, outer VLAN, inner VLAN) of an Ethernet header.
+
+    Two tags, an 802.1ad or Q-in-Q service tag or two stacked 802.1Q tags, give the outer and inner VLAN. A single
+    802.1Q tag is the inner VLAN and a lone service tag the outer VLAN. Missing tags are None.
+    """
+    tpid = unpack(">H", header[12:14])[0]
+    if tpid not in VLAN_TPIDS:
+        return 0, None, None
+    vlan = unpack(">H", header[14:16])[0] % 4096
+    if len(header) >= 20 and unpack(">H", header[16:18])[0] == 33024:
+        return 8, vlan, unpack(">H", header[18:20])[0] % 4096
+    if tpid == 33024:
+        return 4, None, vlan
+    return 4, vlan, None
+
 
 class sFlowRawPacketHeader:
     "flowData: enterprise = 0, format = 1"
@@ -71,15 +93,13 @@ class sFlowRawPacketHeader:
             self.source_mac = self.header[6:12].hex("-")
             self.type = unpack(">H", self.header[12:14])[0]
 
-            offset = 0
-            if unpack(">H", self.header[12:14])[0] == 37120:  # 802.1ad
-                offset = 8
-                self.outer_vlan = divmod(unpack(">H", self.header[14:16])[0], 4096)[1]
-                self.inner_vlan = divmod(unpack(">H", self.header[18:20])[0], 4096)[1]
-
-            if unpack(">H", self.header[12:14])[0] == 33024:  # 802.1Q
-                offset = 4
-                self.vlan = divmod(unpack(">H", self.header[14:16])[0], 4096)[1]
+            offset, outer_vlan, inner_vlan = ethernet_vlans(self.header)
+            if outer_vlan is not None:  # 802.1ad
+                self.outer_vlan = outer_vlan
+                if inner_vlan is not None:
+                    self.inner_vlan = inner_vlan
+            elif inner_vlan is not None:  # 802.1Q
+                self.vlan = inner_vlan
 
             if unpack(">H", self.header[12 + offset : 14 + offset])[0] == 2048:
                 self.ip_version, self.ip_header_legth = divmod(self.header[14 + offset], 16)
@@ -114,18 +134,16 @@ class sFlowRawPacketHeader:
     def decode_ipv4(self):
 
         decode = {}
-        offset = 0
 
-        if unpack(">H", self.header[12:14])[0] == 37120:  # 802.1ad
-            offset = 8
+        offset, outer_vlan, inner_vlan = ethernet_vlans(self.header)
+        if outer_vlan is not None:
             decode["802.1ad"] = True
-            decode["outer_vlan"] = divmod(unpack(">H", self.header[14:16])[0], 4096)[1]
-            decode["inner_vlan"] = divmod(unpack(">H", self.header[18:20])[0], 4096)[1]
-
-        if unpack(">H", self.header[12:14])[0] == 33024:  # 802.1Q
-            offset = 4
+            decode["outer_vlan"] = outer_vlan
+            if inner_vlan is not None:
+                decode["inner_vlan"] = inner_vlan
+        elif inner_vlan is not None:
             decode["802.1Q"] = True
-            decode["vlan"] = divmod(unpack(">H", self.header[14:16])[0], 4096)[1]
+            decode["vlan"] = inner_vlan
 
         if unpack(">H", self.header[12 + offset : 14 + offset])[0] != 2048:
             return decode
@@ -293,32 +311,37 @@ class sFlowExtendedGateway:
             self.source_peer_asn = 0
             self.as_path_type = 0
             self.as_path_count = 0
-            self.destination_as_path = []
-            self.communities = []
+            self.destination_as_path = ()
+            self.community_count = 0
+            self.communities = ()
             self.local_preference = 0
             return
-        self.asn = unpack(">i", datagram[data_position : (data_position + 4)])[0]
-        data_position += 4
-        self.source_asn = unpack(">i", datagram[data_position : (data_position + 4)])[0]
-        data_position += 4
-        self.source_peer_asn = unpack(">i", datagram[data_position : (data_position + 4)])[0]
-        data_position += 4
-        self.as_path_type = unpack(">i", datagram[data_position : (data_position + 4)])[0]
-        data_position += 4
-        self.as_path_count = unpack(">i", datagram[data_position : (data_position + 4)])[0]
-        data_position += 4
-        self.destination_as_path = unpack(
-            f'>{"i" * self.as_path_count}', datagram[data_position : (data_position + self.as_path_count * 4)]
-        )  # TODO: Double Check
-        data_position += self.as_path_count * 4
+        self.asn, self.source_asn, self.source_peer_asn, segment_count = unpack(
+            ">IIIi", datagram[data_position : (data_position + 16)]
+        )
+        data_position += 16
+        # dst_as_path is a list of segments (type, count, ASNs), kept as one path. as_path_type is the type of the
+        # first segment, 1 AS_SET or 2 AS_SEQUENCE.
+        self.as_path_type = 0
+        self.destination_as_path = ()
+        for _ in range(segment_count):
+            segment_type, segment_length = unpack(">ii", datagram[data_position : (data_position + 8)])
+            data_position += 8
+            if not self.as_path_type:
+                self.as_path_type = segment_type
+            self.destination_as_path += unpack(
+                f">{segment_length}I", datagram[data_position : (data_position + segment_length * 4)]
+            )
+            data_position += segment_length * 4
+        self.as_path_count = len(self.destination_as_path)
         self.community_count = unpack(">i", datagram[data_position : (data_position + 4)])[0]
         data_position += 4
         self.communities = unpack(
-            f'>{"i" * self.community_count}',
-            datagram[data_position : (data_position + self.community_count * 4)],  # TODO: Double Check
+            f">{self.community_count}I",
+            datagram[data_position : (data_position + self.community_count * 4)],
         )
         data_position += self.community_count * 4
-        self.local_preference = unpack(">i", datagram[data_position : (data_position + 4)])[0]
+        self.local_preference = unpack(">I", datagram[data_position : (data_position + 4)])[0]
 
     def __repr__(self):
         return f"""
@@ -345,12 +368,12 @@ class sFlowExtendedUser:
     def __init__(self, datagram):
         self.source_character_set = unpack(">i", datagram[0:4])
         name_length = unpack(">i", datagram[4:8])[0]
-        self.source_user = datagram[8 : (8 + name_length)].decode("utf-8")
+        self.source_user = str(datagram[8 : (8 + name_length)], "utf-8")
         data_position = name_length + (4 - name_length) % 4
-        self.destination_character_set = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.destination_character_set = str(datagram[data_position : (data_position + name_length)], "utf-8")
         data_position += 4
         name_length = unpack(">i", datagram[4:8])[0]
-        self.destination_user = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.destination_user = str(datagram[data_position : (data_position + name_length)], "utf-8")
 
     def __repr__(self):
         return f"""
@@ -372,13 +395,13 @@ class sFlowExtendedUrl:
         self.direction = unpack(">i", datagram[0:4])[0]
         name_length = min(unpack(">i", datagram[4:8])[0], 255)
         data_position = 8
-        self.url = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.url = str(datagram[data_position : (data_position + name_length)], "utf-8")
         data_position += name_length + (4 - name_length) % 4
         name_length = min(unpack(">i", datagram[data_position : (data_position + 4)])[0], 255)
         data_position += 4
-        self.host = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.host = str(datagram[data_position : (data_position + name_length)], "utf-8")
         name_length = unpack(">i", datagram[0:4])[0]
-        self.port_name = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.port_name = str(datagram[data_position : (data_position + name_length)], "utf-8")
 
     def __repr__(self):
         return f"""
@@ -482,7 +505,7 @@ class sFlowExtendedMplsTunnel:
 
     def __init__(self, datagram):
         name_length = min(unpack(">i", datagram[0:4])[0], 255)
-        self.host = datagram[4 : (4 + name_length)].decode("utf-8")
+        self.host = str(datagram[4 : (4 + name_length)], "utf-8")
         data_position = 4 + name_length + (4 - name_length) % 4
         self.tunnel_id = unpack(">i", datagram[data_position : (data_position + 4)])[0]
         data_position += 4
@@ -505,7 +528,7 @@ class sFlowExtendedMplsVc:
 
     def __init__(self, datagram):
         name_length = min(unpack(">i", datagram[0:4])[0], 255)
-        self.vc_instance_name = datagram[4 : (4 + name_length)].decode("utf-8")
+        self.vc_instance_name = str(datagram[4 : (4 + name_length)], "utf-8")
         data_position = 4 + name_length + (4 - name_length) % 4
         self.vll_vc_id = unpack(">i", datagram[data_position : (data_position + 4)])[0]
         data_position += 4
@@ -528,7 +551,7 @@ class sFlowExtendedMpls_FTN:
 
     def __init__(self, datagram):
         name_length = min(unpack(">i", datagram[0:4])[0], 255)
-        self.mpls_ftn_description = datagram[4 : (4 + name_length)].decode("utf-8")
+        self.mpls_ftn_description = str(datagram[4 : (4 + name_length)], "utf-8")
         data_position = 4 + name_length + (4 - name_length) % 4
         self.mpls_ftn_mask = unpack(">i", datagram[data_position : (data_position + 4)])[0]
 
@@ -884,7 +907,7 @@ class sFlowPortName:
 
     def __init__(self, datagram):
         name_length = unpack(">i", datagram[0:4])[0]
-        self.port_name = datagram[4 : (4 + name_length)].decode("utf-8")
+        self.port_name = str(datagram[4 : (4 + name_length)], "utf-8")
 
     def __repr__(self):
         return f"""
@@ -902,9 +925,9 @@ class sFlowHostDescr:
     def __init__(self, datagram):
         name_length = min(unpack(">i", datagram[0:4])[0], 64)
         data_position = 4
-        self.host_name = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.host_name = str(datagram[data_position : (data_position + name_length)], "utf-8")
         data_position += name_length + (4 - name_length) % 4
-        self.uuid = UUID(bytes=datagram[data_position : (data_position + 16)])
+        self.uuid = UUID(bytes=bytes(datagram[data_position : (data_position + 16)]))
         data_position = data_position + 16
         self.machine_type = unpack(">i", datagram[data_position : (data_position + 4)])[0]
         data_position = data_position + 4
@@ -912,7 +935,7 @@ class sFlowHostDescr:
         data_position = data_position + 4
         name_length = min(unpack(">i", datagram[data_position : (data_position + 4)])[0], 32)
         data_position += 4
-        self.os_release = datagram[data_position : (data_position + name_length)].decode("utf-8")
+        self.os_release = str(datagram[data_position : (data_position + name_length)], "utf-8")
 
     def __repr__(self):
         return f"""
@@ -1506,18 +1529,158 @@ s_flow_record_format = {
     (2, 0, 2104): sFlowVirtNetIO,
 }
 
+# Descriptive counter records are resent unchanged by every host each counter interval.
+# These are decoded once and the decoded record is shared by every datagram carrying the same bytes.
+
+s_flow_cached_format = {
+    (2, 0, 1005),  # sFlowPortName
+    (2, 0, 2000),  # sFlowHostDescr
+    (2, 0, 2001),  # sFlowHostAdapters
+    (2, 0, 2002),  # sFlowHostParent
+}
+
+
+class sFlowRecordCache:
+    """sFlowRecordCache class:
+
+    Bounded, least recently used cache of decoded records keyed by record format and raw record bytes.
+    Cached records are shared between datagrams and must be treated as read only.
+
+    size:  Maximum number of records held.
+    hits:  Records returned from the cache.
+    misses:  Records decoded and added to the cache.
+    evictions:  Records dropped to stay within size.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f"""
+            Record Cache:
+                Size: {len(self.records)} / {self.size}
+                Hits: {self.hits}
+                Misses: {self.misses}
+                Evictions: {self.evictions}
+                Hit Ratio: {self.hit_ratio:.3f}
+        """
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key, datagram):
+        raw = bytes(datagram)  # Also detaches the cached record from a caller's buffer.
+        record = self.records.get((key, raw))
+        if record is not None:
+            self.hits += 1
+            self.records.move_to_end((key, raw))
+            return record
+        self.misses += 1
+        record = s_flow_record_format[key](raw)
+        self.records[(key, raw)] = record
+        if len(self.records) > self.size:
+            self.records.popitem(last=False)
+            self.evictions += 1
+        return record
+
+    def clear(self):
+        self.records.clear()
+
+
+# Set to an sFlowRecordCache to share the records decoded from the same bytes between datagrams, None decodes every
+# record afresh. sflow_cache.py --benchmark measures both.
+record_cache = None
+
+
+def decode_record(key, datagram, pool=None):
+    """Decodes a record, refilled by pool or shared by record_cache where they apply, and accounted by record_profile.
+
+    Every record decoded by sFlowRecord and iter_records goes through here.
+    """
+    profile = record_profile
+    if profile is not None:
+        start = perf_counter_ns()
+    if pool is not None and key in s_flow_pooled_format:
+        record = pool.decode(key, datagram)
+    elif record_cache is not None and key in s_flow_cached_format:
+        record = record_cache.get(key, datagram)
+    else:
+        record = s_flow_record_format.get(key, sFlowRecordBase)(datagram)
+    if profile is not None:
+        profile.add(key, perf_counter_ns() - start, len(datagram))
+    return record
+
+
+class sFlowRecordProfile:
+    """sFlowRecordProfile class:
+
+    Decode cost per record format, accumulated while set as record_profile.
+
+    formats:  (sample_type, enterprise, format): [calls, nanoseconds, bytes].
+    """
+
+    def __init__(self):
+        self.formats = {}
+
+    def __repr__(self):
+        lines = "".join(
+            f"\n                {name} {calls} calls {nanoseconds / calls:.0f} ns/call {size} bytes {share:.1%}"
+            for name, calls, nanoseconds, size, share in self.report()
+        )
+        return f"""
+            Record Profile:{lines}
+        """
+
+    def add(self, key, nanoseconds, size):
+        totals = self.formats.get(key)
+        if totals is None:
+            self.formats[key] = [1, nanoseconds, size]
+        else:
+            totals[0] += 1
+            totals[1] += nanoseconds
+            totals[2] += size
+
+    def report(self):
+        """(record name, calls, nanoseconds, bytes, share of all nanoseconds), most expensive first."""
+        total = sum(totals[1] for totals in self.formats.values()) or 1
+        rows = []
+        for key, (calls, nanoseconds, size) in self.formats.items():
+            name = s_flow_record_format.get(key, sFlowRecordBase).__name__
+            rows.append((f"{name} {'-'.join(map(str, key))}", calls, nanoseconds, size, nanoseconds / total))
+        return sorted(rows, key=lambda row: -row[2])
+
+    def clear(self):
+        self.formats.clear()
+
+
+# Set to an sFlowRecordProfile to account the decode cost of every record, None costs a single test per record.
+record_profile = None
+
 # sFlow Record class.
 
 
 class sFlowRecord:
-    """sFlowRecord class:"""
+    """sFlowRecord class:
 
-    def __init__(self, header, sample_type, datagram):
+    key:  (sample_type, enterprise, format) of s_flow_record_format, expanded samples (3, 4) keyed as single ones (1, 2).
+    """
+
+    def __init__(self, header, sample_type, datagram, pool=None):
         self.header = header
         self.sample_type = sample_type
         self.enterprise, self.format = divmod(self.header, 4096)
         self.datagram = datagram
-        self.record = s_flow_record_format.get((sample_type, self.enterprise, self.format), sFlowRecordBase)(datagram)
+        self.key = (sample_type - 2 if sample_type > 2 else sample_type, self.enterprise, self.format)
+        self.record = decode_record(self.key, datagram, pool)
 
 
 # sFlow Sample class.
@@ -1540,7 +1703,7 @@ class sFlowSample:
     records:  A list of information about sampled packets.
     """
 
-    def __init__(self, header, sample_size, datagram):
+    def __init__(self, header, sample_size, datagram, pool=None):
 
         self.len = sample_size
         self.data = datagram
@@ -1561,7 +1724,7 @@ class sFlowSample:
             data_position = 12
         else:
             pass  # sampleTypeError
-        self.records = []
+        self.records = [] if pool is None else pool.new_list()
 
         if self.sample_type in [1, 3]:  # Flow
             self.sample_rate, self.sample_pool, self.dropped_packets = unpack(
@@ -1597,18 +1760,23 @@ class sFlowSample:
             record_header = unpack(">i", datagram[(data_position) : (data_position + 4)])[0]
             record_size = unpack(">i", datagram[(data_position + 4) : (data_position + 8)])[0]
             record_data = datagram[(data_position + 8) : (data_position + record_size + 8)]
-            self.records.append(sFlowRecord(record_header, self.sample_type, record_data))
+            if pool is None:
+                self.records.append(sFlowRecord(record_header, self.sample_type, record_data))
+            else:
+                self.records.append(pool.new_record(record_header, self.sample_type, record_data))
             data_position += record_size + 8
 
 
-class sFlow:
-    """sFlow class:
+class sFlowHeader:
+    """sFlowHeader class:
+
+    Decodes only the datagram header, without decoding any samples or records.
 
     agentAddress:  IP address of sampling agent sFlowAgentAddress.
     subAgent:  Used to distinguishing between datagram streams from separate agent sub entities within an device.
     sequenceNumber:  Incremented with each sample datagram generated by a sub-agent within an agent.
     sysUpTime:  Current time (in milliseconds since device last booted). Should be set as close to datagram transmission time as possible.
-    samples:  A list of samples.
+    samplePosition:  Offset of the first sample in the datagram.
 
     """
 
@@ -1624,26 +1792,414 @@ class sFlow:
             self.sequence_number = unpack(">i", datagram[16:20])[0]
             self.system_uptime = unpack(">i", datagram[20:24])[0]
             self.number_sample = unpack(">i", datagram[24:28])[0]
-            data_position = 28
+            self.sample_position = 28
         elif self.address_type == 2:
             self.agent_address = inet_ntop(AF_INET6, datagram[8:24])
             self.sub_agent = unpack(">i", datagram[24:28])[0]
             self.sequence_number = unpack(">i", datagram[28:32])[0]
             self.system_uptime = unpack(">i", datagram[32:36])[0]
             self.number_sample = unpack(">i", datagram[36:40])[0]
-            data_position = 40
+            self.sample_position = 40
         else:
             self.agent_address = 0
             self.sub_agent = 0
             self.sequence_number = 0
             self.system_uptime = 0
             self.number_sample = 0
-        self.samples = []
+            self.sample_position = 0
+
+    def sample_types(self):
+        """Returns the sample type of every sample, reading only the sample headers."""
+        sample_types = []
+        data_position = self.sample_position
+        for _ in range(self.number_sample):
+            sample_header, sample_size = unpack(">ii", self.data[data_position : (data_position + 8)])
+            sample_types.append(sample_header % 4096)
+            data_position += 8 + sample_size
+        return sample_types
+
+
+class sFlow(sFlowHeader):
+    """sFlow class:
+
+    agentAddress:  IP address of sampling agent sFlowAgentAddress.
+    subAgent:  Used to distinguishing between datagram streams from separate agent sub entities within an device.
+    sequenceNumber:  Incremented with each sample datagram generated by a sub-agent within an agent.
+    sysUpTime:  Current time (in milliseconds since device last booted). Should be set as close to datagram transmission time as possible.
+    samples:  A list of samples.
+
+    """
+
+    def __init__(self, datagram, pool=None):
+
+        super().__init__(datagram)
+        data_position = self.sample_position
+        self.samples = [] if pool is None else pool.new_list()
         if self.number_sample > 0:
             for _ in range(self.number_sample):
                 sample_header = datagram[(data_position) : (data_position + 4)]
                 sample_size = unpack(">i", datagram[(data_position + 4) : (data_position + 8)])[0]
                 sample_datagram = datagram[(data_position + 8) : (data_position + sample_size + 8)]
 
-                self.samples.append(sFlowSample(sample_header, sample_size, sample_datagram))
+                if pool is None:
+                    self.samples.append(sFlowSample(sample_header, sample_size, sample_datagram))
+                else:
+                    self.samples.append(pool.new_sample(sample_header, sample_size, sample_datagram))
                 data_position = data_position + 8 + sample_size
+
+    def iter_records(self):
+        """Yields an sFlowFlatRecord for every record of the datagram."""
+        for sample in self.samples:
+            for record in sample.records:
+                yield sFlowFlatRecord(
+                    self.agent_address,
+                    self.sub_agent,
+                    self.sequence_number,
+                    sample.sequence,
+                    sample.source_index,
+                    sample.sample_rate,
+                    record.key,
+                    record.record,
+                )
+
+
+# Fixed layout records, decoded to a tuple of their fields in one unpack. Addresses and MAC addresses are left packed.
+
+s_flow_record_struct = {
+    (1, 0, 2): Struct(">i6s2x6s2xi"),  # sFlowEthernetFrame
+    (1, 0, 3): Struct(">ii4s4siiii"),  # sFlowSampledIpv4
+    (1, 0, 4): Struct(">ii16s16siiii"),  # sFlowSampledIpv6
+    (1, 0, 1001): Struct(">iiii"),  # sFlowExtendedSwitch
+    (1, 0, 2100): Struct(">i4s4sii"),  # sFlowExtendedSocketIpv4
+    (1, 0, 2101): Struct(">i16s16sii"),  # sFlowExtendedSocketIpv6
+    (2, 0, 1): Struct(">iiqiiqiiiiiiqiiiiii"),  # sFlowIfCounters
+    (2, 0, 2): Struct(">13i"),  # sFlowEthernetInterface
+    (2, 0, 3): Struct(">18i"),  # sFlowTokenringCounters
+    (2, 0, 4): Struct(">iqiqiiiiiqiqqq"),  # sFlowVgCounters
+    (2, 0, 5): Struct(">iqiiii"),  # sFlowVLAN
+    (2, 0, 1001): Struct(">iiiqq"),  # sFlowProcessor
+    (2, 0, 1004): Struct(">qi"),  # sFlowOfPort
+    (2, 0, 2002): Struct(">ii"),  # sFlowHostParent
+    (2, 0, 2003): Struct(">fffiiiiiiiiiiiiii"),  # sFlowHostCPU
+    (2, 0, 2004): Struct(">qqqqqqqiiii"),  # sFlowHostMemory
+    (2, 0, 2005): Struct(">qqiiqiiqi"),  # sFlowHostDiskIO
+    (2, 0, 2006): Struct(">qiiiqiii"),  # sFlowHostNetIO
+    (2, 0, 2007): Struct(">19i"),  # sFlowMib2IP
+    (2, 0, 2008): Struct(">25i"),  # sFlowMib2ICMP
+    (2, 0, 2009): Struct(">15i"),  # sFlowMib2TCP
+    (2, 0, 2010): Struct(">7i"),  # sFlowMib2UDP
+    (2, 0, 2100): Struct(">iiqqi"),  # sFlowVirtNode
+    (2, 0, 2101): Struct(">iii"),  # sFlowVirtCPU
+    (2, 0, 2102): Struct(">qq"),  # sFlowVirtMemory
+    (2, 0, 2103): Struct(">qqqiqiqi"),  # sFlowVirtDiskIO
+    (2, 0, 2104): Struct(">qiiiqiii"),  # sFlowVirtNetIO
+}
+
+# Pooled parsing, opt in with an sFlowPool. sFlowPool.parse refills an sFlow, its samples, their records and the
+# decoded record objects from free lists instead of allocating them, and sFlowPool.release returns them.
+
+# Ownership: an sFlow from parse belongs to the caller until it is passed to release. After release neither it nor any
+# sample, sFlowRecord, decoded record or list reached through it may be used; values needed later must be copied out
+# (they are ints, strings and bytes, so copying the value is enough). Release drops every reference the pooled objects
+# hold to the datagram, so a buffer parsed from a memoryview, such as a sflow_ring slot, can be released after it. Attributes a consumer adds to an sFlow are
+# cleared by release; those added to a sample or record are not, and must be set for every datagram, as
+# sflow_interfaces.join does.
+
+# Samples and fixed layout records set the same attributes whatever their content, so they are refilled by calling
+# __init__ again. Other records set some attributes only for some content and are decoded afresh, as are the records
+# of s_flow_cached_format shared by record_cache.
+
+s_flow_pooled_format = set(s_flow_record_struct) - s_flow_cached_format
+
+
+class sFlowPool:
+    """sFlowPool class:
+
+    Free lists of parsed objects, refilled by parse and returned by release.
+
+    size:  Maximum objects kept per free list.
+    reused:  Objects taken from a free list.
+    allocated:  Objects allocated as a free list was empty.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.datagrams = []
+        self.samples = []
+        self.records = []
+        self.lists = []
+        self.decoded = {}
+        self.reused = 0
+        self.allocated = 0
+
+    def __repr__(self):
+        return f"""
+            Pool:
+                Datagrams: {len(self.datagrams)}
+                Samples: {len(self.samples)}
+                Records: {len(self.records)}
+                Decoded Records: {sum(len(free) for free in self.decoded.values())}
+                Lists: {len(self.lists)}
+                Reused: {self.reused}
+                Allocated: {self.allocated}
+        """
+
+    def parse(self, datagram):
+        """Decodes a datagram into pooled objects, owned by the caller until release."""
+        if self.datagrams:
+            self.reused += 1
+            sflow_data = self.datagrams.pop()
+            sflow_data.__init__(datagram, self)
+            return sflow_data
+        self.allocated += 1
+        return sFlow(datagram, self)
+
+    def new_sample(self, header, sample_size, datagram):
+        if self.samples and unpack(">i", header)[0] % 4096 in (1, 2, 3, 4):  # Other types leave attributes unset.
+            self.reused += 1
+            sample = self.samples.pop()
+            sample.__init__(header, sample_size, datagram, self)
+            return sample
+        self.allocated += 1
+        return sFlowSample(header, sample_size, datagram, self)
+
+    def new_record(self, header, sample_type, datagram):
+        if self.records:
+            self.reused += 1
+            record = self.records.pop()
+            record.__init__(header, sample_type, datagram, self)
+            return record
+        self.allocated += 1
+        return sFlowRecord(header, sample_type, datagram, self)
+
+    def new_list(self):
+        if self.lists:
+            return self.lists.pop()
+        return []
+
+    def decode(self, key, datagram):
+        """Decodes a record of s_flow_pooled_format, called through decode_record."""
+        free = self.decoded.get(key)
+        if free:
+            self.reused += 1
+            record = free.pop()
+            record.__init__(datagram)
+            return record
+        self.allocated += 1
+        return s_flow_record_format[key](datagram)
+
+    def release(self, sflow_data):
+        """Returns a datagram from parse, with everything reached through it, to the pool."""
+        if not sflow_data.__dict__:
+            raise ValueError("sFlow datagram released twice")
+        size = self.size
+        samples = sflow_data.samples
+        for sample in samples:
+            records = sample.records
+            for record in records:
+                key = record.key
+                if key in s_flow_pooled_format:
+                    free = self.decoded.get(key)
+                    if free is None:
+                        free = self.decoded[key] = []
+                    if len(free) < size:
+                        free.append(record.record)
+                record.record = record.datagram = None  # Views of the datagram's buffer, as is sample.data.
+                if len(self.records) < size:
+                    self.records.append(record)
+            records.clear()
+            if len(self.lists) < size:
+                self.lists.append(records)
+            sample.data = None
+            if len(self.samples) < size:
+                self.samples.append(sample)
+        samples.clear()
+        if len(self.lists) < size:
+            self.lists.append(samples)
+        sflow_data.__dict__.clear()
+        if len(self.datagrams) < size:
+            self.datagrams.append(sflow_data)
+
+    def clear(self):
+        self.datagrams.clear()
+        self.samples.clear()
+        self.records.clear()
+        self.lists.clear()
+        self.decoded.clear()
+
+
+# sFlow Visitor class.
+
+
+class sFlowVisitor:
+    """sFlowVisitor class:
+
+    Walks a datagram once and calls back per sample and per record, without building sFlowSample or sFlowRecord objects.
+
+    Sample callbacks are called as callback(header, sample), header being the sFlowHeader and sample the tuple
+        (sample_type, sequence, source_type, source_index, sample_rate, sample_pool, dropped_packets,
+         input_if_value, output_if_value, record_count)
+    Expanded samples are reported as sample type 1 (flow) or 2 (counter). A sample callback returning False skips the
+    records of that sample.
+
+    Record callbacks are registered per (sample_type, enterprise, format) and called as
+        callback(header, sample, datagram, offset, length)
+    or, when registered with decode=True, as
+        callback(header, sample, values)
+    where values is the s_flow_record_struct tuple, or the record class instance for records without a fixed layout.
+    """
+
+    def __init__(self):
+        self.sample_callbacks = []
+        self.record_callbacks = {}
+
+    def on_sample(self, callback):
+        self.sample_callbacks.append(callback)
+        return callback
+
+    def on_record(self, key, callback, decode=False):
+        if decode:
+            record_struct = s_flow_record_struct.get(key)
+            if record_struct is not None:
+                unpack_record = record_struct.unpack_from
+
+                def record_callback(header, sample, datagram, offset, length):
+                    return callback(header, sample, unpack_record(datagram, offset))
+
+            else:
+                record_class = s_flow_record_format[key]
+
+                def record_callback(header, sample, datagram, offset, length):
+                    return callback(header, sample, record_class(datagram[offset : offset + length]))
+
+            self.record_callbacks.setdefault(key, []).append(record_callback)
+        else:
+            self.record_callbacks.setdefault(key, []).append(callback)
+        return callback
+
+    def parse(self, datagram):
+        header = sFlowHeader(datagram)
+        sample_callbacks = self.sample_callbacks
+        record_callbacks = self.record_callbacks
+        for sample, data_position in iter_samples(header):
+            skip = False
+            for callback in sample_callbacks:
+                if callback(header, sample) is False:
+                    skip = True
+            if skip or not record_callbacks:
+                continue
+
+            sample_type = sample[0]
+            for _ in range(sample[9]):
+                record_header, record_size = unpack_from(">ii", datagram, data_position)
+                callbacks = record_callbacks.get((sample_type, *divmod(record_header, 4096)))
+                if callbacks:
+                    for callback in callbacks:
+                        callback(header, sample, datagram, data_position + 8, record_size)
+                data_position += record_size + 8
+        return header
+
+
+def iter_samples(header):
+    """Walks the samples of a datagram from its sFlowHeader, yielding the sample tuple and the offset of its first record.
+
+    The sample tuple is (sample_type, sequence, source_type, source_index, sample_rate, sample_pool, dropped_packets,
+    input_if_value, output_if_value, record_count). Expanded samples are reported as sample type 1 or 2.
+    """
+    datagram = header.data
+    data_position = header.sample_position
+    for _ in range(header.number_sample):
+        sample_header, sample_size = unpack_from(">ii", datagram, data_position)
+        sample_end = data_position + 8 + sample_size
+        data_position += 8
+        sample_type = sample_header % 4096
+        if sample_type == 1:
+            sequence, sample_source, sample_rate, sample_pool, dropped_packets, input_interface, output_interface = unpack_from(
+                ">iiiiiii", datagram, data_position
+            )
+            source_type, source_index = divmod(sample_source, 16777216)
+            input_if_value = input_interface % 1073741824
+            output_if_value = output_interface % 1073741824
+            data_position += 28
+        elif sample_type == 2:
+            sequence, sample_source = unpack_from(">ii", datagram, data_position)
+            source_type, source_index = divmod(sample_source, 16777216)
+            sample_rate = sample_pool = dropped_packets = input_if_value = output_if_value = 0
+            data_position += 8
+        elif sample_type == 3:
+            (
+                sequence,
+                source_type,
+                source_index,
+                sample_rate,
+                sample_pool,
+                dropped_packets,
+                _,
+                input_if_value,
+                _,
+                output_if_value,
+            ) = unpack_from(">10i", datagram, data_position)
+            sample_type = 1
+            data_position += 40
+        elif sample_type == 4:
+            sequence, source_type, source_index = unpack_from(">iii", datagram, data_position)
+            sample_rate = sample_pool = dropped_packets = input_if_value = output_if_value = 0
+            sample_type = 2
+            data_position += 12
+        else:  # sampleTypeError
+            data_position = sample_end
+            continue
+        record_count = unpack_from(">i", datagram, data_position)[0]
+        yield (
+            sample_type,
+            sequence,
+            source_type,
+            source_index,
+            sample_rate,
+            sample_pool,
+            dropped_packets,
+            input_if_value,
+            output_if_value,
+            record_count,
+        ), data_position + 4
+        data_position = sample_end
+
+
+# Flat records, as yielded by sFlow.iter_records and iter_records. key is the (sample_type, enterprise, format) of
+# s_flow_record_format, so the records of expanded samples (3, 4) have the sample_type of single ones (1, 2).
+
+sFlowFlatRecord = namedtuple(
+    "sFlowFlatRecord", "agent_address sub_agent sequence_number sample_sequence source_index sample_rate key record"
+)
+
+
+def iter_records(datagrams):
+    """Yields an sFlowFlatRecord for every record of one datagram or an iterable of datagrams.
+
+    Datagrams may be raw bytes or sFlowHeader objects, decoded lazily one record at a time, or already decoded sFlow
+    objects.
+    """
+    if isinstance(datagrams, (bytes, bytearray, memoryview, sFlowHeader)):
+        datagrams = (datagrams,)
+    for datagram in datagrams:
+        if isinstance(datagram, sFlow):
+            yield from datagram.iter_records()
+            continue
+        if isinstance(datagram, sFlowHeader):
+            header = datagram
+            datagram = header.data
+        else:
+            header = sFlowHeader(datagram)
+        agent_address = header.agent_address
+        sub_agent = header.sub_agent
+        sequence_number = header.sequence_number
+        for sample, data_position in iter_samples(header):
+            sample_type = sample[0]
+            for _ in range(sample[9]):
+                record_header, record_size = unpack_from(">ii", datagram, data_position)
+                enterprise, record_format = divmod(record_header, 4096)
+                key = (sample_type, enterprise, record_format)
+                record_data = datagram[(data_position + 8) : (data_position + record_size + 8)]
+                record = decode_record(key, record_data)
+                yield sFlowFlatRecord(agent_address, sub_agent, sequence_number, sample[1], sample[3], sample[4], key, record)
+                data_position += record_size + 8
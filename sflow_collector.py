@@ -1,3 +1,4 @@
+import argparse
 import pprint
 import socket
 
@@ -5,19 +6,14 @@ import sflow
 
 # Basic Listener
 
+# print_records is also the default handler of sflow_daemon.py, which runs it in its workers.
+
 UDP_IP = "127.0.0.1"
 UDP_PORT = 6343
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((UDP_IP, UDP_PORT))
-
-while True:
-
-    data, addr = sock.recvfrom(
-        3000
-    )  # 1386 bytes is the largest possible sFlow packet, by spec 3000 seems to be the number by practice
-    sflow_data = sflow.sFlow(data)
 
+def print_records(sflow_data, addr=None):
+    """Prints every record of a decoded datagram received from addr."""
     # Below this point is test code.
 
     # print(".", end="")
@@ -53,3 +49,21 @@ while True:
             # print(" Sample Record Type:", sflow_data.samples[i].records[j].format)
             # print(repr(sflow_data.samples[i].records[j].record))
             pprint.pprint(vars(sflow_data.samples[i].records[j].record))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Print every record of the sFlow datagrams received.")
+    parser.add_argument("--ip", default=UDP_IP)
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((args.ip, args.port))
+
+    while True:
+
+        data, addr = sock.recvfrom(
+            3000
+        )  # 1386 bytes is the largest possible sFlow packet, by spec 3000 seems to be the number by practice
+        print_records(sflow.sFlow(data), addr)
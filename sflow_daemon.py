@@ -0,0 +1,403 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import re
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import sflow
+import sflow_loadgen
+import sflow_shed
+import sflow_synthetic
+
+# The sFlow Daemon is the long running collector: sflow_collector.py with its sockets tuned, its decoding spread over
+# worker processes and a reload that never stops receiving.
+
+# Each listen address, "[::]:6343" by default, is bound by one socket per worker with SO_REUSEPORT, so the kernel
+# spreads datagrams over the workers by source and every datagram of an agent reaches the same worker. The wildcard
+# "::" is bound dual stack (IPV6_V6ONLY off) and IPv4 agents appear as ::ffff:a.b.c.d; where IPv6 is unavailable it
+# falls back to 0.0.0.0. Every socket gets
+#   SO_RCVBUF       rcvbuf bytes, with SO_RCVBUFFORCE past net.core.rmem_max where permitted
+#   SO_BUSY_POLL    busy_poll microseconds of busy polling the device queue before sleeping, 0 for none
+# and worker i is pinned to cpus[i % len(cpus)] when cpus are given. A worker that dies is started again on its sockets.
+
+# SIGHUP reloads the daemon: the supervisor starts a new copy of itself, re-reading the configuration and the code,
+# and passes it every bound socket. The new daemon takes the sockets listening on its addresses, binds any new address,
+# starts its workers and reports ready through a pipe; only then do the old workers stop. Old and new workers read the
+# same sockets while they overlap, and the kernel keeps queueing between reads, so no datagram is dropped by a reload.
+# A new daemon that fails to become ready within READY_TIMEOUT is killed and the old one carries on. Sockets are
+# never closed while their address is listened on, as a datagram queued on a closed SO_REUSEPORT socket is lost, so
+# reducing the workers leaves some workers reading several sockets.
+
+# Sockets can also be handed over by systemd socket activation (LISTEN_FDS). Under systemd the new daemon takes over
+# as the main process with sd_notify MAINPID, which needs Type=notify and NotifyAccess=all.
+
+# Each decoded datagram is passed to handler(sflow_data, addr) in its worker. The command line names the handler
+# "module:function", by default sflow_collector:print_records, which prints every record as sflow_collector.py does; a
+# sink module's function feeds the sink, and "none" only counts datagrams. Every reload imports the handler again.
+
+# The configuration file is JSON with the same keys as the command line options, which override it:
+#   {"listen": ["[::]:6343"], "rcvbuf": 33554432, "busy_poll": 50, "workers": 4, "cpus": [2, 3, 4, 5],
+#    "handler": "sflow_collector:print_records"}
+
+LISTEN = ["[::]:6343"]
+HANDLER = "sflow_collector:print_records"
+RCVBUF = 32 * 1024 * 1024  # bytes
+INTERVAL = 60  # seconds between worker reports
+READY_TIMEOUT = 30  # seconds
+BATCH = 64  # datagrams read from a socket before checking the others
+RECV_SIZE = 3000
+
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33 if sys.platform.startswith("linux") else None)
+SO_BUSY_POLL = getattr(socket, "SO_BUSY_POLL", 46 if sys.platform.startswith("linux") else None)
+
+FDS_ENV = "SFLOW_FDS"
+READY_ENV = "SFLOW_READY"
+
+
+def listen_address(listen):
+    """(family, address) to bind of "host:port", "[v6 host]:port" or a port alone."""
+    host, _, port = listen.rpartition(":")
+    host = host.strip("[]") or "::"
+    if host == "::" and not socket.has_dualstack_ipv6():
+        host = "0.0.0.0"
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return family, socket.getaddrinfo(host, int(port), family, socket.SOCK_DGRAM, 0, socket.AI_PASSIVE)[0][4][:2]
+
+
+def load_handler(name):
+    """The function named by "module:function", None for "none"."""
+    if name == "none":
+        return None
+    module, _, function = name.partition(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def socket_key(sock):
+    return sock.family, sock.getsockname()[:2]
+
+
+def tune(sock, rcvbuf, busy_poll):
+    """Sets the receive buffer and busy polling of sock, returning the receive buffer the kernel gave."""
+    if rcvbuf:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+        except (OSError, TypeError):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if busy_poll and SO_BUSY_POLL is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, busy_poll)
+        except OSError as error:
+            print(f"SO_BUSY_POLL {busy_poll}: {error}", file=sys.stderr)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+def bind(family, address):
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if family == socket.AF_INET6 and address[0] == "::":
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    sock.bind(address)
+    return sock
+
+
+def inherited_sockets():
+    """Datagram sockets passed by a reloading daemon or by systemd socket activation."""
+    fds = os.environ.pop(FDS_ENV, "")
+    if fds:
+        fds = [int(fd) for fd in fds.split(",")]
+    elif os.environ.get("LISTEN_PID") == str(os.getpid()):
+        fds = range(3, 3 + int(os.environ.get("LISTEN_FDS", 0)))
+        for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+            os.environ.pop(name, None)
+    sockets = []
+    for fd in fds:
+        sock = socket.socket(fileno=fd)
+        if sock.type == socket.SOCK_DGRAM:
+            sockets.append(sock)
+        else:
+            sock.detach()
+    return sockets
+
+
+def notify(state):
+    """sd_notify state to systemd, when started by it."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendto(state.encode(), address)
+
+
+def worker(number, sockets, cpu, interval, handler):
+    """Decodes the datagrams of sockets until SIGTERM, passing each sFlow and address to handler."""
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+    datagrams = errors = 0
+    report = time.monotonic() + interval if interval else None
+    while running:
+        for key, _ in selector.select(1):
+            sock = key.fileobj
+            for _ in range(BATCH):
+                try:
+                    data, addr = sock.recvfrom(RECV_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    break
+                datagrams += 1
+                try:
+                    sflow_data = sflow.sFlow(data)
+                except Exception:
+                    errors += 1
+                    continue
+                if handler is not None:
+                    handler(sflow_data, addr)
+        if report is not None and time.monotonic() >= report:
+            queues = [sflow_shed.socket_queue(sock) for sock in sockets]
+            drops = sum(queue[1] for queue in queues if queue)
+            print(f"worker {number} pid {os.getpid()}: {datagrams} datagrams, {errors} errors, {drops} socket drops", flush=True)
+            report = time.monotonic() + interval
+    print(f"worker {number} pid {os.getpid()} stopped: {datagrams} datagrams, {errors} errors", flush=True)
+
+
+class sFlowDaemon:
+    """sFlowDaemon class:
+
+    listen:  Listen addresses, "host:port".
+    sockets:  (family, address): bound sockets, one per worker or more.
+    rcvbuf:  Receive buffer requested per socket, bytes.
+    busyPoll:  SO_BUSY_POLL microseconds, 0 for none.
+    workers:  Worker processes.
+    cpus:  CPUs the workers are pinned to, round robin, None for no affinity.
+    handler:  Called with each sFlow and source address in the workers.
+    """
+
+    def __init__(self, listen=LISTEN, rcvbuf=RCVBUF, busy_poll=0, workers=None, cpus=None, interval=INTERVAL, handler=None):
+        self.listen = listen
+        self.rcvbuf = rcvbuf
+        self.busy_poll = busy_poll
+        self.workers = workers or (len(cpus) if cpus else 1)
+        self.cpus = cpus
+        self.interval = interval
+        self.handler = handler
+        self.sockets = {}
+        self.received_rcvbuf = None
+        self.processes = []
+        self.context = multiprocessing.get_context("fork")
+        self.reload_requested = False
+        self.stop_requested = False
+        self.reloads = 0
+        self.restarts = 0
+
+    def __repr__(self):
+        addresses = ", ".join(
+            f"[{host}]:{port} x{len(sockets)}" if family == socket.AF_INET6 else f"{host}:{port} x{len(sockets)}"
+            for (family, (host, port)), sockets in self.sockets.items()
+        )
+        return f"""
+            Daemon:
+                Pid: {os.getpid()}
+                Listen: {addresses}
+                Receive Buffer: {self.received_rcvbuf}
+                Busy Poll: {self.busy_poll}
+                Workers: {self.workers}
+                CPUs: {self.cpus}
+                Worker Restarts: {self.restarts}
+        """
+
+    def open(self):
+        """Binds the listen addresses, taking over matching inherited sockets and closing those no longer listened on."""
+        inherited = {}
+        for sock in inherited_sockets():
+            inherited.setdefault(socket_key(sock), []).append(sock)
+        for listen in self.listen:
+            family, address = listen_address(listen)
+            sockets = inherited.pop((family, address), None) or [bind(family, address)]
+            while len(sockets) < self.workers:
+                sockets.append(bind(family, address))
+            self.sockets[(family, address)] = sockets
+        for sockets in inherited.values():
+            for sock in sockets:
+                sock.close()
+        for sockets in self.sockets.values():
+            for sock in sockets:
+                self.received_rcvbuf = tune(sock, self.rcvbuf, self.busy_poll)
+                sock.set_inheritable(True)
+
+    def worker_sockets(self, number):
+        return [sock for sockets in self.sockets.values() for sock in sockets[number :: self.workers]]
+
+    def start_worker(self, number):
+        cpu = self.cpus[number % len(self.cpus)] if self.cpus else None
+        process = self.context.Process(
+            target=worker, args=(number, self.worker_sockets(number), cpu, self.interval, self.handler), daemon=True
+        )
+        process.start()
+        return process
+
+    def start(self):
+        self.processes = [self.start_worker(number) for number in range(self.workers)]
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        ready = os.environ.pop(READY_ENV, None)
+        if ready is not None:
+            os.write(int(ready), b"1")
+            os.close(int(ready))
+        notify(f"READY=1\nMAINPID={os.getpid()}")
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def stop_workers(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def reload(self):
+        """Starts a new daemon on the bound sockets, True once it is ready and this one should exit."""
+        notify("RELOADING=1")
+        fds = [sock.fileno() for sockets in self.sockets.values() for sock in sockets]
+        read, write = os.pipe()
+        environment = dict(os.environ, **{FDS_ENV: ",".join(map(str, fds)), READY_ENV: str(write)})
+        process = subprocess.Popen([sys.executable] + sys.argv, pass_fds=fds + [write], env=environment)
+        os.close(write)
+        selector = selectors.DefaultSelector()
+        selector.register(read, selectors.EVENT_READ)
+        ready = selector.select(READY_TIMEOUT) and os.read(read, 1) == b"1"
+        selector.close()
+        os.close(read)
+        if not ready:
+            process.kill()
+            process.wait()
+            print(f"reload failed, pid {process.pid} not ready, still running as {os.getpid()}", file=sys.stderr, flush=True)
+            notify(f"READY=1\nMAINPID={os.getpid()}")
+            return False
+        self.reloads += 1
+        print(f"reloaded as pid {process.pid}", flush=True)
+        return True
+
+    def run(self):
+        self.open()
+        self.start()
+        print(self, flush=True)
+        while not self.stop_requested:
+            time.sleep(0.2)
+            if self.reload_requested:
+                self.reload_requested = False
+                if self.reload():
+                    break
+            for number, process in enumerate(self.processes):
+                if not process.is_alive() and not self.stop_requested:
+                    self.restarts += 1
+                    self.processes[number] = self.start_worker(number)
+        notify("STOPPING=1")
+        self.stop_workers()
+
+
+def benchmark(listen, reloads, rate, duration):
+    """Sends at rate to a daemon reloaded reloads times and compares the datagrams received to those sent."""
+    family, address = listen_address(listen)
+    command = [sys.executable, os.path.abspath(__file__), "--listen", listen, "--workers", "2", "--interval", "0"]
+    command += ["--handler", "none"]
+    daemon = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    pids = [daemon.pid]
+    received = []
+    started = threading.Event()
+
+    def read_output():
+        for line in daemon.stdout:
+            if "Workers:" in line:
+                started.set()
+            match = re.match(r"reloaded as pid (\d+)", line)
+            if match:
+                pids.append(int(match.group(1)))
+            match = re.match(r"worker \d+ pid \d+ stopped: (\d+) datagrams", line)
+            if match:
+                received.append(int(match.group(1)))
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    started.wait(READY_TIMEOUT)
+    templates = [sflow_synthetic.datagram([sflow_synthetic.flow_sample([sflow_synthetic.sampled_header()])])]
+    results = multiprocessing.Queue()
+    sender = multiprocessing.Process(
+        target=sflow_loadgen.sender,
+        args=(0, templates, address, rate, duration, "constant", 0.01, 0, 0, results),
+    )
+    start = time.monotonic()
+    sender.start()
+    for reload in range(1, reloads + 1):
+        time.sleep(max(0, start + duration * reload / (reloads + 1) - time.monotonic()))
+        reloaded = len(pids)
+        os.kill(pids[-1], signal.SIGHUP)
+        while len(pids) == reloaded and time.monotonic() < start + duration + READY_TIMEOUT:
+            time.sleep(0.01)
+    _, sent, errors, _, _ = results.get()
+    sender.join()
+    time.sleep(0.5)
+    os.kill(pids[-1], signal.SIGTERM)
+    reader.join()
+    daemon.wait()
+    print(f"{reloads} reloads, {len(received)} workers stopped")
+    print(f"sent {sent} ({errors} errors) at {rate}/s, received {sum(received)}, lost {sent - errors - sum(received)}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="sFlow collector daemon with tuned sockets, workers and SIGHUP reload.")
+    parser.add_argument("--config", help="JSON file of option defaults, re-read on reload")
+    parser.add_argument("--listen", action="append", help=f"host:port, repeatable (default {LISTEN[0]})")
+    parser.add_argument("--rcvbuf", type=int, default=RCVBUF, help="SO_RCVBUF bytes")
+    parser.add_argument("--busy-poll", type=int, default=0, help="SO_BUSY_POLL microseconds")
+    parser.add_argument("--workers", type=int, help="worker processes (default one per cpu listed, or 1)")
+    parser.add_argument("--cpus", type=lambda value: [int(cpu) for cpu in value.split(",")], help="cpus to pin workers to")
+    parser.add_argument("--interval", type=int, default=INTERVAL, help="seconds between worker reports, 0 for none")
+    parser.add_argument("--handler", default=HANDLER, help='"module:function" called with each datagram, or "none"')
+    parser.add_argument("--benchmark", type=int, metavar="RELOADS", help="count datagrams lost over reloads and exit")
+    parser.add_argument("--rate", type=int, default=20000, help="datagrams per second sent by the benchmark")
+    parser.add_argument("--duration", type=float, default=10, help="seconds the benchmark sends for")
+    args = parser.parse_args()
+    if args.config:
+        with open(args.config) as config:
+            parser.set_defaults(**{key.replace("-", "_"): value for key, value in json.load(config).items()})
+        args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark((args.listen or ["127.0.0.1:6343"])[0], args.benchmark, args.rate, args.duration)
+    else:
+        sFlowDaemon(
+            listen=args.listen or LISTEN,
+            rcvbuf=args.rcvbuf,
+            busy_poll=args.busy_poll,
+            workers=args.workers,
+            cpus=args.cpus,
+            interval=args.interval,
+            handler=load_handler(args.handler),
+        ).run()
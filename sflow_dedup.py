@@ -0,0 +1,247 @@
+import argparse
+import json
+import random
+import socket
+import time
+from array import array
+
+import sflow
+import sflow_synthetic
+
+# The sFlow Deduplicator drops datagrams received more than once, such as through redundant export paths or collectors
+# fed by both an agent and a replicator, before any sample is decoded.
+
+# A datagram is identified by (agent_address, sub_agent, sequence_number), read with sflow.sFlowHeader. Each agent
+# and sub agent keeps the highest sequence number seen and a bitmap of the WINDOW sequence numbers below it, bit i set
+# when top - i was seen, so the memory of an agent is constant however many datagrams it sends:
+#   ahead       the bitmap shifts by the gap and the new top is marked
+#   behind      within WINDOW of the top, a duplicate when its bit is set, otherwise marked and accepted
+#   stale       more than WINDOW behind, accepted as its bit is long gone
+# Sequence numbers and system_uptime are compared modulo 2^32, so both wrap around without a false restart.
+
+# An agent that restarts starts again from sequence number 1 and uptime 0. A datagram whose system_uptime is more than
+# RESTART_UPTIME behind the latest of its agent is taken to come from a restarted agent: the window is reset and the
+# datagram accepted. The window before the restart is kept, and a late datagram from before it, within WINDOW of that
+# window's top, within RESTART_UPTIME of its uptime and far ahead of the new uptime, is checked against it instead, so
+# it neither moves the new window nor looks like another restart. The latest uptime only moves forward with the
+# sequence number. Agents silent for longer than EXPIRE are forgotten by expire().
+
+WINDOW = 4096  # sequence numbers per agent
+RESTART_UPTIME = 30000  # milliseconds
+EXPIRE = 3600  # seconds
+
+WRAP = 1 << 32
+HALF = 1 << 31
+
+# Agent state, a list per (agent_address, sub_agent)
+TOP = 0
+BITMAP = 1
+UPTIME = 2
+SEEN = 3
+DUPLICATES = 4
+PREVIOUS = 5  # [top, bitmap, uptime] before the latest restart, or None
+
+
+class sFlowDeduplicator:
+    """sFlowDeduplicator class:
+
+    window:  Sequence numbers remembered per agent.
+    agents:  (agent_address, sub_agent): [top sequence number, bitmap, latest uptime, last seen, duplicates, previous].
+    datagrams:  Datagrams checked.
+    duplicates:  Datagrams suppressed.
+    restarts:  Agent restarts, the window was reset.
+    stale:  Datagrams accepted more than window behind the top.
+    """
+
+    def __init__(self, window=WINDOW, restart_uptime=RESTART_UPTIME):
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.restart_uptime = restart_uptime
+        self.agents = {}
+        self.datagrams = 0
+        self.duplicates = 0
+        self.restarts = 0
+        self.stale = 0
+
+    def __repr__(self):
+        return f"""
+            Deduplicator:
+                Agents: {len(self.agents)}
+                Datagrams: {self.datagrams}
+                Duplicates: {self.duplicates}
+                Restarts: {self.restarts}
+                Stale: {self.stale}
+        """
+
+    def accept(self, header, now=None):
+        """True the first time the sequence number of an sFlowHeader (or sFlow) is seen, False for a duplicate."""
+        self.datagrams += 1
+        key = (header.agent_address, header.sub_agent)
+        sequence_number = header.sequence_number & 0xFFFFFFFF
+        uptime = header.system_uptime & 0xFFFFFFFF
+        state = self.agents.get(key)
+        if state is None:
+            self.agents[key] = [sequence_number, 1, uptime, time.monotonic() if now is None else now, 0, None]
+            return True
+        state[SEEN] = time.monotonic() if now is None else now
+        uptime_gap = (uptime - state[UPTIME]) % WRAP
+        if uptime_gap < HALF:
+            previous = state[PREVIOUS]
+            if (
+                previous is not None
+                and uptime_gap > self.restart_uptime
+                and self.before_restart(previous, sequence_number, uptime)
+            ):
+                return self.mark(state, previous, sequence_number)
+            if 0 < (sequence_number - state[TOP]) % WRAP < HALF:
+                state[UPTIME] = uptime
+        elif WRAP - uptime_gap > self.restart_uptime:
+            self.restarts += 1
+            state[PREVIOUS] = state[TOP : UPTIME + 1]
+            state[TOP], state[BITMAP], state[UPTIME] = sequence_number, 1, uptime
+            return True
+        return self.mark(state, state, sequence_number)
+
+    def before_restart(self, previous, sequence_number, uptime):
+        """True for a datagram near the top sequence number and latest uptime of the window before a restart."""
+        lead = (uptime - previous[UPTIME]) % WRAP
+        distance = (sequence_number - previous[TOP]) % WRAP
+        return (lead <= self.restart_uptime or lead >= WRAP - self.restart_uptime) and (
+            distance < self.window or distance > WRAP - self.window
+        )
+
+    def mark(self, state, window, sequence_number):
+        """Marks sequence_number in window, the agent's or the one before its restart. False for a duplicate."""
+        gap = (sequence_number - window[TOP]) % WRAP
+        if gap == 0:
+            state[DUPLICATES] += 1
+            self.duplicates += 1
+            return False
+        if gap < HALF:
+            window[TOP] = sequence_number
+            window[BITMAP] = (window[BITMAP] << gap | 1) & self.mask if gap < self.window else 1
+            return True
+        behind = WRAP - gap
+        if behind >= self.window:
+            self.stale += 1
+            return True
+        bit = 1 << behind
+        if window[BITMAP] & bit:
+            state[DUPLICATES] += 1
+            self.duplicates += 1
+            return False
+        window[BITMAP] |= bit
+        return True
+
+    def check(self, datagram, now=None):
+        """accept() for a raw datagram, decoding only its header. Datagrams without a known address type pass."""
+        header = sflow.sFlowHeader(datagram)
+        if header.address_type not in (1, 2):
+            return True
+        return self.accept(header, now)
+
+    def expire(self, now=None, timeout=EXPIRE):
+        """Forgets agents not seen for timeout seconds, returns the number forgotten."""
+        if now is None:
+            now = time.monotonic()
+        expired = [key for key, state in self.agents.items() if now - state[SEEN] > timeout]
+        for key in expired:
+            del self.agents[key]
+        return len(expired)
+
+    def checkpoint_arrays(self):
+        """The sequence windows as named arrays, for sflow_checkpoint."""
+        agents = self.agents
+        width = (self.window + 7) // 8
+        return {
+            "window": array("Q", (self.window,)),
+            "keys": json.dumps(list(agents)).encode("utf-8"),
+            "tops": array("Q", (state[TOP] for state in agents.values())),
+            "uptimes": array("Q", (state[UPTIME] for state in agents.values())),
+            "duplicates": array("Q", (state[DUPLICATES] for state in agents.values())),
+            "bitmaps": b"".join(state[BITMAP].to_bytes(width, "little") for state in agents.values()),
+        }
+
+    def restore_arrays(self, arrays, now=None):
+        """Replaces the sequence windows with those from checkpoint_arrays, every agent seen now."""
+        if now is None:
+            now = time.monotonic()
+        self.window = int(arrays["window"][0])
+        self.mask = (1 << self.window) - 1
+        width = (self.window + 7) // 8
+        keys = json.loads(bytes(arrays["keys"]).decode("utf-8"))
+        bitmaps = bytes(arrays["bitmaps"])
+        self.agents = {}
+        for i, key in enumerate(keys):
+            bitmap = int.from_bytes(bitmaps[i * width : (i + 1) * width], "little")
+            self.agents[tuple(key)] = [
+                int(arrays["tops"][i]),
+                bitmap,
+                int(arrays["uptimes"][i]),
+                now,
+                int(arrays["duplicates"][i]),
+                None,
+            ]
+
+    def agent_duplicates(self):
+        """(agent_address, sub_agent): duplicates suppressed."""
+        return {key: state[DUPLICATES] for key, state in self.agents.items()}
+
+
+def benchmark(datagrams):
+    sample = sflow_synthetic.flow_sample([sflow_synthetic.sampled_header()])
+    agents = [f"192.0.2.{i}" for i in range(16)]
+    sent = []
+    for i in range(datagrams):
+        agent = agents[i % len(agents)]
+        sequence_number = (i // len(agents) + WRAP - 1000) % WRAP
+        if sequence_number >= HALF:
+            sequence_number -= WRAP
+        data = sflow_synthetic.datagram([sample], agent_address=agent, sequence_number=sequence_number, system_uptime=i)
+        sent.append(data)
+        if i % 4 == 0:
+            sent.append(data)
+    random.seed(1)
+    for i in range(0, len(sent) - 64, 64):
+        chunk = sent[i : i + 64]
+        random.shuffle(chunk)
+        sent[i : i + 64] = chunk
+
+    deduplicator = sFlowDeduplicator()
+    start = time.perf_counter()
+    accepted = sum(deduplicator.check(data) for data in sent)
+    elapsed = time.perf_counter() - start
+    print(deduplicator)
+    print(f"{accepted} of {len(sent)} datagrams accepted, {len(sent) - datagrams} duplicates sent")
+    print(f"{len(sent)} datagrams in {elapsed:.2f}s: {elapsed / len(sent) * 1000000:.2f} us/datagram")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Suppress duplicate sFlow datagrams by agent sequence number.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--window", type=int, default=WINDOW, help="sequence numbers per agent")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between reports")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the cost per datagram and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        deduplicator = sFlowDeduplicator(window=args.window)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        report = time.monotonic() + args.interval
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+                if deduplicator.check(data):
+                    sflow.sFlow(data)
+            except socket.timeout:
+                pass
+            if time.monotonic() >= report:
+                deduplicator.expire()
+                print(deduplicator)
+                report = time.monotonic() + args.interval
@@ -0,0 +1,381 @@
+import argparse
+import socket
+import time
+from collections import namedtuple
+from functools import lru_cache
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+
+import numpy as np
+
+import sflow
+import sflow_rows
+import sflow_synthetic
+
+# The sFlow Volumetric Detector raises an alert when the packet or bit rate towards a destination prefix jumps far
+# above its baseline.
+
+# Flow samples are scaled to packets and bytes by sample_rate, and by the samples the agent dropped: a data source that
+# generated n samples and dropped d since its previous sample had each sample stand for (n + d) / n of them. Scaled
+# samples are summed per destination prefix (/24, /64 by default) in a dict, the only per sample work, and every tick
+# the sums become rates applied to all prefixes at once in NumPy arrays:
+#   fast        EWMA of the rate with a time constant of a few seconds, the rate compared against the threshold
+#   baseline    EWMA of the rate and of its variance over minutes, frozen while the prefix is under attack
+#   threshold   the largest of baseline + SIGMA standard deviations, RATIO * baseline and the minimum rates
+# An attack starts when the fast rate crosses the threshold and ends when it falls below HYSTERESIS * threshold, so
+# alerts fire one to two ticks after the traffic arrives. Ticks follow datagram timestamps, not the wall clock, so a
+# backlog is processed at its own pace without distorting rates.
+
+# For the first WARMUP seconds the baselines are the mean rate so far and no alert is raised. After that a prefix seen
+# for the first time starts from a zero baseline, so only the minimum rates apply to it.
+
+# State is bounded: prefixes not seen for IDLE seconds are dropped, and when the table is full the quietest prefixes
+# not under attack and not seen in the current tick are evicted, so floods towards random destinations cannot grow it.
+# When nothing can be evicted, every prefix under attack or seen this tick, a new prefix's tick is counted as
+# unallocated, with its packets and octets, rather than tracked.
+# A tick sums at most MAX_PREFIXES prefixes, samples for further new ones are counted as overflows, and at most
+# MAX_SOURCES data sources are remembered for their drops, the oldest forgotten first.
+
+TICK = 1.0  # seconds
+FAST_TIME_CONSTANT = 2.0  # seconds
+BASELINE_TIME_CONSTANT = 600.0  # seconds
+SIGMA = 6
+RATIO = 4
+HYSTERESIS = 0.7
+MIN_PPS = 10000
+MIN_BPS = 100000000
+MAX_PREFIXES = 65536
+MAX_SOURCES = 65536
+IDLE = 900  # seconds
+WARMUP = 60  # seconds
+
+PPS, BPS = 0, 1
+
+sFlowAlert = namedtuple(
+    "sFlowAlert", ("time", "prefix", "state", "packets_per_second", "bits_per_second", "baseline_pps", "baseline_bps")
+)
+
+
+class sFlowVolumetricDetector:
+    """sFlowVolumetricDetector class:
+
+    ipv4Prefix, ipv6Prefix:  Prefix lengths destinations are grouped by.
+    maxPrefixes:  Prefixes tracked.
+    prefixes:  Prefix: slot in the arrays.
+    attacks:  Prefixes under attack.
+    alerts:  Alerts raised, the latest ALERTS_KEPT.
+    evictions:  Prefixes evicted to make room.
+    overflows:  Samples not counted as a tick already summed maxPrefixes prefixes.
+    unallocated:  Ticks of new prefixes not tracked as the table was full and nothing could be evicted.
+    unallocatedPackets, unallocatedOctets:  Scaled packets and octets of those ticks.
+    """
+
+    ALERTS_KEPT = 1000
+
+    def __init__(
+        self,
+        ipv4_prefix=24,
+        ipv6_prefix=64,
+        tick=TICK,
+        fast_time_constant=FAST_TIME_CONSTANT,
+        baseline_time_constant=BASELINE_TIME_CONSTANT,
+        sigma=SIGMA,
+        ratio=RATIO,
+        min_pps=MIN_PPS,
+        min_bps=MIN_BPS,
+        max_prefixes=MAX_PREFIXES,
+        max_sources=MAX_SOURCES,
+        idle=IDLE,
+        warmup=WARMUP,
+    ):
+        self.ipv4_mask = ((1 << ipv4_prefix) - 1) << (32 - ipv4_prefix)
+        self.ipv6_mask = ((1 << ipv6_prefix) - 1) << (128 - ipv6_prefix)
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.tick = tick
+        self.fast_time_constant = fast_time_constant
+        self.baseline_time_constant = baseline_time_constant
+        self.sigma = sigma
+        self.ratio = ratio
+        self.minimum = np.array([min_pps, min_bps], dtype=np.float64)
+        self.max_prefixes = max_prefixes
+        self.max_sources = max_sources
+        self.idle = idle
+        self.warmup = warmup
+        self.prefix = lru_cache(maxsize=262144)(self.prefix_of)
+
+        self.prefixes = {}
+        self.names = [None] * max_prefixes
+        self.free = list(range(max_prefixes - 1, -1, -1))
+        self.fast = np.zeros((max_prefixes, 2))
+        self.mean = np.zeros((max_prefixes, 2))
+        self.variance = np.zeros((max_prefixes, 2))
+        self.last_seen = np.zeros(max_prefixes)
+        self.attacking = np.zeros(max_prefixes, dtype=bool)
+        self.in_use = np.zeros(max_prefixes, dtype=bool)
+
+        self.sources = {}
+        self.pending = {}
+        self.tick_start = None
+        self.first_time = None
+        self.attacks = set()
+        self.alerts = []
+        self.callbacks = []
+        self.samples = 0
+        self.evictions = 0
+        self.overflows = 0
+        self.unallocated = 0
+        self.unallocated_packets = 0
+        self.unallocated_octets = 0
+
+    def __repr__(self):
+        return f"""
+            Volumetric Detector:
+                Samples: {self.samples}
+                Prefixes: {len(self.prefixes)}
+                Attacks: {len(self.attacks)}
+                Evictions: {self.evictions}
+                Overflows: {self.overflows}
+                Unallocated: {self.unallocated} ({self.unallocated_packets:.0f} packets, {self.unallocated_octets:.0f} octets)
+        """
+
+    def prefix_of(self, address):
+        if ":" in address:
+            value = int.from_bytes(inet_pton(AF_INET6, address), "big") & self.ipv6_mask
+            return f"{inet_ntop(AF_INET6, value.to_bytes(16, 'big'))}/{self.ipv6_prefix}"
+        value = int.from_bytes(inet_pton(AF_INET, address), "big") & self.ipv4_mask
+        return f"{inet_ntop(AF_INET, value.to_bytes(4, 'big'))}/{self.ipv4_prefix}"
+
+    def on_alert(self, callback):
+        """Calls callback(sFlowAlert) when an attack starts or ends."""
+        self.callbacks.append(callback)
+
+    def drop_factor(self, agent_address, sample):
+        """Packets each sample stands for, per sample_rate, from the drops since the previous sample of its data source."""
+        key = (agent_address, sample.source_type, sample.source_index)
+        previous = self.sources.get(key)
+        if previous is None and len(self.sources) >= self.max_sources:
+            del self.sources[next(iter(self.sources))]
+        self.sources[key] = (sample.sequence, sample.dropped_packets)
+        if previous is None:
+            return 1.0
+        generated = (sample.sequence - previous[0]) & 0xFFFFFFFF
+        dropped = (sample.dropped_packets - previous[1]) & 0xFFFFFFFF
+        if generated == 0 or dropped > generated * 1000:  # A repeated sample or an agent restart.
+            return 1.0
+        return (generated + dropped) / generated
+
+    def add(self, sflow_data, timestamp=None):
+        """Adds the flow samples of a decoded datagram received at timestamp."""
+        if timestamp is None:
+            timestamp = time.time()
+        if self.tick_start is None:
+            self.tick_start = self.first_time = timestamp
+        elif timestamp - self.tick_start >= self.tick:
+            self.advance(timestamp)
+        pending = self.pending
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            _, destination, _, _, _, frame_length = sflow_rows.flow_tuple(sample)
+            if destination is None:
+                continue
+            packets = sample.sample_rate * self.drop_factor(sflow_data.agent_address, sample)
+            prefix = self.prefix(destination)
+            totals = pending.get(prefix)
+            if totals is None:
+                if len(pending) >= self.max_prefixes:
+                    self.overflows += 1
+                    continue
+                pending[prefix] = [packets, packets * (frame_length or 0)]
+            else:
+                totals[0] += packets
+                totals[1] += packets * (frame_length or 0)
+            self.samples += 1
+
+    def allocate(self, prefix, now):
+        if not self.free:
+            self.evict(now)
+            if not self.free:
+                return None
+        slot = self.free.pop()
+        self.prefixes[prefix] = slot
+        self.names[slot] = prefix
+        self.in_use[slot] = True
+        self.last_seen[slot] = now
+        self.fast[slot] = self.mean[slot] = self.variance[slot] = 0
+        return slot
+
+    def release(self, slots):
+        for slot in slots.tolist():
+            del self.prefixes[self.names[slot]]
+            self.names[slot] = None
+            self.free.append(slot)
+        self.in_use[slots] = False
+
+    def evict(self, now):
+        """Drops the idle prefixes, or failing that the eighth of the table with the lowest baseline.
+
+        Prefixes seen in the tick being closed, last_seen now, are kept: their rates are already set.
+        """
+        idle = np.flatnonzero(self.in_use & ~self.attacking & (now - self.last_seen > self.idle))
+        if len(idle) == 0:
+            candidates = np.flatnonzero(self.in_use & ~self.attacking & (self.last_seen < now))
+            idle = candidates[np.argsort(self.mean[candidates, PPS])[: max(1, self.max_prefixes // 8)]]
+            self.evictions += len(idle)
+        self.release(idle)
+
+    def advance(self, now):
+        """Closes the tick, updating every prefix and raising alerts."""
+        elapsed = now - self.tick_start
+        self.tick_start = now
+        pending, self.pending = self.pending, {}
+
+        rates = np.zeros_like(self.fast)
+        new = []
+        for prefix, (packets, octets) in pending.items():
+            slot = self.prefixes.get(prefix)
+            if slot is None:
+                new.append((prefix, packets, octets))  # Allocated once every known prefix is marked seen.
+                continue
+            rates[slot, PPS] = packets / elapsed
+            rates[slot, BPS] = octets * 8 / elapsed
+            self.last_seen[slot] = now
+        for prefix, packets, octets in new:
+            slot = self.allocate(prefix, now)
+            if slot is None:
+                self.unallocated += 1
+                self.unallocated_packets += packets
+                self.unallocated_octets += octets
+                continue
+            rates[slot, PPS] = packets / elapsed
+            rates[slot, BPS] = octets * 8 / elapsed
+
+        in_use = self.in_use
+        fast_alpha = 1 - np.exp(-elapsed / self.fast_time_constant)
+        self.fast[in_use] += fast_alpha * (rates[in_use] - self.fast[in_use])
+        threshold = np.maximum(self.mean + self.sigma * np.sqrt(self.variance), self.ratio * self.mean)
+        threshold = np.maximum(threshold, self.minimum)
+        warming_up = now - self.first_time < self.warmup
+        if warming_up:
+            started = ended = np.zeros(0, dtype=np.int64)
+        else:
+            above = (self.fast > threshold).any(axis=1)
+            below = (self.fast < HYSTERESIS * threshold).all(axis=1)
+            started = np.flatnonzero(in_use & above & ~self.attacking)
+            ended = np.flatnonzero(in_use & below & self.attacking)
+            self.attacking[started] = True
+            self.attacking[ended] = False
+
+        quiet = in_use & ~self.attacking
+        baseline_alpha = 1 - np.exp(-elapsed / self.baseline_time_constant)
+        if warming_up:
+            baseline_alpha = max(baseline_alpha, elapsed / (now - self.first_time))
+        difference = rates[quiet] - self.mean[quiet]
+        self.mean[quiet] += baseline_alpha * difference
+        self.variance[quiet] = (1 - baseline_alpha) * (self.variance[quiet] + baseline_alpha * difference * difference)
+
+        for slots, state in ((started, "start"), (ended, "end")):
+            for slot in slots.tolist():
+                self.alert(now, slot, state)
+
+        idle = np.flatnonzero(in_use & ~self.attacking & (now - self.last_seen > self.idle))
+        if len(idle):
+            self.release(idle)
+
+    def alert(self, now, slot, state):
+        prefix = self.names[slot]
+        if state == "start":
+            self.attacks.add(prefix)
+        else:
+            self.attacks.discard(prefix)
+        alert = sFlowAlert(now, prefix, state, *self.fast[slot].tolist(), *self.mean[slot].tolist())
+        self.alerts.append(alert)
+        del self.alerts[: -self.ALERTS_KEPT]
+        for callback in self.callbacks:
+            callback(alert)
+
+
+def benchmark(seconds, datagrams_per_second):
+    normal = [
+        sflow.sFlow(
+            sflow_synthetic.datagram(
+                [
+                    sflow_synthetic.flow_sample(
+                        [sflow_synthetic.sampled_ipv4(destination_ip=f"198.51.{(i + j) % 64}.{j}", length=800)],
+                        sequence=i * 8 + j,
+                        sample_rate=1000,
+                    )
+                    for j in range(8)
+                ],
+                sequence_number=i,
+            )
+        )
+        for i in range(64)
+    ]
+    attack = [
+        sflow.sFlow(
+            sflow_synthetic.datagram(
+                [
+                    sflow_synthetic.flow_sample(
+                        [sflow_synthetic.sampled_ipv4(source_ip=f"10.{i}.{j}.1", destination_ip="203.0.113.7", length=64)],
+                        sequence=i * 8 + j,
+                        source_index=2,
+                        sample_rate=1000,
+                    )
+                    for j in range(8)
+                ],
+                agent_address="192.0.2.2",
+                sequence_number=i,
+            )
+        )
+        for i in range(64)
+    ]
+
+    detector = sFlowVolumetricDetector()
+    attack_start = seconds * 0.8
+    detected = []
+    detector.on_alert(lambda alert: detected.append(alert) if alert.state == "start" else None)
+    datagrams = 0
+    start = time.perf_counter()
+    for second in range(seconds):
+        for i in range(datagrams_per_second):
+            detector.add(normal[i % len(normal)], second + i / datagrams_per_second)
+        if second >= attack_start:
+            for i in range(datagrams_per_second * 9):
+                detector.add(attack[i % len(attack)], second + i / (datagrams_per_second * 9))
+            datagrams += datagrams_per_second * 9
+        datagrams += datagrams_per_second
+    elapsed = time.perf_counter() - start
+
+    print(f"{datagrams} datagrams, {detector.samples} samples in {elapsed:.2f}s: {detector.samples / elapsed:.0f} samples/s")
+    for alert in detected:
+        print(f"{alert.prefix} attacked, detected {alert.time - int(attack_start):.1f}s after it started")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Detect volumetric attacks towards destination prefixes.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--min-pps", type=float, default=MIN_PPS)
+    parser.add_argument("--min-bps", type=float, default=MIN_BPS)
+    parser.add_argument("--benchmark", type=int, metavar="SECONDS", help="replay a simulated attack and exit")
+    parser.add_argument("--rate", type=int, default=200, help="normal datagrams per second of the benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.rate)
+    else:
+        detector = sFlowVolumetricDetector(min_pps=args.min_pps, min_bps=args.min_bps)
+        detector.on_alert(print)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(detector.tick)
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+            except socket.timeout:
+                if detector.tick_start is not None:
+                    detector.advance(time.time())
+                continue
+            detector.add(sflow.sFlow(data))
@@ -0,0 +1,205 @@
+import csv
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from socket import AF_INET, AF_INET6, inet_pton
+
+import sflow
+
+# The sFlow Enricher tags flow addresses with the customer, site, ASN or any other columns of the longest matching prefix.
+
+# Prefixes are loaded from a CSV file, one prefix per line followed by its annotation columns:
+#   prefix,customer,site,asn
+#   10.0.0.0/8,acme,ams1,64512
+# A first line that does not start with a prefix is taken as the column names. Lines starting with # are skipped.
+# MRT dumps are loaded by first reducing them to prefix,asn lines, for example from bgpdump -m output.
+
+# Nested prefixes are flattened into sorted, non overlapping address ranges, each pointing at the annotation of the
+# most specific prefix covering it, so a lookup is a single bisect. IPv4 ranges are kept in 32-bit arrays, IPv6 ranges
+# in lists of integers. Identical annotations are stored once.
+
+# Enriched addresses
+#   sFlowSampledIpv4, sFlowSampledIpv6     source_ip, destination_ip
+#   sFlowRawPacketHeader                   ip_source, ip_destination (IPv4 headers)
+#   sFlowExtendedGateway                   next_hop
+
+LRU_SIZE = 65536
+
+enriched_addresses = {
+    sflow.sFlowSampledIpv4: (("source_ip", "source_annotation"), ("destination_ip", "destination_annotation")),
+    sflow.sFlowSampledIpv6: (("source_ip", "source_annotation"), ("destination_ip", "destination_annotation")),
+    sflow.sFlowRawPacketHeader: (("ip_source", "source_annotation"), ("ip_destination", "destination_annotation")),
+    sflow.sFlowExtendedGateway: (("next_hop", "next_hop_annotation"),),
+}
+
+
+def flatten(prefixes):
+    """Turns (start, end, value) prefixes into sorted, disjoint ranges where the most specific prefix wins."""
+    starts, ends, values = [], [], []
+
+    def emit(start, end, value):
+        if start > end:
+            return
+        if ends and ends[-1] + 1 == start and values[-1] == value:
+            ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+            values.append(value)
+
+    position = 0
+    stack = []
+    for start, end, value in sorted(prefixes, key=lambda prefix: (prefix[0], -prefix[1])):
+        while stack and stack[-1][0] < start:
+            stack_end, stack_value = stack.pop()
+            emit(position, stack_end, stack_value)
+            position = max(position, stack_end + 1)
+        if stack:
+            emit(position, start - 1, stack[-1][1])
+        position = start
+        stack.append((end, value))
+    while stack:
+        stack_end, stack_value = stack.pop()
+        emit(position, stack_end, stack_value)
+        position = max(position, stack_end + 1)
+
+    return starts, ends, values
+
+
+class sFlowPrefixTable:
+    """sFlowPrefixTable class:
+
+    fields:  Annotation column names.
+    annotations:  Distinct annotation tuples, ranges point at these by index.
+    prefixes:  Number of prefixes loaded.
+    """
+
+    def __init__(self, rows, fields=None, lru_size=LRU_SIZE):
+        self.fields = tuple(fields) if fields else ()
+        self.annotations = []
+        interned = {}
+        prefixes = {4: [], 6: []}
+        self.prefixes = 0
+        for prefix, annotation in rows:
+            address, _, length = prefix.partition("/")
+            if ":" in address:
+                version, bits, family = 6, 128, AF_INET6
+            else:
+                version, bits, family = 4, 32, AF_INET
+            length = int(length) if length else bits
+            start = int.from_bytes(inet_pton(family, address), "big") >> (bits - length) << (bits - length)
+            annotation = tuple(annotation)
+            if annotation not in interned:
+                interned[annotation] = len(self.annotations)
+                self.annotations.append(annotation)
+            prefixes[version].append((start, start + (1 << (bits - length)) - 1, interned[annotation]))
+            self.prefixes += 1
+
+        starts, ends, values = flatten(prefixes[4])
+        self.ipv4 = (array("I", starts), array("I", ends), array("I", values))
+        starts, ends, values = flatten(prefixes[6])
+        self.ipv6 = (starts, ends, array("I", values))
+        self.lookup = lru_cache(maxsize=lru_size)(self.search)
+
+    def __repr__(self):
+        return f"""
+            Prefix Table:
+                Fields: {self.fields}
+                Prefixes: {self.prefixes}
+                IPv4 Ranges: {len(self.ipv4[0])}
+                IPv6 Ranges: {len(self.ipv6[0])}
+                Annotations: {len(self.annotations)}
+        """
+
+    @classmethod
+    def load(cls, path, lru_size=LRU_SIZE):
+        fields = None
+        rows = []
+        with open(path, newline="") as prefix_file:
+            for line in csv.reader(prefix_file):
+                if not line or line[0].startswith("#"):
+                    continue
+                if fields is None and not rows and "/" not in line[0] and "." not in line[0] and ":" not in line[0]:
+                    fields = line[1:]
+                    continue
+                rows.append((line[0].strip(), [column.strip() for column in line[1:]]))
+        return cls(rows, fields, lru_size)
+
+    def search(self, address):
+        """Returns the annotation of the longest prefix matching an address string, None when no prefix matches."""
+        if not address:
+            return None
+        if ":" in address:
+            starts, ends, values = self.ipv6
+            value = int.from_bytes(inet_pton(AF_INET6, address), "big")
+        else:
+            starts, ends, values = self.ipv4
+            value = int.from_bytes(inet_pton(AF_INET, address), "big")
+        index = bisect_right(starts, value) - 1
+        if index < 0 or value > ends[index]:
+            return None
+        return self.annotations[values[index]]
+
+
+class sFlowEnricher:
+    """sFlowEnricher class:
+
+    Annotates the addresses of flow records in place, see enriched_addresses.
+
+    table:  The sFlowPrefixTable in use. Replaced as a whole on reload, so a lookup never sees a partial table.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, lru_size=LRU_SIZE):
+        return cls(sFlowPrefixTable.load(path, lru_size))
+
+    def reload(self, path):
+        """Loads a new table and swaps it in once complete, lookups carry on against the old table meanwhile."""
+        with self.lock:
+            table = sFlowPrefixTable.load(path, self.table.lookup.cache_info().maxsize)
+            self.table = table
+        return table
+
+    def reload_in_background(self, path):
+        thread = threading.Thread(target=self.reload, args=(path,), daemon=True)
+        thread.start()
+        return thread
+
+    def lookup(self, address):
+        return self.table.lookup(address)
+
+    @staticmethod
+    def enrich_datagram(sflow_data, lookup):
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            for record in sample.records:
+                for address_field, annotation_field in enriched_addresses.get(type(record.record), ()):
+                    address = getattr(record.record, address_field, None)
+                    setattr(record.record, annotation_field, lookup(address) if isinstance(address, str) else None)
+
+    def enrich(self, sflow_data):
+        """Annotates every flow record of a decoded datagram."""
+        self.enrich_datagram(sflow_data, self.table.lookup)
+        return sflow_data
+
+    def enrich_all(self, datagrams):
+        """Annotates a batch of decoded datagrams against one table, even if a reload lands meanwhile."""
+        lookup = self.table.lookup
+        for sflow_data in datagrams:
+            self.enrich_datagram(sflow_data, lookup)
+        return datagrams
+
+
+if __name__ == "__main__":
+
+    prefix_table = sFlowPrefixTable.load(sys.argv[1])
+    print(prefix_table)
+    for argument in sys.argv[2:]:
+        print(argument, prefix_table.lookup(argument))
@@ -0,0 +1,139 @@
+import argparse
+import gc
+import time
+
+import sflow
+import sflow_loadgen
+from sflow_trace import sFlowLatencyHistogram
+
+# The sFlow GC Monitor measures the pauses of the cyclic garbage collector in a collector process, and its benchmark
+# compares decoding every datagram into new objects with refilling pooled ones (sflow.sFlowPool).
+
+# Parsed objects hold no reference cycles, so reference counting frees them as soon as they are dropped, and the
+# cyclic collector counts only the containers allocated and not yet freed: a collection is started by the objects a
+# consumer keeps, windows and tables, not by the datagrams decoded and dropped in between. A pool changes how parsed
+# objects are allocated, and the monitor shows whether that changes how often and how long the collector pauses.
+
+# The benchmark decodes the same datagrams both ways, alternating REPEAT times and keeping the fastest run of each. A
+# consumer keeps a tuple per flow record in a window closed every WINDOW datagrams, and RETAINED long lived objects
+# stand in for the tables of a collector.
+
+RETAINED = 1000000  # tracked objects held by the process during the benchmark
+WINDOW = 1000  # datagrams
+REPEAT = 3
+AGENTS = 64
+
+
+class sFlowGcMonitor:
+    """sFlowGcMonitor class:
+
+    pauses:  sflow_trace.sFlowLatencyHistogram of the pauses of each generation, nanoseconds.
+    collected:  Objects freed by the cyclic collector.
+    """
+
+    def __init__(self):
+        self.pauses = [sFlowLatencyHistogram() for _ in range(3)]
+        self.collected = 0
+        self.start = None
+
+    def __repr__(self):
+        generations = "".join(
+            f"\n                Generation {generation}: {pauses}" for generation, pauses in enumerate(self.pauses)
+        )
+        return f"""
+            GC Pauses:{generations}
+                Collected: {self.collected}
+        """
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.start = time.perf_counter_ns()
+        elif self.start is not None:
+            self.pauses[info["generation"]].add(time.perf_counter_ns() - self.start)
+            self.collected += info["collected"]
+            self.start = None
+
+    def install(self):
+        gc.callbacks.append(self.callback)
+        return self
+
+    def remove(self):
+        if self.callback in gc.callbacks:
+            gc.callbacks.remove(self.callback)
+
+    def reset(self):
+        self.pauses = [sFlowLatencyHistogram() for _ in range(3)]
+        self.collected = 0
+
+    def total(self):
+        """Nanoseconds paused in every generation."""
+        return sum(pauses.total for pauses in self.pauses)
+
+
+def consume(sflow_data, window):
+    agent_address = sflow_data.agent_address
+    for sample in sflow_data.samples:
+        if sample.sample_type != 1:
+            continue
+        for record in sample.records:
+            if record.format == 1:
+                window.append((agent_address, sample.input_if_value, record.record.frame_length * sample.sample_rate))
+
+
+def run(datagrams, count, pool):
+    monitor = sFlowGcMonitor().install()
+    latency = sFlowLatencyHistogram()
+    window = []
+    clock = time.perf_counter_ns
+    start = clock()
+    for i in range(count):
+        data = datagrams[i % len(datagrams)]
+        received = clock()
+        if pool is None:
+            consume(sflow.sFlow(data), window)
+        else:
+            sflow_data = pool.parse(data)
+            consume(sflow_data, window)
+            pool.release(sflow_data)
+        if i % WINDOW == 0:
+            window = []
+        latency.add(clock() - received)
+    elapsed = (clock() - start) / 1e9
+    monitor.remove()
+    return elapsed, latency, monitor
+
+
+def benchmark(count, mix, retained, repeat=REPEAT):
+    datagrams = [sflow_loadgen.mix_datagram(mix, f"192.0.2.{agent}", seed=agent) for agent in range(AGENTS)]
+    state = [{"bytes": i, "packets": [i]} for i in range(retained // 2)]
+    gc.collect()
+    pool = sflow.sFlowPool()
+    results = {}
+    for _ in range(repeat):
+        for mode in ("allocate", "pool"):
+            result = run(datagrams, count, pool if mode == "pool" else None)
+            if mode not in results or result[0] < results[mode][0]:
+                results[mode] = result
+    for mode, (elapsed, latency, monitor) in results.items():
+        collections = "/".join(str(pauses.count) for pauses in monitor.pauses)
+        print(f"{mode}: {count / elapsed:.0f} datagrams/s, latency {latency}")
+        print(f"    collections {collections} (gen 0/1/2), paused {monitor.total() / 1e6:.1f}ms of {elapsed * 1000:.0f}ms")
+        for generation, pauses in enumerate(monitor.pauses):
+            if pauses.count:
+                print(f"    generation {generation}: {pauses}")
+    print(
+        f"pool: {results['allocate'][0] / results['pool'][0] - 1:+.1%} throughput, reused {pool.reused}, allocated {pool.allocated}"
+    )
+    print(f"{len(state) * 2} retained objects")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="GC pauses and throughput of pooled against allocating sFlow parsing.")
+    parser.add_argument("--datagrams", type=int, default=100000)
+    parser.add_argument("--mix", default=sflow_loadgen.MIX, help="samples per datagram, as sflow_loadgen")
+    parser.add_argument("--retained", type=int, default=RETAINED, help="long lived tracked objects held meanwhile")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="runs of each mode, the fastest kept")
+    args = parser.parse_args()
+
+    benchmark(args.datagrams, args.mix, args.retained, args.repeat)
@@ -0,0 +1,382 @@
+import argparse
+import socket
+import time
+
+import numpy as np
+
+import sflow
+import sflow_synthetic
+
+# The sFlow Host Telemetry keeps the latest resource rates of every host and virtual machine, and which hypervisor
+# each virtual machine runs on.
+
+# Host sFlow agents send one counter sample per entity: the hypervisor or host itself (sFlowHostCPU, sFlowHostMemory,
+# sFlowHostDiskIO, sFlowHostNetIO, sFlowVirtNode) and one per virtual machine (sFlowVirtCPU, sFlowVirtMemory,
+# sFlowVirtDiskIO, sFlowVirtNetIO and sFlowHostParent naming the hypervisor's data source). sFlowHostDescr gives both
+# their names. An entity is (agent_address, source_type, source_index) and a parent (agent_address, container_type,
+# container_index).
+
+# sFlowHostDescr and sFlowHostParent are resent unchanged every poll. --record-cache decodes them once through
+# sflow.record_cache; sflow_cache.py measures what that saves.
+
+# Every poll is turned into METRICS at once, from the counter deltas since the entity's previous poll, and written to
+# the entity's row of a NumPy array. Hypervisors keep the slots of their virtual machines, so "top N virtual machines
+# of hypervisor X by disk IO" reads a handful of rows instead of any sample.
+
+# Metrics
+#   cpu_utilization         0-1, hosts from idle time over all CPU time, virtual machines from cpu_time_used over
+#                           elapsed time and virtual CPUs
+#   memory_utilization      0-1, hosts without free, buffers and cache, virtual machines memory over max_memory
+#   load                    1 minute load average, hosts only
+#   disk_read_bytes, disk_write_bytes, disk_bytes, disk_iops, net_in_bytes, net_out_bytes       per second
+# Metrics not reported, or before a second poll, are NaN.
+
+METRICS = (
+    "cpu_utilization",
+    "memory_utilization",
+    "load",
+    "disk_read_bytes",
+    "disk_write_bytes",
+    "disk_bytes",
+    "disk_iops",
+    "net_in_bytes",
+    "net_out_bytes",
+)
+
+HOST, VM = 1, 2
+
+# Counters: (record, attribute, width in bits)
+HOST_COUNTERS = (
+    (sflow.sFlowHostCPU, "user_time", 32),
+    (sflow.sFlowHostCPU, "nice_time", 32),
+    (sflow.sFlowHostCPU, "system_time", 32),
+    (sflow.sFlowHostCPU, "idle_time", 32),
+    (sflow.sFlowHostCPU, "io_wait_time", 32),
+    (sflow.sFlowHostCPU, "intrupt_time", 32),
+    (sflow.sFlowHostCPU, "soft_interrupt_time", 32),
+    (sflow.sFlowHostDiskIO, "read_bytes", 64),
+    (sflow.sFlowHostDiskIO, "write_bytes", 64),
+    (sflow.sFlowHostDiskIO, "read", 32),
+    (sflow.sFlowHostDiskIO, "write", 32),
+    (sflow.sFlowHostNetIO, "in_byte", 64),
+    (sflow.sFlowHostNetIO, "out_byte", 64),
+)
+VM_COUNTERS = (
+    (sflow.sFlowVirtCPU, "cpu_time_used", 32),
+    (sflow.sFlowVirtDiskIO, "read_bytes", 64),
+    (sflow.sFlowVirtDiskIO, "write_bytes", 64),
+    (sflow.sFlowVirtDiskIO, "read_requests", 32),
+    (sflow.sFlowVirtDiskIO, "write_requests", 32),
+    (sflow.sFlowVirtNetIO, "received_bytes", 64),
+    (sflow.sFlowVirtNetIO, "transmitted_bytes", 64),
+)
+
+VM_RECORDS = {sflow.sFlowVirtCPU, sflow.sFlowVirtMemory, sflow.sFlowVirtDiskIO, sflow.sFlowVirtNetIO, sflow.sFlowHostParent}
+HOST_RECORDS = {sflow.sFlowHostCPU, sflow.sFlowHostMemory, sflow.sFlowHostDiskIO, sflow.sFlowHostNetIO, sflow.sFlowVirtNode}
+
+CAPACITY = 1024
+EXPIRY = 3600  # seconds without a poll before an entity is dropped
+
+NAN = float("nan")
+
+
+def counter_values(records, counters):
+    return tuple(
+        getattr(records[record_type], field) & ((1 << width) - 1) if record_type in records else None
+        for record_type, field, width in counters
+    )
+
+
+def counter_deltas(current, previous, counters):
+    """Deltas allowing for counter wraps, None where either poll lacks the counter or a 64-bit counter went back."""
+    deltas = []
+    for value, previous_value, (_, _, width) in zip(current, previous, counters):
+        if value is None or previous_value is None:
+            deltas.append(None)
+            continue
+        delta = value - previous_value
+        if delta < 0:
+            delta = None if width == 64 else delta + (1 << width)
+        deltas.append(delta)
+    return deltas
+
+
+def rate(delta, elapsed):
+    return NAN if delta is None else delta / elapsed
+
+
+def rate_sum(first, second, elapsed):
+    return NAN if first is None or second is None else (first + second) / elapsed
+
+
+class sFlowHostTelemetry:
+    """sFlowHostTelemetry class:
+
+    entities:  (agent_address, source_type, source_index): slot.
+    metrics:  METRICS of each slot, NaN when unknown.
+    kinds:  HOST, VM or 0 for a free slot.
+    parents:  Slot of the parent of each slot, -1 for none.
+    children:  Parent slot: set of child slots.
+    names:  Host name of each slot, from sFlowHostDescr.
+    """
+
+    def __init__(self, capacity=CAPACITY, expiry=EXPIRY):
+        self.expiry = expiry
+        self.entities = {}
+        self.keys = [None] * capacity
+        self.names = [None] * capacity
+        self.by_name = {}
+        self.metrics = np.full((capacity, len(METRICS)), NAN)
+        self.kinds = np.zeros(capacity, dtype=np.int8)
+        self.parents = np.full(capacity, -1, dtype=np.int64)
+        self.updated = np.zeros(capacity)
+        self.previous = [None] * capacity
+        self.children = {}
+        self.child_slots = {}
+        self.free = list(range(capacity - 1, -1, -1))
+        self.polls = 0
+
+    def __repr__(self):
+        return f"""
+            Host Telemetry:
+                Hosts: {int((self.kinds == HOST).sum())}
+                Virtual Machines: {int((self.kinds == VM).sum())}
+                Polls: {self.polls}
+        """
+
+    def grow(self):
+        capacity = len(self.keys)
+        self.keys += [None] * capacity
+        self.names += [None] * capacity
+        self.previous += [None] * capacity
+        self.metrics = np.concatenate((self.metrics, np.full((capacity, len(METRICS)), NAN)))
+        self.kinds = np.concatenate((self.kinds, np.zeros(capacity, dtype=np.int8)))
+        self.parents = np.concatenate((self.parents, np.full(capacity, -1, dtype=np.int64)))
+        self.updated = np.concatenate((self.updated, np.zeros(capacity)))
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+
+    def slot(self, key, kind):
+        slot = self.entities.get(key)
+        if slot is None:
+            if not self.free:
+                self.grow()
+            slot = self.entities[key] = self.free.pop()
+            self.keys[slot] = key
+        self.kinds[slot] = kind
+        return slot
+
+    def set_parent(self, slot, parent):
+        previous = self.parents[slot]
+        if previous == parent:
+            return
+        if previous >= 0:
+            self.children[previous].discard(slot)
+            self.child_slots.pop(previous, None)
+        self.parents[slot] = parent
+        if parent >= 0:
+            self.children.setdefault(parent, set()).add(slot)
+            self.child_slots.pop(parent, None)
+
+    def update(self, sflow_data, timestamp=None):
+        """Adds the host and virtual machine counter samples of a decoded datagram."""
+        if timestamp is None:
+            timestamp = time.time()
+        agent = sflow_data.agent_address
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (2, 4):
+                continue
+            records = {type(record.record): record.record for record in sample.records}
+            if not VM_RECORDS.isdisjoint(records):
+                kind, counters = VM, VM_COUNTERS
+            elif not HOST_RECORDS.isdisjoint(records):
+                kind, counters = HOST, HOST_COUNTERS
+            else:
+                continue
+            slot = self.slot((agent, sample.source_type, sample.source_index), kind)
+            self.polls += 1
+
+            description = records.get(sflow.sFlowHostDescr)
+            if description is not None and description.host_name != self.names[slot]:
+                if self.by_name.get(self.names[slot]) == slot:
+                    del self.by_name[self.names[slot]]
+                self.names[slot] = description.host_name
+                self.by_name[description.host_name] = slot
+            parent = records.get(sflow.sFlowHostParent)
+            if parent is not None:
+                self.set_parent(slot, self.slot((agent, parent.container_type, parent.container_index), HOST))
+
+            current = counter_values(records, counters)
+            previous = self.previous[slot]
+            self.previous[slot] = (timestamp, current)
+            row = [NAN] * len(METRICS)
+            if previous is not None and timestamp > previous[0]:
+                elapsed = timestamp - previous[0]
+                deltas = counter_deltas(current, previous[1], counters)
+                if kind == HOST:
+                    row[0] = self.host_cpu(deltas)
+                    row[3:] = self.io_rates(deltas[7:9], deltas[9:11], deltas[11:13], elapsed)
+                else:
+                    virtual_cpu = records.get(sflow.sFlowVirtCPU)
+                    if deltas[0] is not None and virtual_cpu.number_virtual_cpus > 0:
+                        row[0] = deltas[0] / (elapsed * 1000 * virtual_cpu.number_virtual_cpus)
+                    row[3:] = self.io_rates(deltas[1:3], deltas[3:5], deltas[5:7], elapsed)
+            if kind == HOST:
+                memory = records.get(sflow.sFlowHostMemory)
+                if memory is not None and memory.memory_total > 0:
+                    used = memory.memory_total - memory.memory_free - memory.memory_buffers - memory.memory_cache
+                    row[1] = used / memory.memory_total
+                cpu = records.get(sflow.sFlowHostCPU)
+                if cpu is not None:
+                    row[2] = cpu.average_load_1_minute
+            else:
+                memory = records.get(sflow.sFlowVirtMemory)
+                if memory is not None and memory.max_memory > 0:
+                    row[1] = memory.memory / memory.max_memory
+            self.metrics[slot] = row
+            self.updated[slot] = timestamp
+
+    @staticmethod
+    def host_cpu(deltas):
+        times = deltas[0:7]
+        if None in times or sum(times) == 0:
+            return NAN
+        return 1 - deltas[3] / sum(times)
+
+    @staticmethod
+    def io_rates(disk_bytes, disk_operations, net_bytes, elapsed):
+        return [
+            rate(disk_bytes[0], elapsed),
+            rate(disk_bytes[1], elapsed),
+            rate_sum(disk_bytes[0], disk_bytes[1], elapsed),
+            rate_sum(disk_operations[0], disk_operations[1], elapsed),
+            rate(net_bytes[0], elapsed),
+            rate(net_bytes[1], elapsed),
+        ]
+
+    def lookup(self, host):
+        """Slot of a host given by name or (agent_address, source_type, source_index)."""
+        return self.by_name.get(host) if isinstance(host, str) else self.entities.get(host)
+
+    def top(self, metric, n=10, host=None, kind=VM):
+        """Returns [(name or key, value)] of the n entities with the highest metric, of one host's children or of a kind."""
+        if host is not None:
+            parent = self.lookup(host)
+            if parent is None:
+                return []
+            slots = self.child_slots.get(parent)
+            if slots is None:
+                slots = self.child_slots[parent] = np.array(sorted(self.children.get(parent, ())), dtype=np.int64)
+        else:
+            slots = np.flatnonzero(self.kinds == kind)
+        values = self.metrics[slots, METRICS.index(metric)]
+        known = ~np.isnan(values)
+        slots, values = slots[known], values[known]
+        order = np.argsort(-values, kind="stable")[:n]
+        return [
+            (self.names[slot] or self.keys[slot], value) for slot, value in zip(slots[order].tolist(), values[order].tolist())
+        ]
+
+    def expire(self, now=None):
+        """Drops the entities not polled for expiry seconds, returns how many."""
+        now = time.time() if now is None else now
+        stale = np.flatnonzero((self.kinds != 0) & (now - self.updated > self.expiry))
+        expired = 0
+        for slot in sorted(stale.tolist(), key=lambda slot: self.kinds[slot] == HOST):  # Virtual machines first.
+            if self.children.get(slot):  # A hypervisor whose virtual machines still report.
+                continue
+            expired += 1
+            self.set_parent(slot, -1)
+            self.children.pop(slot, None)
+            self.child_slots.pop(slot, None)
+            if self.by_name.get(self.names[slot]) == slot:
+                del self.by_name[self.names[slot]]
+            del self.entities[self.keys[slot]]
+            self.keys[slot] = self.names[slot] = self.previous[slot] = None
+            self.kinds[slot] = 0
+            self.metrics[slot] = NAN
+            self.free.append(slot)
+        return expired
+
+
+def benchmark(hypervisors, vms, polls):
+    datagrams = []
+    for poll in range(polls):
+        for hypervisor in range(hypervisors):
+            samples = [
+                sflow_synthetic.counter_sample(
+                    [
+                        sflow_synthetic.host_descr(f"hv{hypervisor}"),
+                        sflow_synthetic.host_cpu(1.0, 32, poll * 9000, poll * 3000, poll * 20000),
+                        sflow_synthetic.host_memory(1 << 37, 1 << 35, 1 << 30, 1 << 32),
+                        sflow_synthetic.host_disk_io(poll * 100, poll * 1 << 20, poll * 50, poll * 1 << 19),
+                        sflow_synthetic.host_net_io(poll * 1 << 24, 0, poll * 1 << 23, 0),
+                    ],
+                    sequence=poll,
+                    source_type=2,
+                    source_index=1,
+                )
+            ]
+            for vm in range(vms):
+                samples.append(
+                    sflow_synthetic.counter_sample(
+                        [
+                            sflow_synthetic.host_descr(f"hv{hypervisor}-vm{vm}"),
+                            sflow_synthetic.host_parent(2, 1),
+                            sflow_synthetic.virt_cpu(poll * 100 * (vm % 8), 4),
+                            sflow_synthetic.virt_memory(1 << 32, 1 << 33),
+                            sflow_synthetic.virt_disk_io(poll * vm, poll * vm * 4096, poll, poll * 4096),
+                            sflow_synthetic.virt_net_io(poll * vm * 1000, 0, poll * 1000, 0),
+                        ],
+                        sequence=poll,
+                        source_type=3,
+                        source_index=vm,
+                    )
+                )
+            datagrams.append(
+                (sflow_synthetic.datagram(samples, agent_address=f"10.1.{hypervisor // 256}.{hypervisor % 256}"), poll * 20.0)
+            )
+    telemetry = sFlowHostTelemetry()
+    start = time.perf_counter()
+    for data, now in datagrams:
+        telemetry.update(sflow.sFlow(data), now)
+    elapsed = time.perf_counter() - start
+    print(telemetry)
+    print(f"{telemetry.polls} polls in {elapsed:.2f}s, including decoding: {telemetry.polls / elapsed:.0f} polls/s")
+    start = time.perf_counter()
+    for hypervisor in range(hypervisors):
+        result = telemetry.top("disk_bytes", 5, host=f"hv{hypervisor}")
+    print(f"top 5 by disk IO per hypervisor in {(time.perf_counter() - start) / hypervisors * 1e6:.0f} us: {result}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Live host and virtual machine resource telemetry from host sFlow.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--interval", type=float, default=30, help="seconds between reports")
+    parser.add_argument("--metric", default="cpu_utilization", choices=METRICS)
+    parser.add_argument("--record-cache", type=int, default=0, metavar="RECORDS", help="share decoded descriptive records")
+    parser.add_argument("--benchmark", type=int, nargs=3, metavar=("HYPERVISORS", "VMS", "POLLS"))
+    args = parser.parse_args()
+    if args.record_cache:
+        sflow.record_cache = sflow.sFlowRecordCache(args.record_cache)
+
+    if args.benchmark:
+        benchmark(*args.benchmark)
+    else:
+        telemetry = sFlowHostTelemetry()
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(args.interval)
+        last_report = time.monotonic()
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+                telemetry.update(sflow.sFlow(data))
+            except socket.timeout:
+                pass
+            if time.monotonic() - last_report >= args.interval:
+                telemetry.expire()
+                print(f"hosts by {args.metric}: {telemetry.top(args.metric, kind=HOST)}")
+                print(f"virtual machines by {args.metric}: {telemetry.top(args.metric)}")
+                last_report = time.monotonic()
@@ -0,0 +1,213 @@
+import json
+import os
+from array import array
+from collections import namedtuple
+from struct import Struct
+
+import sflow
+
+# The sFlow Interface Table joins flow samples to the interface metadata carried separately in counter samples.
+
+# Counter samples describe their data source: sFlowIfCounters gives the ifIndex speed, sFlowPortName its name and
+# sFlowHostDescr the host name and UUID. The table is kept up to date from every counter sample seen and flow samples
+# are joined on (agent_address, ifIndex) for their input and output interfaces with a single dictionary lookup.
+
+# Storage is kept compact for millions of interfaces: agents, port names and hosts are interned, the key is one
+# integer (agent id << 32 | ifIndex) mapped to a slot and the slot values are held in parallel arrays.
+
+# The table can be saved to and loaded from disk, so a restarted collector joins flows from its first datagram.
+
+sFlowInterface = namedtuple("sFlowInterface", "agent_address if_index port_name speed host_name host_uuid")
+
+SNAPSHOT_MAGIC = b"sFlowIfT"
+SNAPSHOT_HEADER = Struct("<8sQQ")  # magic, string table length, slots
+
+
+class sFlowInterfaceTable:
+    """sFlowInterfaceTable class:
+
+    agents:  Interned agent addresses, an agent id is its position.
+    names:  Interned port names, a name id is its position + 1, 0 when unknown.
+    hosts:  Interned (host_name, uuid), a host id is its position + 1, 0 when unknown.
+    """
+
+    def __init__(self):
+        self.agents = []
+        self.agent_ids = {}
+        self.names = []
+        self.name_ids = {}
+        self.hosts = []
+        self.host_ids = {}
+        self.agent_hosts = array("I")  # Physical host of each agent, by agent id.
+        self.slots = {}
+        self.keys = array("Q")
+        self.speeds = array("Q")
+        self.port_names = array("I")
+        self.interface_hosts = array("I")
+        self.joined = 0
+        self.missed = 0
+
+    def __repr__(self):
+        return f"""
+            Interface Table:
+                Agents: {len(self.agents)}
+                Interfaces: {len(self.slots)}
+                Port Names: {len(self.names)}
+                Hosts: {len(self.hosts)}
+                Joined: {self.joined}
+                Missed: {self.missed}
+        """
+
+    def __len__(self):
+        return len(self.slots)
+
+    def agent_id(self, agent_address):
+        agent_id = self.agent_ids.get(agent_address)
+        if agent_id is None:
+            agent_id = self.agent_ids[agent_address] = len(self.agents)
+            self.agents.append(agent_address)
+            self.agent_hosts.append(0)
+        return agent_id
+
+    def slot(self, agent_id, if_index):
+        key = agent_id << 32 | if_index
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.speeds.append(0)
+            self.port_names.append(0)
+            self.interface_hosts.append(0)
+        return slot
+
+    def intern(self, table, ids, value):
+        value_id = ids.get(value)
+        if value_id is None:
+            table.append(value)
+            value_id = ids[value] = len(table)
+        return value_id
+
+    def update(self, sflow_data):
+        """Updates the table from the counter samples of a decoded datagram."""
+        agent_id = None
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (2, 4):
+                continue
+            if agent_id is None:
+                agent_id = self.agent_id(sflow_data.agent_address)
+            for record in sample.records:
+                record = record.record
+                record_type = type(record)
+                if record_type is sflow.sFlowIfCounters:
+                    self.speeds[self.slot(agent_id, record.index & 0xFFFFFFFF)] = max(record.speed, 0)
+                elif record_type is sflow.sFlowPortName:
+                    name_id = self.intern(self.names, self.name_ids, record.port_name)
+                    self.port_names[self.slot(agent_id, sample.source_index)] = name_id
+                elif record_type is sflow.sFlowHostDescr:
+                    host_id = self.intern(self.hosts, self.host_ids, (record.host_name, str(record.uuid)))
+                    if sample.source_type == 3:  # Virtual entity
+                        self.interface_hosts[self.slot(agent_id, sample.source_index)] = host_id
+                    else:
+                        self.agent_hosts[agent_id] = host_id
+
+    def lookup(self, agent_address, if_index):
+        """Returns the sFlowInterface for (agent_address, ifIndex), None when the interface has not been seen."""
+        agent_id = self.agent_ids.get(agent_address)
+        if agent_id is None:
+            return None
+        slot = self.slots.get(agent_id << 32 | if_index)
+        if slot is None:
+            host_id = self.agent_hosts[agent_id]
+            if not host_id:
+                return None
+            return sFlowInterface(agent_address, if_index, None, None, *self.hosts[host_id - 1])
+        name_id = self.port_names[slot]
+        host_id = self.interface_hosts[slot] or self.agent_hosts[agent_id]
+        host_name, host_uuid = self.hosts[host_id - 1] if host_id else (None, None)
+        return sFlowInterface(
+            agent_address, if_index, self.names[name_id - 1] if name_id else None, self.speeds[slot], host_name, host_uuid
+        )
+
+    def join(self, sflow_data):
+        """Sets input_interface and output_interface on each flow sample of a decoded datagram."""
+        agent_address = sflow_data.agent_address
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            sample.input_interface = self.lookup(agent_address, sample.input_if_value)
+            sample.output_interface = self.lookup(agent_address, sample.output_if_value)
+            if sample.input_interface is None:
+                self.missed += 1
+            else:
+                self.joined += 1
+        return sflow_data
+
+    def process(self, sflow_data):
+        self.update(sflow_data)
+        return self.join(sflow_data)
+
+    def save(self, path):
+        """Writes the table to path, replacing any previous snapshot only once complete."""
+        strings = json.dumps({"agents": self.agents, "names": self.names, "hosts": self.hosts}).encode("utf-8")
+        agent_hosts = array("I", self.agent_hosts)
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as snapshot:
+            snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(strings), len(self.keys)))
+            snapshot.write(strings)
+            agent_hosts.tofile(snapshot)
+            for column in (self.keys, self.speeds, self.port_names, self.interface_hosts):
+                column.tofile(snapshot)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        table = cls()
+        with open(path, "rb") as snapshot:
+            magic, strings_length, slots = SNAPSHOT_HEADER.unpack(snapshot.read(SNAPSHOT_HEADER.size))
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not an interface table snapshot")
+            strings = json.loads(snapshot.read(strings_length).decode("utf-8"))
+            table.agents = strings["agents"]
+            table.agent_ids = {agent: agent_id for agent_id, agent in enumerate(table.agents)}
+            table.names = strings["names"]
+            table.name_ids = {name: name_id for name_id, name in enumerate(table.names, 1)}
+            table.hosts = [tuple(host) for host in strings["hosts"]]
+            table.host_ids = {host: host_id for host_id, host in enumerate(table.hosts, 1)}
+            table.agent_hosts.fromfile(snapshot, len(table.agents))
+            for column in (table.keys, table.speeds, table.port_names, table.interface_hosts):
+                column.fromfile(snapshot, slots)
+        table.slots = dict(zip(table.keys, range(slots)))
+        return table
+
+    def checkpoint_arrays(self):
+        """The table as named arrays, for sflow_checkpoint."""
+        strings = json.dumps({"agents": self.agents, "names": self.names, "hosts": self.hosts}).encode("utf-8")
+        return {
+            "strings": strings,
+            "agent_hosts": self.agent_hosts,
+            "keys": self.keys,
+            "speeds": self.speeds,
+            "port_names": self.port_names,
+            "interface_hosts": self.interface_hosts,
+        }
+
+    def restore_arrays(self, arrays):
+        """Replaces the table with one from checkpoint_arrays."""
+        strings = json.loads(bytes(arrays["strings"]).decode("utf-8"))
+        self.agents = strings["agents"]
+        self.agent_ids = {agent: agent_id for agent_id, agent in enumerate(self.agents)}
+        self.names = strings["names"]
+        self.name_ids = {name: name_id for name_id, name in enumerate(self.names, 1)}
+        self.hosts = [tuple(host) for host in strings["hosts"]]
+        self.host_ids = {host: host_id for host_id, host in enumerate(self.hosts, 1)}
+        for name, typecode in (
+            ("agent_hosts", "I"),
+            ("keys", "Q"),
+            ("speeds", "Q"),
+            ("port_names", "I"),
+            ("interface_hosts", "I"),
+        ):
+            column = array(typecode)
+            column.frombytes(memoryview(arrays[name]).cast("B"))
+            setattr(self, name, column)
+        self.slots = dict(zip(self.keys, range(len(self.keys))))
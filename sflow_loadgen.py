@@ -0,0 +1,303 @@
+import argparse
+import random
+import socket
+import time
+from multiprocessing import Pipe, Process, Queue
+from struct import unpack, unpack_from
+
+import sflow
+import sflow_shed
+import sflow_synthetic
+
+# The sFlow Load Generator measures how many datagrams a second a collector can take before it starts losing them.
+
+# Sender processes blast datagrams over UDP at a collector process that receives and decodes them as
+# sflow_collector.py does, recvfrom(3000) then sflow.sFlow. The offered rate is raised in steps, and at each step
+# the collector reports what it parsed:
+#   sent            datagrams the senders sent, and the rate they achieved
+#   parsed          distinct (agent, sub agent, sequence number) the collector decoded in the step
+#   loss            sent - parsed, as a fraction of sent
+#   drops           receive buffer overflows counted by the kernel (/proc/net/udp)
+#   cpu             collector CPU time per datagram parsed
+# The maximum sustainable rate is the highest achieved rate whose loss is within --loss.
+
+# Each sender stamps its datagrams with its own sub agent and with sequence numbers whose top bits are the step, so
+# every datagram of a run is unique and late datagrams of an earlier step are not counted in the next one.
+
+# Datagrams are synthetic, built from a mix of samples, or replayed from a pcap capture. A mix is a comma separated
+# list of samples, each records joined by + and an optional count:
+#   header+switch:7,if:1        7 flow samples of a sampled header and extended switch, 1 counter sample
+# Flow records: header, ipv4, switch, gateway, mpls. Counter records: if, host_cpu, host_memory, virt_cpu.
+
+# Bursts
+#   constant    evenly spaced datagrams
+#   square      the rate doubled for half of each --period and nothing for the other half
+#   poisson     exponential gaps, as from many independent agents
+
+UDP_IP = "127.0.0.1"
+UDP_PORT = 6343
+
+MIX = "header+switch:7,if:1"
+RATES = "5000,10000,20000,40000,80000,160000"
+DURATION = 5  # seconds per step
+DRAIN = 1  # seconds waited after each step
+LOSS = 0.001
+SEQUENCE_BITS = 24  # sequence numbers per sender and step, the step is above them
+
+FLOW_RECORDS = {
+    "header": lambda i: sflow_synthetic.sampled_header(source_ip=f"10.{i >> 8 & 255}.{i & 255}.1"),
+    "ipv4": lambda i: sflow_synthetic.sampled_ipv4(),
+    "switch": lambda i: sflow_synthetic.extended_switch(1 + i % 4094, 1),
+    "gateway": lambda i: sflow_synthetic.extended_gateway(as_path=(64500, 64501 + i % 16), communities=(i,)),
+    "mpls": lambda i: sflow_synthetic.extended_mpls(in_labels=(16000 + i % 64,), out_labels=(17000,)),
+}
+COUNTER_RECORDS = {
+    "if": lambda i: sflow_synthetic.if_counters(index=1 + i % 48),
+    "host_cpu": lambda i: sflow_synthetic.host_cpu(),
+    "host_memory": lambda i: sflow_synthetic.host_memory(),
+    "virt_cpu": lambda i: sflow_synthetic.virt_cpu(),
+}
+
+
+def mix_datagram(mix, agent_address, seed=0):
+    """Encodes a datagram of the samples of a mix."""
+    samples = []
+    for entry in mix.split(","):
+        names, _, count = entry.partition(":")
+        names = names.split("+")
+        for i in range(int(count or 1)):
+            n = seed * 64 + i
+            if all(name in COUNTER_RECORDS for name in names):
+                records = [COUNTER_RECORDS[name](n) for name in names]
+                samples.append(sflow_synthetic.counter_sample(records, sequence=n, source_index=1 + n % 48))
+            elif all(name in FLOW_RECORDS for name in names):
+                records = [FLOW_RECORDS[name](n) for name in names]
+                samples.append(sflow_synthetic.flow_sample(records, sequence=n, input_if=1 + n % 48))
+            else:
+                raise ValueError(f"unknown or mixed flow and counter records in {entry}")
+    return sflow_synthetic.datagram(samples, agent_address=agent_address)
+
+
+def udp_payloads(path):
+    """Yields the sFlow v5 UDP payloads of a pcap file (Ethernet, raw IP or Linux cooked captures)."""
+    with open(path, "rb") as capture:
+        data = capture.read()
+    if data[:4] in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    elif data[:4] in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = ">"
+    else:
+        raise ValueError(f"{path} is not a pcap file")
+    linktype = unpack(endian + "I", data[20:24])[0] & 0xFFFF
+    position = 24
+    while position + 16 <= len(data):
+        captured = unpack_from(endian + "I", data, position + 8)[0]
+        packet = data[position + 16 : position + 16 + captured]
+        position += 16 + captured
+        if linktype == 1:
+            offset = 14 + sflow.ethernet_vlans(packet)[0]
+        elif linktype == 113:
+            offset = 16
+        elif linktype == 276:
+            offset = 20
+        elif linktype in (101, 228, 229, 12):
+            offset = 0
+        else:
+            raise ValueError(f"unsupported link type {linktype}")
+        if len(packet) < offset + 28:
+            continue
+        version = packet[offset] >> 4
+        if version == 4 and packet[offset + 9] == 17:
+            offset += (packet[offset] & 15) * 4 + 8
+        elif version == 6 and packet[offset + 6] == 17:
+            offset += 48
+        else:
+            continue
+        payload = packet[offset:]
+        if payload[:4] == b"\x00\x00\x00\x05":
+            yield payload
+
+
+def sender(index, templates, address, rate, duration, burst, period, step, seed, results):
+    """Sends the templates round robin at rate datagrams a second for duration seconds, reporting (index, sent, errors, cpu, seconds)."""
+    family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    datagrams = [bytearray(template) for template in templates]
+    generator = random.Random(seed * 1000 + index)
+    per_period = max(1, int(rate * period))
+    sent = errors = 0
+    cpu = time.process_time()
+    start = time.perf_counter()
+    due = 0.0
+    while due < duration:
+        wait = start + due - time.perf_counter()
+        if wait > 0.0005:
+            time.sleep(wait)
+        datagram = datagrams[sent % len(datagrams)]
+        sflow_synthetic.stamp(datagram, index, step << SEQUENCE_BITS | sent)
+        try:
+            sock.sendto(datagram, address)
+        except OSError:
+            errors += 1
+        sent += 1
+        if burst == "square":
+            due = sent // per_period * period + sent % per_period / (2 * rate)
+        elif burst == "poisson":
+            due += generator.expovariate(rate)
+        else:
+            due = sent / rate
+    results.put((index, sent, errors, time.process_time() - cpu, time.perf_counter() - start))
+
+
+def collector(ip, port, rcvbuf, connection):
+    """Receives and decodes datagrams like sflow_collector.py, counting those of the current step."""
+    sock = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_DGRAM)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((ip, port))
+    sock.settimeout(0.05)
+    connection.send(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+    step = -1
+    seen = set()
+    received = duplicates = stale = errors = 0
+    cpu = time.process_time()
+    drops = None
+    while True:
+        try:
+            data, addr = sock.recvfrom(3000)
+        except socket.timeout:
+            data = None
+        if data is not None:
+            try:
+                sflow_data = sflow.sFlow(data)
+            except Exception:
+                errors += 1
+                continue
+            received += 1
+            if sflow_data.sequence_number >> SEQUENCE_BITS != step:
+                stale += 1
+            else:
+                key = (sflow_data.agent_address, sflow_data.sub_agent, sflow_data.sequence_number)
+                if key in seen:
+                    duplicates += 1
+                else:
+                    seen.add(key)
+            if received % 1024:
+                continue
+        if not connection.poll():
+            continue
+        command, value = connection.recv()
+        if command == "step":
+            step = value
+            seen = set()
+            received = duplicates = stale = errors = 0
+            cpu = time.process_time()
+            queue = sflow_shed.socket_queue(sock)
+            drops = queue and queue[1]
+            connection.send(True)
+        elif command == "report":
+            queue = sflow_shed.socket_queue(sock)
+            step_drops = queue[1] - drops if queue and drops is not None else None
+            connection.send((len(seen), received, duplicates, stale, errors, time.process_time() - cpu, step_drops))
+        elif command == "stop":
+            return
+
+
+def run(args):
+    if args.replay:
+        payloads = list(udp_payloads(args.replay))
+        if not payloads:
+            raise SystemExit(f"no sFlow v5 datagrams in {args.replay}")
+        templates = [payloads[i :: args.processes] or payloads for i in range(args.processes)]
+    else:
+        templates = [
+            [mix_datagram(args.mix, f"10.{254 - i}.{a >> 8}.{a & 255}", a) for a in range(args.agents)]
+            for i in range(args.processes)
+        ]
+    print(f"{sum(map(len, templates))} datagrams of {sum(map(len, templates[0])) // len(templates[0])} bytes")
+
+    target = (args.ip, args.port)
+    connection = None
+    if args.target:
+        host, _, port = args.target.rpartition(":")
+        target = (host.strip("[]"), int(port))
+    else:
+        connection, child = Pipe()
+        process = Process(target=collector, args=(args.ip, args.port, args.rcvbuf, child), daemon=True)
+        process.start()
+        print(f"collector SO_RCVBUF {connection.recv()} bytes")
+
+    print(f"{'rate':>10} {'sent':>10} {'achieved':>10} {'parsed':>10} {'loss':>8} {'drops':>8} {'cpu/dgram':>10}")
+    sustainable = 0
+    for step, rate in enumerate(int(rate) for rate in args.rates.split(",")):
+        if connection is not None:
+            connection.send(("step", step))
+            connection.recv()
+        results = Queue()
+        senders = [
+            Process(
+                target=sender,
+                args=(
+                    i,
+                    templates[i],
+                    target,
+                    rate / args.processes,
+                    args.duration,
+                    args.burst,
+                    args.period,
+                    step,
+                    args.seed,
+                    results,
+                ),
+            )
+            for i in range(args.processes)
+        ]
+        for process in senders:
+            process.start()
+        reports = [results.get() for _ in senders]
+        for process in senders:
+            process.join()
+        sent = sum(report[1] for report in reports)
+        achieved = sent / max(args.duration, *(report[4] for report in reports))
+        if connection is None:
+            print(f"{rate:>10} {sent:>10} {achieved:>10.0f}")
+            continue
+        time.sleep(args.drain)
+        connection.send(("report", None))
+        parsed, received, duplicates, stale, errors, cpu, drops = connection.recv()
+        loss = (sent - parsed) / sent if sent else 0
+        cpu_per_datagram = f"{cpu / received * 1000000:.1f}us" if received else "-"
+        drops = "-" if drops is None else drops
+        print(f"{rate:>10} {sent:>10} {achieved:>10.0f} {parsed:>10} {loss:>8.2%} {drops:>8} {cpu_per_datagram:>10}")
+        if duplicates or stale or errors:
+            print(f"{'':>10} {duplicates} duplicates, {stale} from earlier steps, {errors} failed to decode")
+        if loss <= args.loss:
+            sustainable = max(sustainable, achieved)
+        elif args.stop:
+            break
+    if connection is not None:
+        connection.send(("stop", None))
+        print(f"maximum sustainable rate: {sustainable:.0f} datagrams/s with loss under {args.loss:.2%}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Multi-process sFlow load generator and collector capacity benchmark.")
+    parser.add_argument("--ip", default=UDP_IP, help="collector address")
+    parser.add_argument("--port", type=int, default=UDP_PORT, help="collector port")
+    parser.add_argument("--target", metavar="HOST:PORT", help="send to an external collector instead, without loss")
+    parser.add_argument("--processes", type=int, default=2, help="sender processes")
+    parser.add_argument("--agents", type=int, default=16, help="agents per sender process")
+    parser.add_argument("--mix", default=MIX, help="samples per synthetic datagram")
+    parser.add_argument("--replay", metavar="PCAP", help="replay the sFlow datagrams of a capture")
+    parser.add_argument("--rates", default=RATES, help="datagrams/s of each step")
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds per step")
+    parser.add_argument("--drain", type=float, default=DRAIN, help="seconds waited after each step")
+    parser.add_argument("--burst", choices=("constant", "square", "poisson"), default="constant")
+    parser.add_argument("--period", type=float, default=0.2, help="seconds per square burst cycle")
+    parser.add_argument("--loss", type=float, default=LOSS, help="loss allowed at a sustainable rate")
+    parser.add_argument("--rcvbuf", type=int, help="collector SO_RCVBUF bytes")
+    parser.add_argument("--stop", action="store_true", help="stop at the first step over --loss")
+    parser.add_argument("--seed", type=int, default=1)
+    run(parser.parse_args())
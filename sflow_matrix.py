@@ -0,0 +1,281 @@
+import argparse
+import socket
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+import sflow
+import sflow_synthetic
+
+# The sFlow Traffic Matrix accumulates the bytes and packets carried from each input to each output interface of every
+# agent, optionally split by VLAN, per time window.
+
+# Every flow sample adds frame_length * sample_rate bytes and sample_rate packets to the cell (input_if_value,
+# output_if_value, VLAN). Interfaces are mapped to dense slots per agent, and a cell is a single integer
+#   (input slot * MAX_SLOTS + output slot) * 4097 + VLAN + 1        (VLAN + 1 is 0 when VLANs are not kept)
+# written with its weights to the next entry of preallocated arrays. When the arrays fill up, equal cells are summed
+# in place with NumPy, so a window costs the memory of its distinct cells, not of its samples.
+
+# When a window ends every agent's cells are summed once more and published as an sFlowMatrixSnapshot: parallel arrays
+# of input_if, output_if, vlan, octets and packets. dense() turns a snapshot into in_if x out_if matrices.
+
+# Output interfaces that are not a single ifIndex
+#   DISCARDED       output_if_format 1, the packet was dropped
+#   MULTIPLE        output_if_format 2, the packet went to several interfaces
+# An agent keeps MAX_SLOTS interfaces; interfaces seen once its slots are taken are summed under OTHER and counted in
+# overflows, so a misbehaving agent costs a bounded matrix instead of an error.
+
+# VLAN: sFlowExtendedSwitch source_vlan, or the 802.1Q VLAN of sFlowRawPacketHeader, the inner (customer) VLAN of a
+# Q-in-Q header, -1 when unknown.
+
+WINDOW = 300  # seconds
+ENTRIES = 65536  # cells pending per agent before they are summed
+SNAPSHOTS = 288  # snapshots kept, one day of 5 minute windows
+MAX_SLOTS = 65536
+VLANS = 4097
+
+DISCARDED = -1
+MULTIPLE = -2
+OTHER = -3
+
+sFlowMatrixSnapshot = namedtuple(
+    "sFlowMatrixSnapshot", ("agent_address", "start", "end", "input_if", "output_if", "vlan", "octets", "packets")
+)
+
+
+def dense(snapshot):
+    """Returns (interfaces, octets, packets) of a snapshot: octets[i, j] from interfaces[i] to interfaces[j], all VLANs."""
+    interfaces, positions = np.unique(np.concatenate((snapshot.input_if, snapshot.output_if)), return_inverse=True)
+    rows, columns = np.split(positions, 2)
+    octets = np.zeros((len(interfaces), len(interfaces)))
+    packets = np.zeros((len(interfaces), len(interfaces)))
+    np.add.at(octets, (rows, columns), snapshot.octets)
+    np.add.at(packets, (rows, columns), snapshot.packets)
+    return interfaces, octets, packets
+
+
+class sFlowAgentMatrix:
+    """sFlowAgentMatrix class:
+
+    slots:  Interface: slot.
+    interfaces:  Interface of each slot.
+    count:  Entries pending.
+    overflows:  Interface lookups past MAX_SLOTS, summed under OTHER.
+    """
+
+    def __init__(self, entries=ENTRIES):
+        self.slots = {}
+        self.interfaces = []
+        self.cells = np.zeros(entries, dtype=np.int64)
+        self.octets = np.zeros(entries)
+        self.packets = np.zeros(entries)
+        self.count = 0
+        self.overflows = 0
+
+    def slot(self, interface):
+        slot = self.slots.get(interface)
+        if slot is None:
+            if len(self.interfaces) >= MAX_SLOTS - 1:  # The last slot is kept for OTHER.
+                self.overflows += 1
+                interface = OTHER
+                slot = self.slots.get(interface)
+                if slot is not None:
+                    return slot
+            slot = self.slots[interface] = len(self.interfaces)
+            self.interfaces.append(interface)
+        return slot
+
+    def add(self, cell, octets, packets):
+        count = self.count
+        if count == len(self.cells):
+            count = self.compact()
+        self.cells[count] = cell
+        self.octets[count] = octets
+        self.packets[count] = packets
+        self.count = count + 1
+
+    def compact(self):
+        """Sums equal cells, growing the arrays when they stay more than half full."""
+        cells, positions = np.unique(self.cells[: self.count], return_inverse=True)
+        octets = np.bincount(positions, self.octets[: self.count], len(cells))
+        packets = np.bincount(positions, self.packets[: self.count], len(cells))
+        count = len(cells)
+        if count > len(self.cells) // 2:
+            size = len(self.cells) * 2
+            self.cells = np.zeros(size, dtype=np.int64)
+            self.octets = np.zeros(size)
+            self.packets = np.zeros(size)
+        self.cells[:count] = cells
+        self.octets[:count] = octets
+        self.packets[:count] = packets
+        self.count = count
+        return count
+
+    def snapshot(self, agent_address, start, end):
+        count = self.compact() if self.count else 0
+        cells = self.cells[:count]
+        interfaces = np.array(self.interfaces, dtype=np.int64)
+        links, vlans = np.divmod(cells, VLANS)
+        inputs, outputs = np.divmod(links, MAX_SLOTS)
+        self.count = 0
+        return sFlowMatrixSnapshot(
+            agent_address,
+            start,
+            end,
+            interfaces[inputs],
+            interfaces[outputs],
+            vlans - 1,
+            self.octets[:count].copy(),
+            self.packets[:count].copy(),
+        )
+
+
+class sFlowTrafficMatrix:
+    """sFlowTrafficMatrix class:
+
+    window:  Seconds per snapshot.
+    vlans:  Split cells by VLAN.
+    agents:  sFlowAgentMatrix by agent_address.
+    snapshots:  The latest sFlowMatrixSnapshot of every agent and window, SNAPSHOTS windows deep.
+    """
+
+    def __init__(self, window=WINDOW, vlans=False, snapshots=SNAPSHOTS):
+        self.window = window
+        self.vlans = vlans
+        self.agents = {}
+        self.snapshots = deque(maxlen=snapshots)
+        self.callbacks = []
+        self.window_start = None
+        self.samples = 0
+
+    def __repr__(self):
+        return f"""
+            Traffic Matrix:
+                Agents: {len(self.agents)}
+                Interfaces: {sum(len(agent.interfaces) for agent in self.agents.values())}
+                Samples: {self.samples}
+                Overflows: {sum(agent.overflows for agent in self.agents.values())}
+                Windows: {len(self.snapshots)}
+        """
+
+    def on_snapshot(self, callback):
+        """Calls callback(list of sFlowMatrixSnapshot) when a window ends."""
+        self.callbacks.append(callback)
+
+    def add(self, sflow_data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self.window_start is None:
+            self.window_start = timestamp // self.window * self.window
+        elif timestamp >= self.window_start + self.window:
+            self.close(timestamp)
+        agent = self.agents.get(sflow_data.agent_address)
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            if agent is None:
+                agent = self.agents[sflow_data.agent_address] = sFlowAgentMatrix()
+            frame_length = 0
+            vlan = -1
+            for record in sample.records:
+                record = record.record
+                record_type = type(record)
+                if record_type is sflow.sFlowRawPacketHeader:
+                    frame_length = record.frame_length
+                    if vlan == -1 and record.header_protocol == 1:
+                        inner_vlan = sflow.ethernet_vlans(record.header)[2]
+                        if inner_vlan is not None:
+                            vlan = inner_vlan
+                elif record_type is sflow.sFlowExtendedSwitch:
+                    vlan = record.source_vlan
+                elif (record_type is sflow.sFlowSampledIpv4 or record_type is sflow.sFlowSampledIpv6) and not frame_length:
+                    frame_length = record.length
+            if sample.output_if_format == 1:
+                output_if = DISCARDED
+            elif sample.output_if_format == 2:
+                output_if = MULTIPLE
+            else:
+                output_if = sample.output_if_value
+            link = agent.slot(sample.input_if_value) * MAX_SLOTS + agent.slot(output_if)
+            cell = link * VLANS + (vlan + 1 if self.vlans and 0 <= vlan < VLANS - 1 else 0)
+            agent.add(cell, frame_length * sample.sample_rate, sample.sample_rate)
+            self.samples += 1
+
+    def close(self, now=None):
+        """Publishes the snapshots of the window and opens the window holding now."""
+        if self.window_start is None:
+            return []
+        start, end = self.window_start, self.window_start + self.window
+        snapshots = [agent.snapshot(agent_address, start, end) for agent_address, agent in self.agents.items()]
+        self.snapshots.append(snapshots)
+        self.window_start = (time.time() if now is None else now) // self.window * self.window
+        for callback in self.callbacks:
+            callback(snapshots)
+        return snapshots
+
+
+def print_snapshots(snapshots, n=10):
+    for snapshot in snapshots:
+        print(f"{snapshot.agent_address} {time.strftime('%H:%M:%S', time.gmtime(snapshot.start))}: {len(snapshot.octets)} cells")
+        for i in np.argsort(snapshot.octets)[::-1][:n].tolist():
+            vlan = f" vlan {snapshot.vlan[i]}" if snapshot.vlan[i] >= 0 else ""
+            print(
+                f"    {snapshot.input_if[i]:>6} -> {snapshot.output_if[i]:<6}{vlan} "
+                f"{snapshot.octets[i] * 8 / (snapshot.end - snapshot.start):.0f} bps"
+            )
+
+
+def benchmark(datagrams, vlans):
+    decoded = []
+    for i in range(256):
+        samples = [
+            sflow_synthetic.flow_sample(
+                [sflow_synthetic.sampled_header(vlan=(i + j) % 32), sflow_synthetic.extended_switch((i + j) % 32, 1)],
+                sequence=i * 8 + j,
+                input_if=(i * 8 + j) % 48,
+                output_if=(i * 3 + j) % 48,
+            )
+            for j in range(8)
+        ]
+        decoded.append(sflow.sFlow(sflow_synthetic.datagram(samples, agent_address=f"192.0.2.{i % 4}", sequence_number=i)))
+
+    matrix = sFlowTrafficMatrix(window=60, vlans=vlans)
+    start = time.perf_counter()
+    for i in range(datagrams):
+        matrix.add(decoded[i % len(decoded)], 1700000000 + i / 1000)
+    snapshots = matrix.close()
+    elapsed = time.perf_counter() - start
+    print(f"{matrix.samples} samples in {elapsed:.2f}s: {matrix.samples / elapsed:.0f} samples/s")
+    start = time.perf_counter()
+    for snapshot in snapshots:
+        dense(snapshot)
+    print(f"{sum(len(snapshot.octets) for snapshot in snapshots)} cells, dense in {time.perf_counter() - start:.4f}s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Interface to interface traffic matrices from sFlow flow samples.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--window", type=int, default=WINDOW, help="seconds")
+    parser.add_argument("--vlans", action="store_true", help="split cells by VLAN")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the cost per sample and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.vlans)
+    else:
+        matrix = sFlowTrafficMatrix(window=args.window, vlans=args.vlans)
+        matrix.on_snapshot(print_snapshots)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+            except socket.timeout:
+                if matrix.window_start is not None and time.time() >= matrix.window_start + matrix.window:
+                    matrix.close()
+                continue
+            matrix.add(sflow.sFlow(data))
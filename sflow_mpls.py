@@ -0,0 +1,173 @@
+import argparse
+import socket
+import time
+from collections import namedtuple
+
+import sflow
+import sflow_synthetic
+from sflow_window import SNAPSHOTS, sFlowKeyWindow, top
+
+# The sFlow Tunnel Accounting sums the traffic of flow samples per MPLS tunnel, VC, FEC, label and VLAN stack.
+
+# Each sample adds frame_length * sample_rate bytes and sample_rate packets, per agent_address, to
+#   tunnels         (tunnel name, tunnel_id)                sFlowExtendedMplsTunnel
+#   vcs             (VC instance name, vll_vc_id)           sFlowExtendedMplsVc
+#   ftns            (FTN description, mask)                 sFlowExtendedMpls_FTN
+#   labels          top label of the received stack         sFlowExtendedMpls
+#   label_stacks    (received labels, sent labels)          sFlowExtendedMpls
+#   vlan_stacks     VLANs outermost first                   sFlowExtendedVlantunnel, or the 802.1ad outer and inner
+#                                                           VLAN of sFlowRawPacketHeader
+# Labels are the 20-bit label of each stack entry, without traffic class, bottom of stack bit and TTL.
+
+# Windows are sflow_window.sFlowKeyWindow tables, as in sflow_asmatrix: label and VLAN stacks of keys entering a table
+# are interned, up to MAX_STACKS, and past MAX_KEYS keys in a table further keys of the window are summed under OTHER.
+
+WINDOW = 300  # seconds
+MAX_STACKS = 100000
+MAX_KEYS = 200000
+
+TABLES = ("tunnels", "vcs", "ftns", "labels", "label_stacks", "vlan_stacks")
+STACK_TABLES = ("label_stacks", "vlan_stacks")  # Tables whose keys hold stacks to intern.
+
+sFlowTunnelSnapshot = namedtuple("sFlowTunnelSnapshot", ("start", "end", "samples") + TABLES)
+
+
+class sFlowTunnelAccounting(sFlowKeyWindow):
+    """sFlowTunnelAccounting class:
+
+    window:  Seconds per snapshot.
+    interned:  Interned label and VLAN stacks, stack: stack.
+    tables:  Table name: {key: [octets, packets]} of the open window.
+    snapshots:  The latest sFlowTunnelSnapshot, SNAPSHOTS windows deep.
+    overflows:  Keys summed under OTHER.
+    """
+
+    def __init__(self, window=WINDOW, max_stacks=MAX_STACKS, max_keys=MAX_KEYS, snapshots=SNAPSHOTS):
+        super().__init__(window, TABLES, max_keys, max_stacks, snapshots)
+
+    def __repr__(self):
+        return f"""
+            Tunnel Accounting:
+                Samples: {self.samples}
+                Interned Stacks: {len(self.interned)}
+                Tunnels: {len(self.tables["tunnels"])}
+                VCs: {len(self.tables["vcs"])}
+                Overflows: {self.overflows}
+        """
+
+    def snapshot(self, start, end, samples, tables):
+        return sFlowTunnelSnapshot(start, end, samples, *(tables[name] for name in TABLES))
+
+    def add(self, sflow_data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.advance(timestamp)
+        agent = sflow_data.agent_address
+        tables = self.tables
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            frame_length = 0
+            keys = []
+            vlan_stack = None
+            for record in sample.records:
+                record = record.record
+                record_type = type(record)
+                if record_type is sflow.sFlowRawPacketHeader:
+                    frame_length = record.frame_length
+                    if vlan_stack is None and hasattr(record, "inner_vlan"):
+                        vlan_stack = (record.outer_vlan, record.inner_vlan)
+                elif record_type is sflow.sFlowExtendedMpls:
+                    if record.address_type not in (1, 2):
+                        continue
+                    in_labels = tuple(entry >> 12 & 0xFFFFF for entry in record.in_label_stack)
+                    out_labels = tuple(entry >> 12 & 0xFFFFF for entry in record.out_label_stack)
+                    if in_labels:
+                        keys.append(("labels", (agent, in_labels[0])))
+                    keys.append(("label_stacks", (agent, in_labels, out_labels)))
+                elif record_type is sflow.sFlowExtendedMplsTunnel:
+                    keys.append(("tunnels", (agent, record.host, record.tunnel_id)))
+                elif record_type is sflow.sFlowExtendedMplsVc:
+                    keys.append(("vcs", (agent, record.vc_instance_name, record.vll_vc_id)))
+                elif record_type is sflow.sFlowExtendedMpls_FTN:
+                    keys.append(("ftns", (agent, record.mpls_ftn_description, record.mpls_ftn_mask)))
+                elif record_type is sflow.sFlowExtendedVlantunnel:
+                    vlan_stack = tuple(tag & 0xFFF for tag in record.stack)
+                elif (record_type is sflow.sFlowSampledIpv4 or record_type is sflow.sFlowSampledIpv6) and not frame_length:
+                    frame_length = record.length
+            if vlan_stack:
+                keys.append(("vlan_stacks", (agent, vlan_stack)))
+            if not keys:
+                continue
+            packets = sample.sample_rate
+            octets = frame_length * packets
+            for table_name, key in keys:
+                self.count(tables[table_name], key, octets, packets, intern=table_name in STACK_TABLES)
+            self.samples += 1
+            self.window_samples += 1
+
+
+def print_snapshot(snapshot, n=10):
+    seconds = snapshot.end - snapshot.start
+    print(f"{time.strftime('%H:%M:%S', time.gmtime(snapshot.start))}: {snapshot.samples} samples")
+    for name in TABLES:
+        table = getattr(snapshot, name)
+        if not table:
+            continue
+        print(f"    {name}:")
+        for key, octets, packets in top(table, n):
+            print(f"        {key} {octets * 8 / seconds:.0f} bps {packets / seconds:.0f} pps")
+
+
+def benchmark(datagrams):
+    decoded = []
+    for i in range(256):
+        samples = [
+            sflow_synthetic.flow_sample(
+                [
+                    sflow_synthetic.sampled_header(vlan=j, outer_vlan=100 + i % 16),
+                    sflow_synthetic.extended_mpls(in_labels=(16000 + i % 64, 100 + j), out_labels=(17000 + i % 32,)),
+                    sflow_synthetic.extended_mpls_tunnel(f"lsp-{i % 32}", i % 32),
+                    sflow_synthetic.extended_mpls_vc(f"vc-{j}", j),
+                ],
+                sequence=i * 8 + j,
+            )
+            for j in range(8)
+        ]
+        decoded.append(sflow.sFlow(sflow_synthetic.datagram(samples, sequence_number=i)))
+
+    accounting = sFlowTunnelAccounting(window=60)
+    start = time.perf_counter()
+    for i in range(datagrams):
+        accounting.add(decoded[i % len(decoded)], 1700000000 + i / 1000)
+    accounting.close()
+    elapsed = time.perf_counter() - start
+    print(accounting)
+    print(f"{accounting.samples} samples in {elapsed:.2f}s: {accounting.samples / elapsed:.0f} samples/s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="MPLS tunnel, VC, label and VLAN stack traffic accounting from sFlow.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--window", type=int, default=WINDOW, help="seconds")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the cost per sample and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        accounting = sFlowTunnelAccounting(window=args.window)
+        accounting.on_snapshot(print_snapshot)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+            except socket.timeout:
+                if accounting.window_start is not None and time.time() >= accounting.window_start + accounting.window:
+                    accounting.close()
+                continue
+            accounting.add(sflow.sFlow(data))
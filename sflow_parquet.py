@@ -0,0 +1,218 @@
+import os
+import queue
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import sflow_rows
+
+# The sFlow Parquet Writer archives decoded flow and counter samples as compressed Parquet files.
+
+# The receive path turns the samples into rows and hands them to a bounded queue, never waiting: when the queue is
+# full the datagram is counted as dropped. Rows hold plain values only, so the datagram, its records and the buffer it
+# was decoded from may be reused as soon as write() returns, as sflow_ring and sflow.sFlowPool do. A background thread
+# buffers the rows per table and hour of their timestamp and writes a compressed row group when a buffer reaches its
+# row limit, its oldest row reaches the flush interval or its hour has ended. One file per table and hour:
+#   {directory}/{table}-YYYYMMDDHH.parquet
+# Every tick the files of hours that have ended are closed, whether or not their table got rows since, so each is
+# complete, footer included, within a tick of the hour. Rows arriving for an hour already closed go to a new file of
+# that hour.
+
+# Flow samples are written one row per sample to the flows table and counter records to a table per record type,
+# as flattened by sflow_rows.
+
+QUEUE_SIZE = 65536
+ROW_GROUP_ROWS = 131072
+FLUSH_INTERVAL = 60  # seconds
+COMPRESSION = "zstd"
+HOUR = 3600000  # ms
+
+CLOSE = object()
+
+# Arrow types of the sflow_rows fields, int64 unless listed.
+field_types = {
+    "time": pa.timestamp("ms", tz="UTC"),
+    "agent_address": pa.string(),
+    "source_mac": pa.string(),
+    "destination_mac": pa.string(),
+    "source_ip": pa.string(),
+    "destination_ip": pa.string(),
+}
+
+
+def table_schema(fields):
+    return pa.schema(
+        [
+            (field, field_types.get(field, pa.float64() if field in sflow_rows.counter_float_fields else pa.int64()))
+            for field in fields
+        ]
+    )
+
+
+class sFlowTableBuffer:
+    """sFlowTableBuffer class:
+
+    Rows buffered for one table, column by column per hour of their timestamp, and the Parquet file open per hour.
+
+    columns:  Hour: {field: values} of the buffered rows, hours counted since the epoch.
+    firstRowTime:  Hour: monotonic time the oldest buffered row of the hour was appended.
+    writers:  Hour: Parquet writer of the hour's open file.
+    rows:  Rows buffered, all hours.
+    """
+
+    def __init__(self, name, schema):
+        self.name = name
+        self.schema = schema
+        self.columns = {}
+        self.first_row_time = {}
+        self.writers = {}
+        self.rows = 0
+
+    def append(self, row):
+        hour = row["time"] // HOUR
+        columns = self.columns.get(hour)
+        if columns is None:
+            columns = self.columns[hour] = {field: [] for field in self.schema.names}
+            self.first_row_time[hour] = time.monotonic()
+        for field, column in columns.items():
+            column.append(row[field])
+        self.rows += 1
+
+    def buffered(self, hour):
+        return len(self.columns[hour]["time"])
+
+    def flush(self, directory, compression, hour):
+        columns = self.columns.pop(hour, None)  # Rows are let go even if the write fails.
+        if columns is None:
+            return 0
+        del self.first_row_time[hour]
+        rows = len(columns["time"])
+        self.rows -= rows
+        writer = self.writers.get(hour)
+        if writer is None:
+            name = time.strftime("%Y%m%d%H", time.gmtime(hour * HOUR // 1000))
+            path = os.path.join(directory, f"{self.name}-{name}.parquet")
+            if os.path.exists(path):  # A restart, or late rows, within the hour, never overwrite what was archived.
+                path = os.path.join(directory, f"{self.name}-{name}-{int(time.time())}.parquet")
+            writer = self.writers[hour] = pq.ParquetWriter(path, self.schema, compression=compression)
+        writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=self.schema))
+        return rows
+
+    def close(self, hour=None):
+        """Closes the file of hour, or every open file."""
+        for hour in list(self.writers) if hour is None else [hour]:
+            writer = self.writers.pop(hour, None)
+            if writer is not None:
+                writer.close()
+
+
+class sFlowParquetWriter:
+    """sFlowParquetWriter class:
+
+    directory:  Where the Parquet files are written.
+    rowGroupRows:  Rows buffered per table before a row group is written.
+    flushInterval:  Seconds a buffered row may wait before its row group is written.
+    queued:  Datagrams whose rows were handed to the writer.
+    dropped:  Datagrams dropped because the writer fell behind.
+    written:  Rows written.
+    """
+
+    def __init__(
+        self,
+        directory,
+        row_group_rows=ROW_GROUP_ROWS,
+        flush_interval=FLUSH_INTERVAL,
+        compression=COMPRESSION,
+        queue_size=QUEUE_SIZE,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.row_group_rows = row_group_rows
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.queue = queue.Queue(queue_size)
+        self.tables = {"flows": sFlowTableBuffer("flows", table_schema(sflow_rows.flow_fields))}
+        for record_type, table_name in sflow_rows.counter_table_names.items():
+            fields = sflow_rows.sample_fields + sflow_rows.counter_fields[record_type]
+            self.tables[table_name] = sFlowTableBuffer(table_name, table_schema(fields))
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self.last_error = None
+        self.thread = threading.Thread(target=self.run, name="sflow-parquet", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f"""
+            Parquet Writer:
+                Directory: {self.directory}
+                Queued: {self.queued}
+                Dropped: {self.dropped}
+                Written: {self.written}
+                Errors: {self.errors}
+        """
+
+    def write(self, sflow_data, timestamp=None):
+        """Hands the rows of a decoded datagram to the writer thread, never blocking. Returns False if they had to be
+        dropped. The datagram is not kept and may be reused once this returns."""
+        timestamp = int((time.time() if timestamp is None else timestamp) * 1000)
+        try:
+            self.queue.put_nowait(list(sflow_rows.iter_rows(sflow_data, timestamp)))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        return True
+
+    def add(self, rows):
+        tables = self.tables
+        for table_name, row in rows:
+            tables[table_name].append(row)
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        current_hour = int(time.time() * 1000) // HOUR
+        for table in self.tables.values():
+            for hour in list(table.columns):
+                if (
+                    force
+                    or hour < current_hour
+                    or table.buffered(hour) >= self.row_group_rows
+                    or now - table.first_row_time[hour] >= self.flush_interval
+                ):
+                    try:
+                        self.written += table.flush(self.directory, self.compression, hour)
+                    except (OSError, pa.ArrowException) as error:
+                        self.errors += 1
+                        self.last_error = error
+                        self.close_file(table, hour)
+            for hour in list(table.writers):
+                if force or hour < current_hour:
+                    self.close_file(table, hour)
+
+    def close_file(self, table, hour):
+        try:
+            table.close(hour)
+        except (OSError, pa.ArrowException) as error:
+            self.errors += 1
+            self.last_error = error
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                if item is CLOSE:
+                    break
+                self.add(item)
+            self.flush()
+        self.flush(force=True)
+
+    def close(self):
+        self.queue.put(CLOSE)
+        self.thread.join()
@@ -0,0 +1,218 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import sflow
+import sflow_synthetic
+
+# The sFlow Profiler shows where a live collector spends its CPU, without restarting it.
+
+# Sending the collector SIGUSR1 starts a sampling profiler: every INTERVAL of CPU time (ITIMER_PROF, SIGPROF) the stack
+# of every thread is recorded, and sflow.record_profile is set so each record decoded also accounts its calls,
+# nanoseconds and bytes per (sample_type, enterprise, format). After DURATION seconds, or on the next SIGUSR1, the
+# profiler stops and writes into its directory
+#   sflow-<pid>-<time>.folded      collapsed stacks, "frame;frame;frame count" per line, for flamegraph.pl or speedscope
+#   sflow-<pid>-<time>.records     decode cost per record format, most expensive first
+# While no profile runs the collector pays nothing but the single record_profile test per record in sflow.py.
+
+# The SIGPROF handler only records stacks, and no handler writes files. When the duration is up a timer thread disarms
+# the itimer and writes the profile, so an idle collector, which takes no samples, is stopped too. A profile stopped by
+# SIGUSR1 is written by a thread of its own. The SIGPROF handler stays installed, idle, until the next profile starts
+# or stop() is called on the main thread.
+
+# Signal handlers run on the main thread between bytecodes, so the collector's main loop must not block signals; the
+# live CLI below uses a socket timeout.
+
+INTERVAL = 0.005  # seconds of CPU time between stack samples
+DURATION = 30  # seconds
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse(frame):
+    """The stack of a frame, outermost first, as flamegraph frames joined by ;."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class sFlowSamplingProfiler:
+    """sFlowSamplingProfiler class:
+
+    interval:  Seconds of CPU time between samples.
+    stacks:  Collapsed stack: samples.
+    records:  sflow.sFlowRecordProfile of the last profile.
+    running:  A profile is being taken.
+    """
+
+    def __init__(self, interval=INTERVAL, directory="."):
+        self.interval = interval
+        self.directory = directory
+        self.stacks = {}
+        self.records = None
+        self.running = False
+        self.timer = None
+        self.previous_handler = None
+        self.previous_profile = None
+        self.samples = 0
+
+    def __repr__(self):
+        return f"""
+            Sampling Profiler:
+                Running: {self.running}
+                Samples: {self.samples}
+                Stacks: {len(self.stacks)}
+        """
+
+    def start(self, duration=None):
+        if self.running:
+            return
+        self.stacks = {}
+        self.samples = 0
+        self.records = sflow.sFlowRecordProfile()
+        self.previous_profile = sflow.record_profile
+        sflow.record_profile = self.records
+        handler = signal.signal(signal.SIGPROF, self.sample)
+        if handler != self.sample:  # Still installed after a profile that expired.
+            self.previous_handler = handler
+        self.running = True
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        if duration:
+            self.timer = threading.Timer(duration, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def disarm(self):
+        """Stops sampling and record accounting, from any thread."""
+        if not self.running:
+            return False
+        self.running = False
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        sflow.record_profile = self.previous_profile
+        return True
+
+    def stop(self):
+        """Stops the profile and restores the previous SIGPROF handler, on the main thread."""
+        self.disarm()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGPROF, self.previous_handler)
+            self.previous_handler = None
+
+    def expire(self):
+        """Stops the profile at the end of its duration and writes it, on the timer thread."""
+        if self.disarm():
+            self.dump()
+
+    def sample(self, signum, frame):
+        if not self.running:
+            return
+        stacks = self.stacks
+        main = threading.main_thread().ident
+        threads = sys._current_frames()
+        threads[main] = frame
+        if self.timer is not None:
+            threads.pop(self.timer.ident, None)
+        for thread_frame in threads.values():
+            stack = collapse(thread_frame)
+            stacks[stack] = stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def dump(self, prefix=None):
+        """Writes the collapsed stacks and the record profile, returning the path of the stacks."""
+        return self.write(prefix, dict(self.stacks), self.records)  # A copy, the handler may still be sampling.
+
+    def write(self, prefix, stacks, record_profile):
+        if prefix is None:
+            prefix = os.path.join(self.directory, f"sflow-{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}")
+        with open(f"{prefix}.folded", "w") as folded:
+            for stack, count in sorted(stacks.items()):
+                folded.write(f"{stack} {count}\n")
+        if record_profile is not None:
+            with open(f"{prefix}.records", "w") as records:
+                for name, calls, nanoseconds, size, share in record_profile.report():
+                    records.write(f"{name}\t{calls}\t{nanoseconds}\t{size}\t{share:.4f}\n")
+        return f"{prefix}.folded"
+
+    def toggle(self, duration=DURATION):
+        """Starts a profile of duration seconds, or stops the one running and writes it from another thread."""
+        if self.running:
+            self.stop()
+            threading.Thread(target=self.write, args=(None, self.stacks, self.records)).start()
+        else:
+            self.start(duration)
+
+    def install(self, signum=signal.SIGUSR1, duration=DURATION):
+        """Toggles a profile on signum."""
+        signal.signal(signum, lambda received, frame: self.toggle(duration))
+
+
+def benchmark(datagrams):
+    samples = [
+        sflow_synthetic.flow_sample(
+            [
+                sflow_synthetic.sampled_header(),
+                sflow_synthetic.extended_switch(),
+                sflow_synthetic.extended_gateway(as_path=(64500, 64501, 64502), communities=(1, 2)),
+            ]
+        ),
+        sflow_synthetic.counter_sample([sflow_synthetic.if_counters(), sflow_synthetic.host_cpu()]),
+    ]
+    data = sflow_synthetic.datagram(samples * 2)
+
+    start = time.perf_counter()
+    for i in range(datagrams):
+        sflow.sFlow(data)
+    off = time.perf_counter() - start
+    print(f"profile off: {off / datagrams * 1000000:.2f} us/datagram")
+
+    profiler = sFlowSamplingProfiler(interval=0.001)
+    profiler.start()
+    start = time.perf_counter()
+    for i in range(datagrams):
+        sflow.sFlow(data)
+    on = time.perf_counter() - start
+    profiler.stop()
+    print(f"profile on: {on / datagrams * 1000000:.2f} us/datagram ({on / off - 1:+.0%})")
+    print(profiler)
+    print(profiler.records)
+    for stack, count in sorted(profiler.stacks.items(), key=lambda item: -item[1])[:5]:
+        print(f"    {count} {stack[-120:]}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="sFlow collector with a SIGUSR1 triggered sampling profiler.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--directory", default=".", help="where profiles are written")
+    parser.add_argument("--duration", type=int, default=DURATION, help="seconds per profile")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the profiling overhead and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        profiler = sFlowSamplingProfiler(directory=args.directory)
+        profiler.install(duration=args.duration)
+        print(f"kill -USR1 {os.getpid()} to profile for {args.duration}s")
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+            except socket.timeout:
+                continue
+            sflow.sFlow(data)
@@ -0,0 +1,223 @@
+import argparse
+import select
+import socket
+import time
+from struct import error as StructError
+
+import sflow
+
+# The sFlow Replicator receives each datagram once and re-sends it, unchanged, to several collectors.
+
+# Datagrams are received into a fixed set of preallocated buffers and every destination is sent a memoryview
+# of the same buffer, so a datagram is never copied. Datagrams are drained from the socket in batches and each
+# batch is then sent to every destination in turn.
+
+# Destinations may filter on the agent address or the sample types of a datagram. Filters are evaluated
+# against sflow.sFlowHeader, which reads the datagram header and the sample headers but decodes no records.
+# Expanded samples match as the single ones: 1 and 3 are flow samples, 2 and 4 counter samples.
+
+# Every interval the datagrams per second sent to each destination are printed, with its send errors.
+
+UDP_IP = "127.0.0.1"
+UDP_PORT = 6343
+
+BUFFER_SIZE = 3000  # 1386 bytes is the largest possible sFlow packet, by spec 3000 seems to be the number by practice
+BATCH_SIZE = 64
+INTERVAL = 60  # seconds between reports
+
+
+def single_sample_type(sample_type):
+    """Flow (1) for expanded flow samples (3), counters (2) for expanded counter samples (4)."""
+    return sample_type - 2 if sample_type in (3, 4) else sample_type
+
+
+class sFlowDestination:
+    """sFlowDestination class:
+
+    address:  (host, port) the datagrams are re-sent to.
+    agents:  Agent addresses to forward, every agent when None.
+    sampleTypes:  Sample types to forward, a datagram is forwarded if it holds any of them. Every datagram when None.
+                  Expanded types are kept as single ones, 3 as 1 and 4 as 2.
+    datagrams:  Datagrams sent.
+    bytes:  Bytes sent.
+    filtered:  Datagrams not sent because of a filter.
+    errors:  Datagrams that failed to send.
+    """
+
+    def __init__(self, address, agents=None, sample_types=None):
+        self.address = address
+        self.agents = set(agents) if agents else None
+        self.sample_types = set(map(single_sample_type, sample_types)) if sample_types else None
+        self.family, self.sockaddr = self.resolve(address)
+        self.datagrams = 0
+        self.bytes = 0
+        self.filtered = 0
+        self.errors = 0
+        self.last_error = None
+        self.rate_time = time.monotonic()
+        self.rate_datagrams = 0
+        self.reported_errors = 0
+
+    def __repr__(self):
+        return f"""
+            Destination:
+                Address: {self.address[0]}:{self.address[1]}
+                Datagrams: {self.datagrams}
+                Bytes: {self.bytes}
+                Filtered: {self.filtered}
+                Errors: {self.errors}
+                Last Error: {self.last_error}
+        """
+
+    @staticmethod
+    def resolve(address):
+        family, _, _, _, sockaddr = socket.getaddrinfo(address[0], address[1], type=socket.SOCK_DGRAM)[0]
+        return family, sockaddr
+
+    @property
+    def filtering(self):
+        return self.agents is not None or self.sample_types is not None
+
+    def accepts(self, header, sample_types=None):
+        """sample_types are those of the datagram, read once by the replicator when any destination filters on them."""
+        if header is None:  # The datagram could not be decoded, only unfiltered destinations receive it.
+            return not self.filtering
+        if self.agents is not None and header.agent_address not in self.agents:
+            return False
+        if self.sample_types is not None and self.sample_types.isdisjoint(sample_types):
+            return False
+        return True
+
+    def rate(self):
+        """Returns the datagrams per second sent since the previous call."""
+        now = time.monotonic()
+        elapsed = now - self.rate_time
+        rate = (self.datagrams - self.rate_datagrams) / elapsed if elapsed > 0 else 0.0
+        self.rate_time = now
+        self.rate_datagrams = self.datagrams
+        return rate
+
+
+class sFlowReplicator:
+    """sFlowReplicator class:
+
+    sock:  Bound UDP socket the datagrams are received on.
+    destinations:  A list of sFlowDestination.
+    received:  Datagrams received.
+    malformed:  Datagrams whose header or sample headers could not be decoded.
+    """
+
+    def __init__(self, sock, destinations, batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.destinations = destinations
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.lengths = [0] * batch_size
+        self.sockets = {}
+        for destination in destinations:
+            if destination.family not in self.sockets:
+                self.sockets[destination.family] = socket.socket(destination.family, socket.SOCK_DGRAM)
+        self.filtering = any(destination.filtering for destination in destinations)
+        self.sample_filtering = any(destination.sample_types is not None for destination in destinations)
+        self.received = 0
+        self.malformed = 0
+
+    def receive(self):
+        """Blocks for one datagram, then drains up to a full batch without blocking. Returns the batch size."""
+        self.lengths[0] = self.sock.recv_into(self.buffers[0])
+        count = 1
+        while count < len(self.buffers):
+            try:
+                self.lengths[count] = self.sock.recv_into(self.buffers[count], 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            count += 1
+        self.received += count
+        return count
+
+    def forward(self, count):
+        batch = [self.views[i][: self.lengths[i]] for i in range(count)]
+        headers = [self.header(datagram) for datagram in batch] if self.filtering else None
+
+        for destination in self.destinations:
+            sendto = self.sockets[destination.family].sendto
+            sockaddr = destination.sockaddr
+            for i, datagram in enumerate(batch):
+                if headers is not None and not destination.accepts(*headers[i]):
+                    destination.filtered += 1
+                    continue
+                try:
+                    sendto(datagram, sockaddr)
+                except OSError as error:
+                    destination.errors += 1
+                    destination.last_error = error
+                    continue
+                destination.datagrams += 1
+                destination.bytes += len(datagram)
+
+    def header(self, datagram):
+        """(sFlowHeader, sample types or None), (None, None) when the datagram cannot be decoded."""
+        try:
+            header = sflow.sFlowHeader(datagram)
+            if not self.sample_filtering:
+                return header, None
+            return header, {single_sample_type(sample_type) for sample_type in header.sample_types()}
+        except (StructError, ValueError):
+            self.malformed += 1
+            return None, None
+
+    def run(self, interval=INTERVAL):
+        report = time.monotonic() + interval if interval else None
+        while True:
+            if report is None or select.select([self.sock], [], [], 1)[0]:  # The socket stays blocking for the batch.
+                self.forward(self.receive())
+            if report is not None and time.monotonic() >= report:
+                self.report()
+                report = time.monotonic() + interval
+
+    def report(self):
+        """Prints the rate and errors of every destination since the previous report."""
+        print(f"{self.received} received, {self.malformed} malformed", flush=True)
+        for destination in self.destinations:
+            errors = destination.errors - destination.reported_errors
+            destination.reported_errors = destination.errors
+            last_error = f", last: {destination.last_error}" if errors else ""
+            print(
+                f"    {destination.address[0]}:{destination.address[1]} {destination.rate():.0f} datagrams/s, "
+                f"{errors} errors{last_error}, {destination.filtered} filtered",
+                flush=True,
+            )
+
+
+def parse_destination(value):
+    # host:port[,agent=a.b.c.d][,sample_type=n] - options may be repeated.
+    fields = value.split(",")
+    host, _, port = fields[0].rpartition(":")
+    agents = []
+    sample_types = []
+    for field in fields[1:]:
+        key, _, option = field.partition("=")
+        if key == "agent":
+            agents.append(option)
+        elif key == "sample_type":
+            sample_types.append(int(option))
+        else:
+            raise argparse.ArgumentTypeError(f"unknown destination option: {key}")
+    return sFlowDestination((host.strip("[]"), int(port)), agents, sample_types)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Re-send each received sFlow datagram to several collectors.")
+    parser.add_argument("destinations", nargs="+", type=parse_destination, help="host:port[,agent=ip][,sample_type=n]")
+    parser.add_argument("--ip", default=UDP_IP)
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument("--interval", type=int, default=INTERVAL, help="seconds between reports, 0 for none")
+    args = parser.parse_args()
+
+    family = socket.AF_INET6 if ":" in args.ip else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.bind((args.ip, args.port))
+
+    sFlowReplicator(sock, args.destinations, batch_size=args.batch).run(args.interval)
@@ -0,0 +1,263 @@
+import argparse
+import socket
+import time
+from multiprocessing import Process, shared_memory
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+from struct import Struct
+from struct import error as StructError
+
+import sflow
+
+# The sFlow Ring passes raw datagrams from one receiving process to several parsing processes through shared memory.
+
+# The ring is a fixed number of slots, each large enough for the largest datagram. The receiver writes each datagram
+# straight from the socket into the next slot, along with its receive time and source address. Parser workers decode
+# the datagram in place by handing sflow.sFlow a memoryview of the slot, so nothing is pickled or copied.
+
+# Every datagram is parsed by exactly one worker: worker k of n takes the datagrams whose ring sequence is k modulo n,
+# so the workers need no lock between them. The receiver never waits for the workers. When a worker falls more than a
+# ring behind, the datagrams it lost are counted as overruns and it skips ahead to the oldest datagram still held.
+
+# Shared memory layout
+#   control     magic, slots, slot size, consumers, write cursor, then a read cursor and overrun count per consumer
+#   slots       slot header followed by the datagram
+
+# Slot header
+#   stamp       ring sequence + 1 of the datagram held, 0 while the slot is being written
+#   timestamp   receive time, seconds since the epoch
+#   length      datagram length
+#   port        source port
+#   family      source address family, 4 or 6
+#   address     source address, packed
+
+UDP_IP = "127.0.0.1"
+UDP_PORT = 6343
+
+BUFFER_SIZE = 3000  # 1386 bytes is the largest possible sFlow packet, by spec 3000 seems to be the number by practice
+
+RING_MAGIC = 0x73466C6F7752696E  # "sFlowRin"
+CONTROL_FIELDS = 5  # magic, slots, slot_size, consumers, write_cursor
+SLOT_HEADER = Struct("<QdIHB16s")
+SLOT_HEADER_SIZE = 48
+
+
+class sFlowRing:
+    """sFlowRing class:
+
+    slots:  Number of datagrams the ring holds.
+    slotSize:  Largest datagram a slot holds.
+    consumers:  Number of parser workers reading the ring.
+    name:  Shared memory name, passed to workers to attach to the ring.
+    """
+
+    def __init__(self, slots=4096, consumers=1, slot_size=BUFFER_SIZE, name=None):
+        self.owner = name is None
+        if self.owner:
+            control_size = (CONTROL_FIELDS + 2 * consumers) * 8
+            self.stride = SLOT_HEADER_SIZE + slot_size + (-(SLOT_HEADER_SIZE + slot_size) % 64)
+            self.shm = shared_memory.SharedMemory(create=True, size=control_size + slots * self.stride)
+            self.control = self.shm.buf[:control_size].cast("Q")
+            self.control[1] = slots
+            self.control[2] = slot_size
+            self.control[3] = consumers
+            for i in range(CONTROL_FIELDS, len(self.control)):
+                self.control[i] = 0
+            self.control[0] = RING_MAGIC
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            geometry = self.shm.buf[: CONTROL_FIELDS * 8].cast("Q")
+            magic, slots, slot_size, consumers = geometry[0:4]
+            geometry.release()
+            if magic != RING_MAGIC:
+                self.shm.close()
+                raise ValueError(f"{name} is not an sFlow ring")
+            control_size = (CONTROL_FIELDS + 2 * consumers) * 8
+            self.stride = SLOT_HEADER_SIZE + slot_size + (-(SLOT_HEADER_SIZE + slot_size) % 64)
+            self.control = self.shm.buf[:control_size].cast("Q")
+        self.name = self.shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.consumers = consumers
+        self.base = control_size
+        self.buf = self.shm.buf
+
+    def __repr__(self):
+        return f"""
+            sFlow Ring:
+                Name: {self.name}
+                Slots: {self.slots}
+                Written: {self.write_cursor}
+                Occupancy: {self.occupancy()}
+                Overruns: {self.overruns()}
+        """
+
+    @property
+    def write_cursor(self):
+        return self.control[4]
+
+    def read_cursor(self, consumer):
+        return self.control[CONTROL_FIELDS + 2 * consumer]
+
+    def overruns(self, consumer=None):
+        if consumer is None:
+            return sum(self.control[CONTROL_FIELDS + 2 * i + 1] for i in range(self.consumers))
+        return self.control[CONTROL_FIELDS + 2 * consumer + 1]
+
+    def occupancy(self):
+        """Returns the number of datagrams written but not yet read by the slowest worker."""
+        write_cursor = self.write_cursor
+        pending = max(max(write_cursor - self.read_cursor(i), 0) for i in range(self.consumers))
+        return min(pending, self.slots)
+
+    def slot_offset(self, sequence):
+        return self.base + (sequence % self.slots) * self.stride
+
+    def close(self):
+        self.control.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class sFlowRingWriter:
+    """sFlowRingWriter class:
+
+    The single producer, receives datagrams from a socket straight into the ring.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.views = [
+            ring.buf[ring.slot_offset(i) + SLOT_HEADER_SIZE : ring.slot_offset(i) + SLOT_HEADER_SIZE + ring.slot_size]
+            for i in range(ring.slots)
+        ]
+        self.high_water = 0
+
+    def receive(self, sock):
+        ring = self.ring
+        sequence = ring.control[4]
+        offset = ring.slot_offset(sequence)
+        SLOT_HEADER.pack_into(ring.buf, offset, 0, 0.0, 0, 0, 0, b"")  # Readers must not trust the slot while it is written.
+        length, address = sock.recvfrom_into(self.views[sequence % ring.slots])
+        if sock.family == AF_INET6:
+            family, packed = 6, inet_pton(AF_INET6, address[0])
+        else:
+            family, packed = 4, inet_pton(AF_INET, address[0])
+        SLOT_HEADER.pack_into(ring.buf, offset, sequence + 1, time.time(), length, address[1], family, packed)
+        ring.control[4] = sequence + 1
+        if sequence & 1023 == 0:
+            self.high_water = max(self.high_water, ring.occupancy())
+
+    def run(self, sock):
+        while True:
+            self.receive(sock)
+
+    def close(self):
+        for view in self.views:
+            view.release()
+
+
+class sFlowRingReader:
+    """sFlowRingReader class:
+
+    One of the parser workers, takes every consumers-th datagram from the ring.
+
+    The sFlow objects yielded are decoded in place and hold memoryviews into the ring. They are only valid until the
+    next datagram is requested, anything kept longer must be copied out.
+    """
+
+    def __init__(self, ring, consumer, idle=0.0005):
+        self.ring = ring
+        self.consumer = consumer
+        self.idle = idle
+        self.cursor_index = CONTROL_FIELDS + 2 * consumer
+        self.cursor = consumer
+        self.ring.control[self.cursor_index] = self.cursor
+        self.malformed = 0
+
+    def overrun(self, lost):
+        self.ring.control[self.cursor_index + 1] += lost
+
+    def next_sequence(self):
+        ring = self.ring
+        while True:
+            write_cursor = ring.control[4]
+            if self.cursor < write_cursor:
+                break
+            time.sleep(self.idle)
+        oldest = write_cursor - ring.slots
+        if self.cursor < oldest:
+            skip_to = oldest + (self.consumer - oldest) % ring.consumers
+            self.overrun((skip_to - self.cursor) // ring.consumers)
+            self.cursor = skip_to
+        return self.cursor
+
+    def __iter__(self):
+        ring = self.ring
+        consumers = ring.consumers
+        while True:
+            sequence = self.next_sequence()
+            offset = ring.slot_offset(sequence)
+            stamp, timestamp, length, port, family, packed = SLOT_HEADER.unpack_from(ring.buf, offset)
+            if stamp == sequence + 1:
+                if family == 6:
+                    address = (inet_ntop(AF_INET6, packed), port)
+                else:
+                    address = (inet_ntop(AF_INET, packed[:4]), port)
+                data = ring.buf[offset + SLOT_HEADER_SIZE : offset + SLOT_HEADER_SIZE + length]
+                try:
+                    try:
+                        sflow_data = sflow.sFlow(data)
+                    except (StructError, ValueError, IndexError):
+                        sflow_data = None
+                    if SLOT_HEADER.unpack_from(ring.buf, offset)[0] != stamp:  # Overwritten while it was decoded.
+                        sflow_data = None
+                        self.overrun(1)
+                    elif sflow_data is None:
+                        self.malformed += 1
+                    self.cursor = sequence + consumers
+                    ring.control[self.cursor_index] = self.cursor
+                    if sflow_data is not None:
+                        yield timestamp, address, sflow_data
+                finally:
+                    sflow_data = None
+                    data.release()  # Also when the consumer stops iterating, so that the ring can be closed.
+            else:
+                self.overrun(1)
+                self.cursor = sequence + consumers
+                ring.control[self.cursor_index] = self.cursor
+
+
+def worker(name, consumer):
+    ring = sFlowRing(name=name)
+    for _, address, sflow_data in sFlowRingReader(ring, consumer):
+        print(f"{consumer} {address[0]} {sflow_data.agent_address} {sflow_data.sequence_number} {sflow_data.number_sample}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Receive sFlow into a shared memory ring parsed by several workers.")
+    parser.add_argument("--ip", default=UDP_IP)
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    parser.add_argument("--slots", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    family = AF_INET6 if ":" in args.ip else AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.bind((args.ip, args.port))
+
+    ring = sFlowRing(slots=args.slots, consumers=args.workers)
+    workers = [Process(target=worker, args=(ring.name, i), daemon=True) for i in range(args.workers)]
+    for process in workers:
+        process.start()
+
+    writer = sFlowRingWriter(ring)
+    try:
+        writer.run(sock)
+    finally:
+        for process in workers:
+            process.terminate()
+        writer.close()
+        ring.close()
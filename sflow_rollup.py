@@ -0,0 +1,333 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+import sflow
+
+# The sFlow Rollup keeps 1 minute, 5 minute and 1 hour rollups of every interface's counters in fixed size rings.
+
+# Interface counters arrive every polling interval in sFlowIfCounters and sFlowEthernetInterface records. The deltas
+# between consecutive polls of an interface, allowing for 32-bit counter wraps, give one rate sample per metric.
+# Rate samples fill the open 1 minute bucket. When a bucket closes its mean, min, max and 95th percentile are written
+# to the ring and passed on, with the rate samples it kept, to the open bucket of the next coarser level. A coarser
+# bucket's rate is the mean of its finer buckets' rates, its min and max are theirs, and its 95th percentile is taken
+# over their rate samples, so coarser levels are built incrementally and peaks are not averaged away.
+
+# Each level is a ring of fixed size allocated when the interface is first seen. A bucket lives in slot
+# (bucket start / resolution) modulo slots and the slot keeps the bucket start, so stale slots are told apart and a
+# query reads only the slots of the range asked for.
+
+# Metrics, all per second
+#   in_bps, out_bps                 octets * 8
+#   in_pps, out_pps                 unicast + multicast + broadcast packets
+#   in_errors, out_errors
+#   in_discards, out_discards
+#   ethernet_errors                 sum of the sFlowEthernetInterface error counters, 0 if the agent sends none
+
+# Level: (resolution in seconds, buckets kept)
+RESOLUTIONS = ((60, 720), (300, 864), (3600, 336))  # 12 hours, 3 days, 14 days
+
+METRICS = (
+    "in_bps",
+    "out_bps",
+    "in_pps",
+    "out_pps",
+    "in_errors",
+    "out_errors",
+    "in_discards",
+    "out_discards",
+    "ethernet_errors",
+)
+STATS = ("rate", "min", "max", "p95")
+
+# Counters: (record, attribute, width in bits)
+COUNTERS = (
+    ("if", "input_octets", 64),
+    ("if", "output_octets", 64),
+    ("if", "input_packets", 32),
+    ("if", "input_multicast", 32),
+    ("if", "input_broadcast", 32),
+    ("if", "output_packets", 32),
+    ("if", "output_multicast", 32),
+    ("if", "output_broadcast", 32),
+    ("if", "input_errors", 32),
+    ("if", "output_errors", 32),
+    ("if", "input_discarded", 32),
+    ("if", "output_discarded", 32),
+) + tuple(("ethernet", field, 32) for field in vars(sflow.sFlowEthernetInterface(bytes(52))))
+
+COUNTER_WIDTHS = tuple(width for _, _, width in COUNTERS)
+
+# Metric = METRIC_WEIGHTS @ counter deltas / elapsed seconds
+METRIC_WEIGHTS = np.zeros((len(METRICS), len(COUNTERS)))
+METRIC_WEIGHTS[0, 0] = 8
+METRIC_WEIGHTS[1, 1] = 8
+METRIC_WEIGHTS[2, 2:5] = 1
+METRIC_WEIGHTS[3, 5:8] = 1
+METRIC_WEIGHTS[4, 8] = 1
+METRIC_WEIGHTS[5, 9] = 1
+METRIC_WEIGHTS[6, 10] = 1
+METRIC_WEIGHTS[7, 11] = 1
+METRIC_WEIGHTS[8, 12:] = 1
+
+SAMPLE_CAPACITY = 64  # Rate samples kept per open bucket for the percentile, a uniform sample when there are more.
+
+
+class sFlowRollupLevel:
+    """sFlowRollupLevel class:
+
+    resolution:  Bucket length in seconds.
+    times:  Start of the bucket held by each slot, 0 when empty.
+    values:  Stats of each slot, slots x METRICS x STATS.
+    """
+
+    def __init__(self, resolution, slots):
+        self.resolution = resolution
+        self.slots = slots
+        self.times = np.zeros(slots, dtype=np.int64)
+        self.values = np.zeros((slots, len(METRICS), len(STATS)), dtype=np.float32)
+        self.samples = np.zeros((SAMPLE_CAPACITY, len(METRICS)))
+        self.count = 0
+        self.parts = 0
+        self.total = None
+        self.minimum = None
+        self.maximum = None
+        self.bucket = None
+        self.random = np.random.default_rng(resolution)
+
+    def add(self, timestamp, rates):
+        """Adds a rate sample, returns the summary of the bucket it closed or None."""
+        return self.merge(timestamp, rates, rates, rates, rates[np.newaxis])
+
+    def merge(self, timestamp, rates, minimum, maximum, samples):
+        """Adds the summary of a closed finer bucket, returns the summary of the bucket it closed or None.
+
+        A summary is (bucket start, rates, minimum, maximum, rate samples), per metric.
+        """
+        bucket = int(timestamp) // self.resolution * self.resolution
+        closed = None
+        if self.bucket is not None and bucket != self.bucket:
+            if bucket < self.bucket:  # Late sample for a closed bucket.
+                return None
+            closed = self.close()
+        self.bucket = bucket
+        if self.parts:
+            self.total += rates
+            np.minimum(self.minimum, minimum, out=self.minimum)
+            np.maximum(self.maximum, maximum, out=self.maximum)
+        else:
+            self.total = np.array(rates, dtype=np.float64)
+            self.minimum = np.array(minimum, dtype=np.float64)
+            self.maximum = np.array(maximum, dtype=np.float64)
+        self.parts += 1
+        for sample in samples:
+            if self.count < SAMPLE_CAPACITY:
+                self.samples[self.count] = sample
+            else:
+                slot = self.random.integers(self.count + 1)
+                if slot < SAMPLE_CAPACITY:
+                    self.samples[slot] = sample
+            self.count += 1
+        return closed
+
+    def close(self):
+        samples = self.samples[: min(self.count, SAMPLE_CAPACITY)].copy()
+        slot = self.bucket // self.resolution % self.slots
+        values = self.values[slot]
+        rates = self.total / self.parts
+        values[:, 0] = rates
+        values[:, 1] = self.minimum
+        values[:, 2] = self.maximum
+        values[:, 3] = np.percentile(samples, 95, axis=0)
+        self.times[slot] = self.bucket
+        closed = (self.bucket, rates, self.minimum, self.maximum, samples)
+        self.bucket = None
+        self.count = 0
+        self.parts = 0
+        return closed
+
+    def query(self, start, end):
+        """Returns (bucket starts, stats) of the closed buckets starting in [start, end), oldest first."""
+        first = max(int(start) // self.resolution, (int(end) - 1) // self.resolution - self.slots + 1)
+        last = (int(end) - 1) // self.resolution
+        if last < first:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(METRICS), len(STATS)), dtype=np.float32)
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        slots = buckets % self.slots
+        held = self.times[slots] == buckets * self.resolution
+        return self.times[slots[held]], self.values[slots[held]]
+
+
+class sFlowRollupInterface:
+    """sFlowRollupInterface class:
+
+    levels:  An sFlowRollupLevel per resolution, finest first.
+    """
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.levels = [sFlowRollupLevel(resolution, slots) for resolution, slots in resolutions]
+        self.previous_time = None
+        self.previous = None
+        self.resets = 0
+
+    def add(self, timestamp, counters):
+        """Adds one poll of the COUNTERS, as unsigned integers."""
+        previous, previous_time = self.previous, self.previous_time
+        self.previous, self.previous_time = counters, timestamp
+        if previous is None or timestamp <= previous_time:
+            return
+        deltas = []
+        for counter, previous_counter, width in zip(counters, previous, COUNTER_WIDTHS):
+            delta = counter - previous_counter
+            if delta < 0:
+                if width == 64:  # A 64-bit counter went backwards, the agent or interface was reset.
+                    self.resets += 1
+                    return
+                delta += 1 << width
+            deltas.append(delta)
+        rates = METRIC_WEIGHTS @ np.array(deltas, dtype=np.float64) / (timestamp - previous_time)
+
+        closed = self.levels[0].add(timestamp, rates)
+        for level in self.levels[1:]:
+            if closed is None:
+                break
+            closed = level.merge(*closed)
+
+    def flush(self, now):
+        """Closes the open buckets that have ended by now, for interfaces that stopped reporting.
+
+        Closed buckets are merged into the next coarser level as add() does, and may close an older bucket there.
+        """
+        closed = []
+        for level in self.levels:
+            merged = [level.merge(*summary) for summary in closed]
+            closed = [summary for summary in merged if summary is not None]
+            if level.bucket is not None and level.bucket + level.resolution <= now:
+                closed.append(level.close())
+
+
+class sFlowRollup:
+    """sFlowRollup class:
+
+    interfaces:  sFlowRollupInterface by (agent_address, ifIndex).
+    """
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = resolutions
+        self.interfaces = {}
+
+    def __repr__(self):
+        return f"""
+            Rollup:
+                Interfaces: {len(self.interfaces)}
+                Memory per Interface: {self.memory_per_interface}
+        """
+
+    @property
+    def memory_per_interface(self):
+        return sum(slots * (8 + len(METRICS) * len(STATS) * 4) for _, slots in self.resolutions)
+
+    def update(self, sflow_data, timestamp=None):
+        """Adds the interface counters of the counter samples of a decoded datagram."""
+        if timestamp is None:
+            timestamp = time.time()
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (2, 4):
+                continue
+            records = {}
+            for record in sample.records:
+                if type(record.record) is sflow.sFlowIfCounters:
+                    records["if"] = record.record
+                elif type(record.record) is sflow.sFlowEthernetInterface:
+                    records["ethernet"] = record.record
+            if "if" not in records:
+                continue
+            counters = tuple(
+                getattr(records[name], field) & ((1 << width) - 1) if name in records else 0 for name, field, width in COUNTERS
+            )
+            key = (sflow_data.agent_address, records["if"].index)
+            interface = self.interfaces.get(key)
+            if interface is None:
+                interface = self.interfaces[key] = sFlowRollupInterface(self.resolutions)
+            interface.add(timestamp, counters)
+
+    def flush(self, now=None):
+        now = time.time() if now is None else now
+        for interface in self.interfaces.values():
+            interface.flush(now)
+
+    def checkpoint_arrays(self):
+        """The counter baselines of the interfaces as named arrays, for sflow_checkpoint. Rings are not included."""
+        polled = [(key, interface) for key, interface in self.interfaces.items() if interface.previous is not None]
+        counters = np.zeros((len(polled), len(COUNTERS)), dtype=np.uint64)
+        for row, (_, interface) in enumerate(polled):
+            counters[row] = interface.previous
+        return {
+            "keys": json.dumps([key for key, _ in polled]).encode("utf-8"),
+            "counters": counters,
+            "times": np.array([interface.previous_time for _, interface in polled], dtype=np.float64),
+        }
+
+    def restore_arrays(self, arrays):
+        """Restores the counter baselines from checkpoint_arrays, so the next poll of each interface gives a rate."""
+        keys = json.loads(bytes(arrays["keys"]).decode("utf-8"))
+        counters = arrays["counters"].reshape(len(keys), len(COUNTERS)).tolist()
+        for key, previous, previous_time in zip(keys, counters, arrays["times"].tolist()):
+            key = tuple(key)
+            interface = self.interfaces.get(key)
+            if interface is None:
+                interface = self.interfaces[key] = sFlowRollupInterface(self.resolutions)
+            interface.previous, interface.previous_time = tuple(previous), previous_time
+
+    def query(self, agent_address, if_index, hours, metric=None, now=None):
+        """Returns (bucket starts, stats) for the last hours of an interface, from the finest level holding them all.
+
+        stats is buckets x METRICS x STATS, or buckets x STATS for a single metric.
+        """
+        interface = self.interfaces.get((agent_address, if_index))
+        if interface is None:
+            return None
+        end = time.time() if now is None else now
+        start = end - hours * 3600
+        for level in interface.levels:
+            if level.resolution * level.slots >= end - start:
+                break
+        times, values = level.query(start, end)
+        if metric is not None:
+            values = values[:, METRICS.index(metric)]
+        return times, values
+
+
+def check(poll_interval=20, minutes=50, peak=400000):
+    """Polls an interface for minutes, peaking a minute before the last poll, flushes and checks every level kept the peak."""
+    interface = sFlowRollupInterface()
+    start = 1700000000 // 3600 * 3600
+    counters = [0] * len(COUNTERS)
+    polls = minutes * 60 // poll_interval
+    for poll in range(polls + 1):
+        octets = (peak if poll == polls - 60 // poll_interval else 7000) * poll_interval // 8
+        counters[0] += octets
+        interface.add(start + poll * poll_interval, tuple(counters))
+    interface.flush(start + 2 * 3600)
+    in_bps = METRICS.index("in_bps")
+    maximums = []
+    for level in interface.levels:
+        times, values = level.query(start, start + 3600)
+        maximum = float(values[:, in_bps, STATS.index("max")].max()) if len(times) else None
+        maximums.append(maximum)
+        print(f"{level.resolution}s: {len(times)} buckets, in_bps max {maximum}")
+    assert all(level.bucket is None for level in interface.levels), "open bucket left after flush"
+    assert maximums == [peak] * len(maximums), f"peak {peak} not kept by every level: {maximums}"
+    print("flushed buckets reached every level")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Interface counter rollups at 1 minute, 5 minute and 1 hour resolution.")
+    parser.add_argument("--check", action="store_true", help="check that flushed buckets reach the coarser levels")
+    args = parser.parse_args()
+
+    if args.check:
+        check()
@@ -0,0 +1,157 @@
+from struct import unpack
+
+import sflow
+
+# Flat rows of decoded sFlow samples, shared by the archive and storage sinks.
+
+# Flow samples are flattened to one row per sample, merging sFlowRawPacketHeader (decoded Ethernet and IPv4 header),
+# sFlowSampledIpv4, sFlowSampledIpv6 and sFlowExtendedSwitch records. Counter records are flattened to one row per
+# record, with the attributes of their record class.
+
+sample_fields = ("time", "agent_address", "sub_agent", "sequence_number", "sample_sequence", "source_index")
+
+flow_fields = sample_fields + (
+    "sample_rate",
+    "sample_pool",
+    "dropped_packets",
+    "input_if",
+    "output_if",
+    "frame_length",
+    "source_mac",
+    "destination_mac",
+    "vlan",
+    "ip_protocol",
+    "source_ip",
+    "destination_ip",
+    "source_port",
+    "destination_port",
+    "tcp_flags",
+    "tos",
+    "source_vlan",
+    "destination_vlan",
+)
+
+# Counter record type: table name
+
+counter_table_names = {
+    sflow.sFlowIfCounters: "if_counters",
+    sflow.sFlowEthernetInterface: "ethernet_counters",
+    sflow.sFlowVLAN: "vlan_counters",
+    sflow.sFlowProcessor: "processor",
+    sflow.sFlowHostCPU: "host_cpu",
+    sflow.sFlowHostMemory: "host_memory",
+    sflow.sFlowHostDiskIO: "host_disk_io",
+    sflow.sFlowHostNetIO: "host_net_io",
+    sflow.sFlowMib2IP: "mib2_ip_group",
+    sflow.sFlowMib2ICMP: "mib2_icmp_group",
+    sflow.sFlowMib2TCP: "mib2_tcp_group",
+    sflow.sFlowMib2UDP: "mib2_udp_group",
+    sflow.sFlowVirtCPU: "virt_cpu",
+    sflow.sFlowVirtMemory: "virt_memory",
+    sflow.sFlowVirtDiskIO: "virt_disk_io",
+    sflow.sFlowVirtNetIO: "virt_net_io",
+}
+
+# The record attributes, in decode order, are taken from a record decoded from zeros.
+counter_fields = {record_type: tuple(vars(record_type(bytes(128)))) for record_type in counter_table_names}
+
+# Counter attributes decoded as floating point, all others are integers.
+counter_float_fields = {
+    "average_load_1_minute",
+    "average_load_5_minutes",
+    "average_load_15_minutes",
+    "partition_max_used",
+}
+
+
+def flow_row(sflow_data, sample, timestamp):
+    row = dict.fromkeys(flow_fields)
+    row["time"] = timestamp
+    row["agent_address"] = sflow_data.agent_address
+    row["sub_agent"] = sflow_data.sub_agent
+    row["sequence_number"] = sflow_data.sequence_number
+    row["sample_sequence"] = sample.sequence
+    row["source_index"] = sample.source_index
+    row["sample_rate"] = sample.sample_rate
+    row["sample_pool"] = sample.sample_pool
+    row["dropped_packets"] = sample.dropped_packets
+    row["input_if"] = sample.input_if_value
+    row["output_if"] = sample.output_if_value
+
+    for record in sample.records:
+        record = record.record
+        record_type = type(record)
+        if record_type is sflow.sFlowRawPacketHeader:
+            row["frame_length"] = record.frame_length
+            if record.header_protocol != 1:  # Ethernet
+                continue
+            row["source_mac"] = record.source_mac
+            row["destination_mac"] = record.destination_mac
+            decode = record.decode_ipv4()
+            row["vlan"] = decode.get("vlan", decode.get("inner_vlan"))
+            if "protocol" in decode:
+                row["ip_protocol"] = decode["protocol"]
+                row["source_ip"] = decode["source"]
+                row["destination_ip"] = decode["destination"]
+                if decode["protocol"] in (6, 17) and len(decode["header"]) >= 4:
+                    row["source_port"], row["destination_port"] = unpack(">HH", decode["header"][0:4])
+        elif record_type is sflow.sFlowSampledIpv4 or record_type is sflow.sFlowSampledIpv6:
+            if row["frame_length"] is None:
+                row["frame_length"] = record.length
+            row["ip_protocol"] = record.protocol
+            row["source_ip"] = record.source_ip
+            row["destination_ip"] = record.destination_ip
+            row["source_port"] = record.source_port
+            row["destination_port"] = record.destination_port
+            row["tcp_flags"] = record.tcp_flags
+            row["tos"] = record.tos if record_type is sflow.sFlowSampledIpv4 else record.priority
+        elif record_type is sflow.sFlowExtendedSwitch:
+            row["source_vlan"] = record.source_vlan
+            row["destination_vlan"] = record.destination_vlan
+    return row
+
+
+def flow_tuple(sample):
+    """Returns (source_ip, destination_ip, ip_protocol, source_port, destination_port, frame_length) of a flow sample.
+
+    A lighter flow_row for the analysis stages: fields missing from the sample are None.
+    """
+    source_ip = destination_ip = protocol = source_port = destination_port = frame_length = None
+    for record in sample.records:
+        record = record.record
+        record_type = type(record)
+        if record_type is sflow.sFlowSampledIpv4 or record_type is sflow.sFlowSampledIpv6:
+            source_ip, destination_ip, protocol = record.source_ip, record.destination_ip, record.protocol
+            source_port, destination_port = record.source_port, record.destination_port
+            if frame_length is None:
+                frame_length = record.length
+        elif record_type is sflow.sFlowRawPacketHeader:
+            frame_length = record.frame_length
+            if source_ip is None and hasattr(record, "ip_source"):
+                source_ip, destination_ip, protocol = record.ip_source, record.ip_destination, record.ip_protocol
+                if protocol in (6, 17) and len(record.ip_remaining_header) >= 4:
+                    source_port, destination_port = unpack(">HH", record.ip_remaining_header[0:4])
+    return source_ip, destination_ip, protocol, source_port, destination_port, frame_length
+
+
+def counter_row(sflow_data, sample, record, timestamp):
+    row = {field: getattr(record, field) for field in counter_fields[type(record)]}
+    row["time"] = timestamp
+    row["agent_address"] = sflow_data.agent_address
+    row["sub_agent"] = sflow_data.sub_agent
+    row["sequence_number"] = sflow_data.sequence_number
+    row["sample_sequence"] = sample.sequence
+    row["source_index"] = sample.source_index
+    return row
+
+
+def iter_rows(sflow_data, timestamp):
+    """Yields (table name, row) for every flow sample and every known counter record of a decoded datagram."""
+    for sample in sflow_data.samples:
+        if sample.sample_type in (1, 3):
+            yield "flows", flow_row(sflow_data, sample, timestamp)
+            continue
+        for record in sample.records:
+            table_name = counter_table_names.get(type(record.record))
+            if table_name is not None:
+                yield table_name, counter_row(sflow_data, sample, record.record, timestamp)
@@ -0,0 +1,254 @@
+import argparse
+import math
+import os
+import socket
+import time
+from struct import pack_into, unpack_from
+
+import sflow
+import sflow_synthetic
+
+# The sFlow Load Shedder keeps a collector that cannot keep up from falling behind, by decoding fewer flow samples
+# rather than letting the kernel drop whole datagrams at random.
+
+# Each datagram is rewritten before it is decoded. Counter samples are always kept. Flow samples of an agent shedding
+# by a factor N are kept when their sample sequence number is a multiple of N, and the sample_rate of each kept sample
+# is multiplied by N, so every sum of frame_length * sample_rate or of sample_rate over the kept samples still
+# estimates the traffic of the agent. The choice depends only on the datagram, so replicated collectors shed the same
+# samples, and agents with a factor of 1 are passed through unchanged.
+
+# Every INTERVAL the controller is given the time the collector spent decoding and consuming the samples it kept and,
+# optionally, the receive queue of its socket:
+#   cost        seconds per kept flow sample, averaged
+#   capacity    flow samples per second the collector can take at TARGET utilization, less the share of the
+#               receive queue above HIGH_WATER so that a backlog drains
+#   offered     flow samples per second received from each agent
+# When the offered samples exceed the capacity, it is divided between agents max-min fairly: agents offering less than
+# an even share keep every sample and the rest of the capacity is shared evenly by the others, whose factor is the
+# integer that brings them within their share. The shedding factor reported is offered / kept over every agent.
+
+INTERVAL = 1.0  # seconds
+TARGET = 0.8  # utilization
+HIGH_WATER = 0.25  # receive queue, fraction of SO_RCVBUF
+SMOOTHING = 0.3  # weight of the latest interval in the cost
+MAX_FACTOR = 4096
+MAX_SAMPLE_RATE = 0x7FFFFFFF
+
+
+def socket_queue(sock):
+    """(receive queue bytes, drops) of a UDP socket from /proc/net/udp or udp6, or None where neither lists it."""
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(path) as table:
+                for line in table:
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[4].split(":")[1], 16), int(fields[-1])
+        except OSError:  # No IPv4 or no IPv6 table, try the other.
+            continue
+    return None
+
+
+class sFlowLoadShedder:
+    """sFlowLoadShedder class:
+
+    target:  Utilization of the collector aimed for.
+    capacity:  Flow samples per second the collector can take, None until measured.
+    factors:  Agent address: shedding factor, agents not listed keep every sample.
+    sheddingFactor:  Flow samples received / flow samples kept over the last interval.
+    flowSamples:  Flow samples received.
+    kept:  Flow samples kept.
+    counterSamples:  Counter samples, all kept.
+    """
+
+    def __init__(self, interval=INTERVAL, target=TARGET, high_water=HIGH_WATER):
+        self.interval = interval
+        self.target = target
+        self.high_water = high_water
+        self.cost = None
+        self.capacity = None
+        self.factors = {}
+        self.shedding_factor = 1.0
+        self.offered = {}
+        self.busy = 0.0
+        self.interval_kept = 0
+        self.interval_start = time.monotonic()
+        self.flow_samples = 0
+        self.kept = 0
+        self.counter_samples = 0
+        self.queue = 0.0
+        self.drops = 0
+
+    def __repr__(self):
+        return f"""
+            Load Shedder:
+                Shedding Factor: {self.shedding_factor:.2f}
+                Capacity: {f"{self.capacity:.0f} samples/s" if self.capacity else "unknown"}
+                Agents Shedding: {len(self.factors)}
+                Flow Samples: {self.flow_samples}
+                Kept: {self.kept}
+                Counter Samples: {self.counter_samples}
+                Receive Queue: {self.queue:.2f}
+                Kernel Drops: {self.drops}
+        """
+
+    def shed(self, datagram):
+        """Returns the datagram with the flow samples shed by its agent's factor removed, sample rates scaled to match."""
+        header = sflow.sFlowHeader(datagram)
+        if header.address_type not in (1, 2):
+            return datagram
+        factor = self.factors.get(header.agent_address, 1)
+        data_position = header.sample_position
+        flow_samples = kept = counter_samples = 0
+        output = None
+        for _ in range(header.number_sample):
+            sample_header, sample_size = unpack_from(">ii", datagram, data_position)
+            sample_end = data_position + 8 + sample_size
+            sample_type = sample_header % 4096
+            if sample_type == 1 or sample_type == 3:
+                flow_samples += 1
+                if factor > 1:
+                    if output is None:
+                        output = bytearray(datagram[:data_position])
+                    if unpack_from(">i", datagram, data_position + 8)[0] % factor == 0:
+                        rate_position = len(output) + (16 if sample_type == 1 else 20)
+                        output += datagram[data_position:sample_end]
+                        sample_rate = unpack_from(">i", output, rate_position)[0]
+                        pack_into(">i", output, rate_position, min(sample_rate * factor, MAX_SAMPLE_RATE))
+                        kept += 1
+                    data_position = sample_end
+                    continue
+                kept += 1
+            elif sample_type == 2 or sample_type == 4:
+                counter_samples += 1
+            if output is not None:
+                output += datagram[data_position:sample_end]
+            data_position = sample_end
+        self.offered[header.agent_address] = self.offered.get(header.agent_address, 0) + flow_samples
+        self.flow_samples += flow_samples
+        self.kept += kept
+        self.interval_kept += kept
+        self.counter_samples += counter_samples
+        if output is None:
+            return datagram
+        pack_into(">i", output, header.sample_position - 4, header.number_sample - flow_samples + kept)
+        return output
+
+    def record(self, seconds):
+        """Adds the seconds spent decoding and consuming shed datagrams."""
+        self.busy += seconds
+
+    def update(self, now=None, queue=None, rcvbuf=None, drops=None):
+        """Recomputes the factors from the last interval. queue and rcvbuf are the receive queue and SO_RCVBUF in bytes."""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.interval_start
+        if elapsed <= 0:
+            return self.factors
+        if self.interval_kept:
+            cost = self.busy / self.interval_kept
+            self.cost = cost if self.cost is None else self.cost + SMOOTHING * (cost - self.cost)
+        self.queue = queue / rcvbuf if queue is not None and rcvbuf else 0.0
+        if drops is not None:
+            self.drops = drops
+        offered = {agent: samples / elapsed for agent, samples in self.offered.items() if samples}
+        total = sum(offered.values())
+        if self.cost:
+            capacity = self.target / self.cost
+            if self.queue > self.high_water:
+                capacity *= 1 - min(self.queue, 1) / 2
+            self.capacity = capacity
+        factors = {}
+        if self.capacity and total > self.capacity:
+            remaining = self.capacity
+            rates = sorted(offered.items(), key=lambda item: item[1])
+            for i, (agent, rate) in enumerate(rates):
+                share = remaining / (len(rates) - i)
+                if rate <= share:
+                    remaining -= rate
+                    continue
+                factor = min(math.ceil(rate / share), MAX_FACTOR) if share > 0 else MAX_FACTOR
+                factors[agent] = factor
+                remaining -= rate / factor
+        self.factors = factors
+        kept = sum(rate / factors.get(agent, 1) for agent, rate in offered.items())
+        self.shedding_factor = total / kept if kept else 1.0
+        self.offered = {}
+        self.busy = 0.0
+        self.interval_kept = 0
+        self.interval_start = now
+        return factors
+
+
+def benchmark(datagrams):
+    decoded = []
+    agents = [f"192.0.2.{i}" for i in range(8)]
+    for i in range(1024):
+        agent = agents[0] if i % 2 else agents[i // 2 % len(agents)]
+        samples = [
+            sflow_synthetic.flow_sample([sflow_synthetic.sampled_header()], sequence=i * 8 + j, sample_rate=1000)
+            for j in range(8)
+        ]
+        samples.append(sflow_synthetic.counter_sample([sflow_synthetic.if_counters()], sequence=i))
+        decoded.append(sflow_synthetic.datagram(samples, agent_address=agent, sequence_number=i))
+
+    shedder = sFlowLoadShedder()
+    start = time.perf_counter()
+    for i in range(datagrams):
+        shedder.shed(decoded[i % len(decoded)])
+    elapsed = time.perf_counter() - start
+    print(f"pass through: {elapsed / datagrams * 1000000:.2f} us/datagram")
+
+    # Half the datagrams come from one agent, and the collector was busy for 4 times its target over the interval.
+    shedder.record(4 * shedder.target)
+    shedder.update(shedder.interval_start + 1)
+    shedder.flow_samples = shedder.kept = shedder.counter_samples = 0
+    offered, estimated = {}, {}
+    start = time.perf_counter()
+    for i in range(datagrams):
+        shedder.shed(decoded[i % len(decoded)])
+    elapsed = time.perf_counter() - start
+    for i in range(len(decoded)):
+        for data in (decoded[i], shedder.shed(decoded[i])):
+            sflow_data = sflow.sFlow(data)
+            totals = offered if data is decoded[i] else estimated
+            for sample in sflow_data.samples:
+                totals[sflow_data.agent_address] = totals.get(sflow_data.agent_address, 0) + sample.sample_rate
+    print(shedder)
+    print(f"factors: {shedder.factors}")
+    print(f"shedding: {elapsed / datagrams * 1000000:.2f} us/datagram")
+    for agent in sorted(offered):
+        print(f"    {agent} packets {offered[agent]} estimated {estimated[agent]}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Adaptive load shedding of sFlow flow samples with sample rate compensation.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--target", type=float, default=TARGET, help="utilization")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the cost per datagram and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        shedder = sFlowLoadShedder(target=args.target)
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(shedder.interval)
+        rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+                start = time.perf_counter()
+                sflow.sFlow(shedder.shed(data))
+                shedder.record(time.perf_counter() - start)
+            except socket.timeout:
+                pass
+            if time.monotonic() >= shedder.interval_start + shedder.interval:
+                queue = socket_queue(sock)
+                shedder.update(queue=queue and queue[0], rcvbuf=rcvbuf, drops=queue and queue[1])
+                if shedder.factors:
+                    print(shedder)
@@ -0,0 +1,460 @@
+import argparse
+import heapq
+import socket
+import time
+from functools import lru_cache
+from socket import AF_INET, AF_INET6, inet_pton
+from struct import Struct
+
+import numpy as np
+
+import sflow
+import sflow_rows
+import sflow_synthetic
+
+# The sFlow Sketches estimate distinct counts and heavy hitters over flow samples in fixed memory.
+
+# Every flow sample yields (source, destination, protocol, ports, frame length) through sflow_rows.flow_tuple.
+# Samples are batched and the sketches updated a whole batch at a time: keys are turned into 64-bit integers, hashed
+# with a vectorized MurmurHash3 finalizer and applied with NumPy ufunc.at, so the per sample cost is mostly the Python
+# work of reading the sample.
+
+# Sketches
+#   sFlowHyperLogLog            distinct count of a whole stream
+#   sFlowCountMin               weight per key, never under estimated
+#   sFlowDistinctCountMin       distinct count per key: a Count-Min whose cells are small HyperLogLogs
+#   sFlowTopK                   the k keys with the largest estimates, as reported by one of the sketches above
+
+# Estimates
+#   sources per destination     sFlowDistinctCountMin, distinct source addresses
+#   ports per source            sFlowDistinctCountMin, distinct (protocol, destination port)
+#   packets per destination     sFlowCountMin, sample_rate per sample
+#   bytes per destination       sFlowCountMin, frame_length * sample_rate per sample
+# Packets and bytes are scaled by sample_rate. Distinct counts are counts of what was sampled, they are not scaled.
+
+# Sketches with the same dimensions merge: registers by maximum, counters by sum, so per worker sketches add up to the
+# sketch of the whole stream. to_bytes and from_bytes carry them between processes.
+
+BATCH_SIZE = 4096
+
+HLL_PRECISION = 14  # 16384 registers, 0.8% standard error
+CM_WIDTH = 65536
+CM_DEPTH = 4
+DISTINCT_WIDTH = 16384
+DISTINCT_DEPTH = 3
+DISTINCT_PRECISION = 6  # 64 registers per cell, 13% standard error
+TOP_K = 100
+
+SKETCH_HEADER = Struct("<4sIII")  # magic, first, second and third dimension
+
+MASK64 = (1 << 64) - 1
+
+# Hash seeds, so a key hashes differently as a source, a destination or a port.
+SOURCE_SEED, DESTINATION_SEED, PORT_SEED = 1, 2, 3
+
+
+def hash64(values, seed=0):
+    """MurmurHash3 fmix64 of a uint64 array."""
+    h = values ^ np.uint64(seed)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xFF51AFD7ED558CCD)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xC4CEB9FE1A85EC53)
+    h ^= h >> np.uint64(33)
+    return h
+
+
+@lru_cache(maxsize=262144)
+def address_key(address):
+    """An address as a 64-bit integer, IPv6 addresses folded."""
+    if ":" in address:
+        value = int.from_bytes(inet_pton(AF_INET6, address), "big")
+        return (value >> 64) ^ (value & MASK64)
+    return int.from_bytes(inet_pton(AF_INET, address), "big")
+
+
+def hll_alpha(registers):
+    return {16: 0.673, 32: 0.697, 64: 0.709}.get(registers, 0.7213 / (1 + 1.079 / registers))
+
+
+def hll_observations(hashes, precision):
+    """Returns (register, rank) of each hash: the top bits pick the register, the rank is 1 + the leading zeros of the rest."""
+    registers = hashes >> np.uint64(64 - precision)
+    rest = (hashes << np.uint64(precision)) >> np.uint64(12)  # 52 bits, exact as float64
+    _, bit_length = np.frexp(rest.astype(np.float64))
+    return registers.astype(np.int64), (53 - bit_length).astype(np.uint8)
+
+
+def hll_estimate(registers):
+    """Estimates of HyperLogLog registers along the last axis."""
+    m = registers.shape[-1]
+    raw = hll_alpha(m) * m * m / np.ldexp(1.0, -registers.astype(np.int32)).sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    small = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), small, raw)
+
+
+def cells(hashes, width, depth):
+    """Count-Min columns of each hash in each row, depth x len(hashes), from double hashing."""
+    low = hashes & np.uint64(0xFFFFFFFF)
+    high = (hashes >> np.uint64(32)) | np.uint64(1)
+    rows = np.arange(depth, dtype=np.uint64)[:, None]
+    return ((low + rows * high) % np.uint64(width)).astype(np.int64)
+
+
+def pack_sketch(magic, shape, array):
+    return SKETCH_HEADER.pack(magic, *shape) + array.tobytes()
+
+
+def unpack_sketch(magic, data, dtype):
+    found, *shape = SKETCH_HEADER.unpack_from(data)
+    if found != magic:
+        raise ValueError(f"expected a {magic.decode()} sketch")
+    return shape, np.frombuffer(data, dtype, offset=SKETCH_HEADER.size).copy()
+
+
+class sFlowHyperLogLog:
+    """sFlowHyperLogLog class:
+
+    precision:  Bits of the hash choosing the register, 2 ** precision registers.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes):
+        registers, ranks = hll_observations(hashes, self.precision)
+        np.maximum.at(self.registers, registers, ranks)
+
+    def estimate(self):
+        return float(hll_estimate(self.registers))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("sketches of different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def to_bytes(self):
+        return pack_sketch(b"sHLL", (self.precision, 0, 0), self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (precision, _, _), registers = unpack_sketch(b"sHLL", data, np.uint8)
+        sketch = cls(precision)
+        sketch.registers = registers
+        return sketch
+
+
+class sFlowCountMin:
+    """sFlowCountMin class:
+
+    width:  Counters per row.
+    depth:  Rows, each key is counted once per row and its estimate is the smallest of its counters.
+    """
+
+    def __init__(self, width=CM_WIDTH, depth=CM_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.counters = np.zeros((depth, width), dtype=np.int64)
+
+    def add(self, hashes, weights):
+        columns = cells(hashes, self.width, self.depth)
+        flat = columns + (np.arange(self.depth, dtype=np.int64) * self.width)[:, None]
+        np.add.at(self.counters.ravel(), flat.ravel(), np.tile(weights, self.depth))
+
+    def estimate(self, hashes):
+        columns = cells(hashes, self.width, self.depth)
+        return self.counters[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("sketches of different dimensions")
+        self.counters += other.counters
+
+    def to_bytes(self):
+        return pack_sketch(b"sCMS", (self.width, self.depth, 0), self.counters)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (width, depth, _), counters = unpack_sketch(b"sCMS", data, np.int64)
+        sketch = cls(width, depth)
+        sketch.counters = counters.reshape(depth, width)
+        return sketch
+
+
+class sFlowDistinctCountMin:
+    """sFlowDistinctCountMin class:
+
+    width:  Cells per row.
+    depth:  Rows, the estimate of a key is the smallest of its cells.
+    precision:  2 ** precision HyperLogLog registers per cell.
+    """
+
+    def __init__(self, width=DISTINCT_WIDTH, depth=DISTINCT_DEPTH, precision=DISTINCT_PRECISION):
+        self.width = width
+        self.depth = depth
+        self.precision = precision
+        self.registers = np.zeros((depth, width, 1 << precision), dtype=np.uint8)
+
+    def add(self, key_hashes, item_hashes):
+        columns = cells(key_hashes, self.width, self.depth)
+        registers, ranks = hll_observations(item_hashes, self.precision)
+        rows = np.arange(self.depth, dtype=np.int64)[:, None]
+        flat = ((rows * self.width + columns) << self.precision) + registers
+        np.maximum.at(self.registers.ravel(), flat.ravel(), np.tile(ranks, self.depth))
+
+    def estimate(self, key_hashes):
+        columns = cells(key_hashes, self.width, self.depth)
+        return hll_estimate(self.registers[np.arange(self.depth)[:, None], columns]).min(axis=0)
+
+    def merge(self, other):
+        if (other.width, other.depth, other.precision) != (self.width, self.depth, self.precision):
+            raise ValueError("sketches of different dimensions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def to_bytes(self):
+        return pack_sketch(b"sDCM", (self.width, self.depth, self.precision), self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (width, depth, precision), registers = unpack_sketch(b"sDCM", data, np.uint8)
+        sketch = cls(width, depth, precision)
+        sketch.registers = registers.reshape(depth, width, 1 << precision)
+        return sketch
+
+
+class sFlowTopK:
+    """sFlowTopK class:
+
+    k:  Keys kept.
+    candidates:  Key: latest estimate, at most 2k between trims.
+    """
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.candidates = {}
+
+    def offer(self, keys, estimates):
+        candidates = self.candidates
+        for key, estimate in zip(keys, estimates.tolist()):
+            candidates[key] = estimate
+        if len(candidates) > 2 * self.k:
+            self.trim()
+
+    def trim(self):
+        self.candidates = dict(heapq.nlargest(self.k, self.candidates.items(), key=lambda item: item[1]))
+
+    def top(self, n=None):
+        return heapq.nlargest(min(n or self.k, self.k), self.candidates.items(), key=lambda item: item[1])
+
+    def merge(self, other):
+        """Takes the candidates of another sFlowTopK, their estimates are to be offered again from the merged sketch."""
+        for key, estimate in other.candidates.items():
+            if estimate > self.candidates.get(key, -1):
+                self.candidates[key] = estimate
+
+
+class sFlowSketches:
+    """sFlowSketches class:
+
+    sources:  Distinct sources, sFlowHyperLogLog.
+    destinations:  Distinct destinations, sFlowHyperLogLog.
+    sourcesPerDestination:  sFlowDistinctCountMin and sFlowTopK of destinations.
+    portsPerSource:  sFlowDistinctCountMin and sFlowTopK of sources.
+    packetsPerDestination:  sFlowCountMin and sFlowTopK of destinations.
+    bytesPerDestination:  sFlowCountMin and sFlowTopK of destinations.
+    samples:  Flow samples added.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, k=TOP_K):
+        self.batch_size = batch_size
+        self.sources = sFlowHyperLogLog()
+        self.destinations = sFlowHyperLogLog()
+        self.sources_per_destination = (sFlowDistinctCountMin(), sFlowTopK(k))
+        self.ports_per_source = (sFlowDistinctCountMin(), sFlowTopK(k))
+        self.packets_per_destination = (sFlowCountMin(), sFlowTopK(k))
+        self.bytes_per_destination = (sFlowCountMin(), sFlowTopK(k))
+        self.samples = 0
+        self.batch = []
+
+    def __repr__(self):
+        return f"""
+            Sketches:
+                Samples: {self.samples}
+                Sources: {self.sources.estimate():.0f}
+                Destinations: {self.destinations.estimate():.0f}
+        """
+
+    def add(self, sflow_data):
+        """Adds the flow samples of a decoded datagram, updating the sketches once a batch is full."""
+        batch = self.batch
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (1, 3):
+                continue
+            source, destination, protocol, _, destination_port, frame_length = sflow_rows.flow_tuple(sample)
+            if source is None:
+                continue
+            batch.append(
+                (
+                    source,
+                    destination,
+                    address_key(source),
+                    address_key(destination),
+                    (protocol or 0) << 16 | (destination_port or 0),
+                    sample.sample_rate,
+                    (frame_length or 0) * sample.sample_rate,
+                )
+            )
+        if len(batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        sources, destinations, source_keys, destination_keys, ports, packets, octets = zip(*self.batch)
+        self.samples += len(self.batch)
+        self.batch = []
+
+        source_hashes = hash64(np.array(source_keys, dtype=np.uint64), SOURCE_SEED)
+        destination_hashes = hash64(np.array(destination_keys, dtype=np.uint64), DESTINATION_SEED)
+        port_hashes = hash64(np.array(ports, dtype=np.uint64), PORT_SEED)
+        self.sources.add(source_hashes)
+        self.destinations.add(destination_hashes)
+
+        # Estimates are read once per distinct key of the batch.
+        _, first_destination = np.unique(destination_hashes, return_index=True)
+        _, first_source = np.unique(source_hashes, return_index=True)
+        batch_destinations = [destinations[i] for i in first_destination]
+        batch_sources = [sources[i] for i in first_source]
+
+        sketch, top = self.sources_per_destination
+        sketch.add(destination_hashes, source_hashes)
+        top.offer(batch_destinations, sketch.estimate(destination_hashes[first_destination]))
+        sketch, top = self.ports_per_source
+        sketch.add(source_hashes, port_hashes)
+        top.offer(batch_sources, sketch.estimate(source_hashes[first_source]))
+        for (sketch, top), weights in ((self.packets_per_destination, packets), (self.bytes_per_destination, octets)):
+            sketch.add(destination_hashes, np.array(weights, dtype=np.int64))
+            top.offer(batch_destinations, sketch.estimate(destination_hashes[first_destination]))
+
+    def estimates(self):
+        """Returns (name, (sketch, top), seed of the keys) of each keyed estimate."""
+        return (
+            ("sources per destination", self.sources_per_destination, DESTINATION_SEED),
+            ("ports per source", self.ports_per_source, SOURCE_SEED),
+            ("packets per destination", self.packets_per_destination, DESTINATION_SEED),
+            ("bytes per destination", self.bytes_per_destination, DESTINATION_SEED),
+        )
+
+    def merge(self, other):
+        """Adds the sketches of another worker, both flushed first."""
+        self.flush()
+        other.flush()
+        self.sources.merge(other.sources)
+        self.destinations.merge(other.destinations)
+        for (_, (sketch, top), seed), (_, (other_sketch, other_top), _) in zip(self.estimates(), other.estimates()):
+            sketch.merge(other_sketch)
+            top.merge(other_top)
+            keys = list(top.candidates)
+            if keys:
+                hashes = hash64(np.array([address_key(key) for key in keys], dtype=np.uint64), seed)
+                top.offer(keys, sketch.estimate(hashes))
+            top.trim()
+        self.samples += other.samples
+
+    def report(self, n=10):
+        self.flush()
+        lines = [f"sources: {self.sources.estimate():.0f}, destinations: {self.destinations.estimate():.0f}"]
+        for name, (_, top), _ in self.estimates():
+            lines.append(f"{name}:")
+            lines.extend(f"    {key:<40} {estimate:.0f}" for key, estimate in top.top(n))
+        return "\n".join(lines)
+
+    def to_bytes(self):
+        self.flush()
+        parts = [self.sources.to_bytes(), self.destinations.to_bytes()]
+        for _, (sketch, top), _ in self.estimates():
+            parts.append(sketch.to_bytes())
+            parts.append("\n".join(f"{key}\t{estimate!r}" for key, estimate in top.candidates.items()).encode("utf-8"))
+        parts.append(str(self.samples).encode())
+        return b"".join(len(part).to_bytes(8, "little") + part for part in parts)
+
+    @classmethod
+    def from_bytes(cls, data, batch_size=BATCH_SIZE, k=TOP_K):
+        parts = []
+        offset = 0
+        while offset < len(data):
+            length = int.from_bytes(data[offset : offset + 8], "little")
+            parts.append(data[offset + 8 : offset + 8 + length])
+            offset += 8 + length
+        sketches = cls(batch_size, k)
+        sketches.sources = sFlowHyperLogLog.from_bytes(parts[0])
+        sketches.destinations = sFlowHyperLogLog.from_bytes(parts[1])
+        names = ("sources_per_destination", "ports_per_source", "packets_per_destination", "bytes_per_destination")
+        for i, (name, sketch_type) in enumerate(
+            zip(names, (sFlowDistinctCountMin, sFlowDistinctCountMin, sFlowCountMin, sFlowCountMin))
+        ):
+            top = sFlowTopK(k)
+            for line in parts[3 + 2 * i].decode("utf-8").splitlines():
+                key, estimate = line.split("\t")
+                top.candidates[key] = float(estimate)
+            setattr(sketches, name, (sketch_type.from_bytes(parts[2 + 2 * i]), top))
+        sketches.samples = int(parts[10])
+        return sketches
+
+
+def benchmark(samples):
+    datagrams = []
+    for i in range(256):
+        records = [
+            sflow_synthetic.flow_sample(
+                [
+                    sflow_synthetic.sampled_ipv4(
+                        source_ip=f"10.{i}.{j}.{(i * j) % 256}",
+                        destination_ip=f"192.0.2.{j % 16}",
+                        destination_port=1 + (i * 7 + j) % 1024,
+                    )
+                ],
+                sequence=j,
+            )
+            for j in range(8)
+        ]
+        datagrams.append(sflow.sFlow(sflow_synthetic.datagram(records, sequence_number=i)))
+
+    sketches = sFlowSketches()
+    start = time.perf_counter()
+    for i in range(samples // 8):
+        sketches.add(datagrams[i % len(datagrams)])
+    sketches.flush()
+    elapsed = time.perf_counter() - start
+    print(sketches.report(5))
+    print(f"{sketches.samples} samples in {elapsed:.2f}s: {elapsed / sketches.samples * 1e6:.2f} us/sample")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Distinct count and heavy hitter sketches of sFlow flow samples.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--interval", type=float, default=10, help="seconds between reports")
+    parser.add_argument("--benchmark", type=int, metavar="SAMPLES", help="measure the cost per sample and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        sketches = sFlowSketches()
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(args.interval)
+        last_report = time.monotonic()
+        while True:
+            try:
+                data, addr = sock.recvfrom(3000)
+                sketches.add(sflow.sFlow(data))
+            except socket.timeout:
+                pass
+            if time.monotonic() - last_report >= args.interval:
+                print(sketches.report())
+                last_report = time.monotonic()
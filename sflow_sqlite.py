@@ -0,0 +1,250 @@
+import argparse
+import socket
+import sqlite3
+import sys
+import time
+from struct import error as StructError
+
+import sflow
+import sflow_rows
+import sflow_synthetic
+
+# The sFlow SQLite Store keeps recent decoded flows and counters in a local SQLite file for ad hoc queries.
+
+# Rows are buffered and inserted in large transactions, either once enough rows are pending or when the oldest pending
+# row reaches the flush interval. Every table is partitioned by day, {table}_YYYYMMDD, and a view named after the
+# table unions its partitions, so queries go against flows, if_counters, host_cpu and so on. Retention drops whole
+# partitions, which is far cheaper than deleting rows.
+
+# Indexes
+#   flows       time, agent_address, input_if, output_if, source_ip, destination_ip
+#   counters    time, (agent_address, source_index)
+
+UDP_IP = "127.0.0.1"
+UDP_PORT = 6343
+
+BATCH_ROWS = 50000
+FLUSH_INTERVAL = 5  # seconds
+RETENTION_DAYS = 7
+
+flow_indexes = ("time", "agent_address", "input_if", "output_if", "source_ip", "destination_ip")
+counter_indexes = ("time", "agent_address, source_index")
+
+text_fields = {"agent_address", "source_mac", "destination_mac", "source_ip", "destination_ip"}
+
+
+def column_type(field):
+    if field in text_fields:
+        return "TEXT"
+    if field == "time" or field in sflow_rows.counter_float_fields:
+        return "REAL"
+    return "INTEGER"
+
+
+class sFlowSQLiteStore:
+    """sFlowSQLiteStore class:
+
+    path:  SQLite database file.
+    batchRows:  Rows pending before they are inserted.
+    flushInterval:  Seconds a pending row may wait before it is inserted.
+    retentionDays:  Days of partitions kept.
+    rows:  Rows inserted.
+    dropped:  Rows lost with a transaction that failed.
+    errors:  Transactions that failed and were rolled back.
+    lastError:  The last sqlite3.Error.
+    """
+
+    def __init__(self, path, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL, retention_days=RETENTION_DAYS):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.fields = {"flows": sflow_rows.flow_fields}
+        for record_type, table_name in sflow_rows.counter_table_names.items():
+            self.fields[table_name] = sflow_rows.sample_fields + sflow_rows.counter_fields[record_type]
+        self.inserts = {}
+        for table_name, fields in self.fields.items():
+            columns = ", ".join(f'"{field}"' for field in fields)  # Quoted, sFlowIfCounters has an index field.
+            self.inserts[table_name] = f"({columns}) VALUES ({', '.join('?' * len(fields))})"
+        self.partitions = {table_name: set() for table_name in self.fields}
+        for (name,) in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+            table_name, _, day = name.rpartition("_")
+            if table_name in self.partitions and day.isdigit():
+                self.partitions[table_name].add(day)
+        self.pending = {}
+        self.pending_rows = 0
+        self.first_pending_time = None
+        self.rows = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return f"""
+            SQLite Store:
+                Path: {self.path}
+                Rows: {self.rows}
+                Dropped: {self.dropped}
+                Errors: {self.errors}
+                Pending: {self.pending_rows}
+                Partitions: {sum(len(days) for days in self.partitions.values())}
+        """
+
+    def write(self, sflow_data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        day = time.strftime("%Y%m%d", time.gmtime(timestamp))
+        pending = self.pending
+        for table_name, row in sflow_rows.iter_rows(sflow_data, timestamp):
+            rows = pending.get((table_name, day))
+            if rows is None:
+                rows = pending[(table_name, day)] = []
+            rows.append(tuple(row[field] for field in self.fields[table_name]))
+            self.pending_rows += 1
+        if self.first_pending_time is None and self.pending_rows:
+            self.first_pending_time = time.monotonic()
+        if self.pending_rows >= self.batch_rows or (
+            self.first_pending_time is not None and time.monotonic() - self.first_pending_time >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self.pending_rows:
+            return
+        created = []
+        try:
+            self.db.execute("BEGIN")
+            for (table_name, day), rows in self.pending.items():
+                if day not in self.partitions[table_name]:
+                    self.create_partition(table_name, day)
+                    created.append((table_name, day))
+                self.db.executemany(f"INSERT INTO {table_name}_{day} {self.inserts[table_name]}", rows)
+            self.db.execute("COMMIT")
+            self.rows += self.pending_rows
+        except sqlite3.Error as error:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            created = []  # Rolled back with the rows.
+            self.dropped += self.pending_rows
+            self.errors += 1
+            self.last_error = error
+        finally:
+            self.pending = {}
+            self.pending_rows = 0
+            self.first_pending_time = None
+        for table_name, day in created:
+            self.partitions[table_name].add(day)
+        if created:
+            self.create_views()
+
+    def create_partition(self, table_name, day):
+        partition = f"{table_name}_{day}"
+        columns = ", ".join(f'"{field}" {column_type(field)}' for field in self.fields[table_name])
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {partition} ({columns})")
+        for index in flow_indexes if table_name == "flows" else counter_indexes:
+            index_name = f"{partition}_{index.replace(', ', '_')}"
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {partition} ({index})")
+
+    def create_views(self):
+        for table_name, days in self.partitions.items():
+            self.db.execute(f"DROP VIEW IF EXISTS {table_name}")
+            if days:
+                union = " UNION ALL ".join(f"SELECT * FROM {table_name}_{day}" for day in sorted(days))
+                self.db.execute(f"CREATE VIEW {table_name} AS {union}")
+
+    def retain(self, now=None):
+        """Drops the partitions older than the retention period. Returns the number dropped."""
+        oldest = time.strftime("%Y%m%d", time.gmtime((time.time() if now is None else now) - self.retention_days * 86400))
+        dropped = 0
+        for table_name, days in self.partitions.items():
+            for day in sorted(days):
+                if day >= oldest:
+                    break
+                self.db.execute(f"DROP TABLE IF EXISTS {table_name}_{day}")
+                days.discard(day)
+                dropped += 1
+        if dropped:
+            self.create_views()
+        return dropped
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def benchmark(path, datagrams, batch_rows):
+    samples = [
+        sflow_synthetic.flow_sample(
+            [
+                sflow_synthetic.sampled_header(source_ip=f"10.0.{i}.{j}", source_port=1024 + j, vlan=i),
+                sflow_synthetic.extended_switch(i, i),
+            ],
+            sequence=j,
+            input_if=j,
+            output_if=i,
+        )
+        for i in range(8)
+        for j in range(8)
+    ]
+    decoded = []
+    for i in range(256):
+        sample_set = [samples[(i + j) % len(samples)] for j in range(7)]
+        sample_set.append(sflow_synthetic.counter_sample([sflow_synthetic.if_counters(index=i)], sequence=i, source_index=i))
+        decoded.append(sflow.sFlow(sflow_synthetic.datagram(sample_set, sequence_number=i)))
+
+    store = sFlowSQLiteStore(path, batch_rows=batch_rows, flush_interval=3600)
+    rows = store.rows
+    start = time.perf_counter()
+    timestamp = time.time()
+    for i in range(datagrams):
+        store.write(decoded[i % len(decoded)], timestamp)
+    store.flush()
+    elapsed = time.perf_counter() - start
+    rows = store.rows - rows
+    store.close()
+    print(f"{rows} rows from {datagrams} datagrams in {elapsed:.2f}s: {rows / elapsed:.0f} rows/s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Store decoded sFlow in a local SQLite database.")
+    parser.add_argument("database")
+    parser.add_argument("--ip", default=UDP_IP)
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    parser.add_argument("--retention", type=int, default=RETENTION_DAYS, help="days")
+    parser.add_argument("--batch", type=int, default=BATCH_ROWS)
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure sustained ingest and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.database, args.benchmark, args.batch)
+    else:
+        store = sFlowSQLiteStore(args.database, batch_rows=args.batch, retention_days=args.retention)
+        store.retain()
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(store.flush_interval)
+        last_retain = time.monotonic()
+        errors = store.errors
+        malformed = 0
+        try:
+            while True:
+                try:
+                    data, addr = sock.recvfrom(3000)
+                    store.write(sflow.sFlow(data))
+                except socket.timeout:
+                    store.flush()
+                except (StructError, ValueError, IndexError):
+                    malformed += 1
+                if store.errors != errors:
+                    print(f"insert failed, {store.dropped} rows dropped: {store.last_error}", file=sys.stderr)
+                    errors = store.errors
+                if time.monotonic() - last_retain > 3600:
+                    store.retain()
+                    last_retain = time.monotonic()
+        finally:
+            store.close()
+            print(f"{store.rows} rows, {store.dropped} dropped, {malformed} malformed datagrams")
@@ -0,0 +1,246 @@
+from socket import AF_INET, AF_INET6, inet_pton
+from struct import pack, pack_into, unpack_from
+
+# Encoders for synthetic sFlow v5 datagrams, used by the benchmarks and the load generator.
+
+# Each record encoder returns the record with its header (enterprise and format, length). Samples take a list of
+# encoded records and datagrams a list of encoded samples. Field layouts follow the decoders in sflow.py.
+
+
+def record(record_format, data, enterprise=0):
+    data += bytes(-len(data) % 4)
+    return pack(">ii", enterprise * 4096 + record_format, len(data)) + data
+
+
+def string(value, limit=255):
+    data = value.encode("utf-8")[:limit]
+    return pack(">i", len(data)) + data + bytes(-len(data) % 4)
+
+
+def address(value):
+    if ":" in value:
+        return pack(">i", 2) + inet_pton(AF_INET6, value)
+    return pack(">i", 1) + inet_pton(AF_INET, value)
+
+
+# Flow Records
+
+
+def sampled_header(
+    source_ip="10.0.0.1",
+    destination_ip="10.0.0.2",
+    protocol=6,
+    source_port=1024,
+    destination_port=80,
+    frame_length=1500,
+    vlan=None,
+    source_mac="00:00:5e:00:53:01",
+    destination_mac="00:00:5e:00:53:02",
+    outer_vlan=None,
+):
+    "flowData: enterprise = 0, format = 1, an Ethernet, optionally 802.1ad and 802.1Q, IPv4 header"
+    header = bytes.fromhex(destination_mac.replace(":", "")) + bytes.fromhex(source_mac.replace(":", ""))
+    if outer_vlan is not None:
+        header += pack(">HH", 34984, outer_vlan)
+    if vlan is not None:
+        header += pack(">HH", 33024, vlan)
+    header += pack(">H", 2048)
+    header += pack(
+        ">BBHHHBBH4s4s",
+        0x45,
+        0,
+        frame_length - len(header),
+        0,
+        0,
+        64,
+        protocol,
+        0,
+        inet_pton(AF_INET, source_ip),
+        inet_pton(AF_INET, destination_ip),
+    )
+    header += pack(">HH", source_port, destination_port) + bytes(16)
+    return record(1, pack(">iiii", 1, frame_length, 4, len(header)) + header)
+
+
+def sampled_ipv4(source_ip="10.0.0.1", destination_ip="10.0.0.2", protocol=6, source_port=1024, destination_port=80, length=1500):
+    "flowData: enterprise = 0, format = 3"
+    return record(
+        3,
+        pack(
+            ">ii4s4siiii",
+            length,
+            protocol,
+            inet_pton(AF_INET, source_ip),
+            inet_pton(AF_INET, destination_ip),
+            source_port,
+            destination_port,
+            0,
+            0,
+        ),
+    )
+
+
+def extended_switch(source_vlan=1, destination_vlan=1):
+    "flowData: enterprise = 0, format = 1001"
+    return record(1001, pack(">iiii", source_vlan, 0, destination_vlan, 0))
+
+
+def extended_gateway(
+    next_hop="192.0.2.254",
+    asn=64496,
+    source_asn=64497,
+    source_peer_asn=64498,
+    as_path=(64499, 64500),
+    communities=(),
+    local_preference=100,
+):
+    "flowData: enterprise = 0, format = 1003, the AS path as a single AS_SEQUENCE segment"
+    data = address(next_hop) + pack(">III", asn, source_asn, source_peer_asn)
+    data += pack(">i", 1 if as_path else 0)
+    if as_path:
+        data += pack(f">ii{len(as_path)}I", 2, len(as_path), *as_path)
+    data += pack(f">i{len(communities)}I", len(communities), *communities)
+    return record(1003, data + pack(">I", local_preference))
+
+
+def extended_mpls(next_hop="192.0.2.254", in_labels=(), out_labels=()):
+    "flowData: enterprise = 0, format = 1006, labels as stack entries with the bottom of stack bit on the last"
+    data = address(next_hop)
+    for labels in (in_labels, out_labels):
+        entries = [label << 12 | (256 if i == len(labels) - 1 else 0) | 64 for i, label in enumerate(labels)]
+        data += pack(f">i{len(entries)}I", len(entries), *entries)
+    return record(1006, data)
+
+
+def extended_mpls_tunnel(name="", tunnel_id=0, tunnel_cos=0):
+    "flowData: enterprise = 0, format = 1008"
+    return record(1008, string(name) + pack(">ii", tunnel_id, tunnel_cos))
+
+
+def extended_mpls_vc(name="", vc_id=0, vc_cos=0):
+    "flowData: enterprise = 0, format = 1009"
+    return record(1009, string(name) + pack(">ii", vc_id, vc_cos))
+
+
+def extended_mpls_ftn(description="", mask=0):
+    "flowData: enterprise = 0, format = 1010"
+    return record(1010, string(description) + pack(">i", mask))
+
+
+def extended_vlantunnel(stack=()):
+    "flowData: enterprise = 0, format = 1012, stack as 802.1Q tag control information, outermost first"
+    return record(1012, pack(f">i{len(stack)}I", len(stack), *stack))
+
+
+# Counter Records
+
+
+def if_counters(index=1, speed=1000000000, input_octets=0, input_packets=0, output_octets=0, output_packets=0):
+    "counterData: enterprise = 0, format = 1"
+    return record(
+        1,
+        pack(
+            ">iiqiiqiiiiiiqiiiiii",
+            index,
+            6,
+            speed,
+            1,
+            3,
+            input_octets,
+            input_packets,
+            0,
+            0,
+            0,
+            0,
+            0,
+            output_octets,
+            output_packets,
+            0,
+            0,
+            0,
+            0,
+            0,
+        ),
+    )
+
+
+def host_descr(host_name="host", uuid=bytes(16), machine_type=3, os_name=2, os_release=""):
+    "counterData: enterprise = 0, format = 2000"
+    return record(2000, string(host_name, 64) + uuid + pack(">ii", machine_type, os_name) + string(os_release, 32))
+
+
+def host_parent(container_type=2, container_index=1):
+    "counterData: enterprise = 0, format = 2002"
+    return record(2002, pack(">ii", container_type, container_index))
+
+
+def host_cpu(load=0.0, cpus=1, user=0, system=0, idle=0, io_wait=0):
+    "counterData: enterprise = 0, format = 2003, times in milliseconds"
+    return record(
+        2003, pack(">fffiiiiiiiiiiiiii", load, load, load, 1, 1, cpus, 2000, 0, user, 0, system, idle, io_wait, 0, 0, 0, 0)
+    )
+
+
+def host_memory(total=0, free=0, buffers=0, cache=0):
+    "counterData: enterprise = 0, format = 2004"
+    return record(2004, pack(">qqqqqqqiiii", total, free, 0, buffers, cache, 0, 0, 0, 0, 0, 0))
+
+
+def host_disk_io(reads=0, read_bytes=0, writes=0, write_bytes=0, total=0, free=0):
+    "counterData: enterprise = 0, format = 2005"
+    return record(2005, pack(">qqiiqiiqi", total, free, 0, reads, read_bytes, 0, writes, write_bytes, 0))
+
+
+def host_net_io(in_bytes=0, in_packets=0, out_bytes=0, out_packets=0):
+    "counterData: enterprise = 0, format = 2006"
+    return record(2006, pack(">qiiiqiii", in_bytes, in_packets, 0, 0, out_bytes, out_packets, 0, 0))
+
+
+def virt_cpu(cpu_time=0, vcpus=1, state=1):
+    "counterData: enterprise = 0, format = 2101, cpu_time in milliseconds"
+    return record(2101, pack(">iii", state, cpu_time, vcpus))
+
+
+def virt_memory(memory=0, max_memory=0):
+    "counterData: enterprise = 0, format = 2102"
+    return record(2102, pack(">qq", memory, max_memory))
+
+
+def virt_disk_io(read_requests=0, read_bytes=0, write_requests=0, write_bytes=0, capacity=0):
+    "counterData: enterprise = 0, format = 2103"
+    return record(2103, pack(">qqqiqiqi", capacity, 0, 0, read_requests, read_bytes, write_requests, write_bytes, 0))
+
+
+def virt_net_io(received_bytes=0, received_packets=0, transmitted_bytes=0, transmitted_packets=0):
+    "counterData: enterprise = 0, format = 2104"
+    return record(2104, pack(">qiiiqiii", received_bytes, received_packets, 0, 0, transmitted_bytes, transmitted_packets, 0, 0))
+
+
+# Samples and Datagrams
+
+
+def flow_sample(records, sequence=0, source_index=1, sample_rate=1024, sample_pool=0, drops=0, input_if=1, output_if=2):
+    data = pack(">iiiiiiii", sequence, source_index, sample_rate, sample_pool, drops, input_if, output_if, len(records))
+    data += b"".join(records)
+    return pack(">ii", 1, len(data)) + data
+
+
+def counter_sample(records, sequence=0, source_index=1, source_type=0):
+    data = pack(">iii", sequence, source_type * 16777216 + source_index, len(records)) + b"".join(records)
+    return pack(">ii", 2, len(data)) + data
+
+
+def datagram(samples, agent_address="192.0.2.1", sub_agent=0, sequence_number=0, system_uptime=0):
+    return (
+        pack(">i", 5)
+        + address(agent_address)
+        + pack(">iiii", sub_agent, sequence_number, system_uptime, len(samples))
+        + b"".join(samples)
+    )
+
+
+def stamp(datagram, sub_agent, sequence_number):
+    """Overwrites the sub agent and sequence number of an encoded datagram held in a bytearray."""
+    position = 12 if unpack_from(">i", datagram, 4)[0] == 1 else 24
+    pack_into(">ii", datagram, position, sub_agent, sequence_number)
+    return datagram
@@ -0,0 +1,350 @@
+import argparse
+import socket
+import sys
+import time
+from struct import Struct
+
+import sflow
+import sflow_enrich
+import sflow_matrix
+import sflow_sqlite
+import sflow_synthetic
+
+# The sFlow Tracer measures how long each datagram takes from the kernel receiving it to the last stage consuming it.
+
+# The kernel stamps every datagram as it arrives (SO_TIMESTAMPNS, CLOCK_REALTIME in nanoseconds), and the stamp is
+# read from the ancillary data of recvmsg. Each stage then marks the trace of the datagram with time.time_ns(), the
+# same clock, when it is done with it; the trace travels on the decoded datagram as sflow_data.trace. When the last
+# stage finishes, the time between consecutive marks is added to the histogram of each stage:
+#   queue       kernel receive to recvmsg returning, the time spent in the socket receive buffer
+#   parse       sflow.sFlow
+#   enrich      sflow_enrich
+#   aggregate   sflow_matrix, or any other aggregation
+#   sink        sflow_sqlite, or any other sink
+#   total       kernel receive to the last mark, also kept per agent
+# Stages are not fixed: mark(trace, name) adds a histogram for any name.
+
+# Histograms are log-linear, 4 buckets per power of two (values within 25%), from 1 ns to 2^63 ns in 256 counters.
+
+# Export delay is the time an agent held a datagram before sending it. The agent stamps system_uptime, milliseconds
+# since it booted, as close to sending as it can, so receive time - system_uptime is its boot time plus the delay.
+# The smallest value over the current and the previous DELAY_WINDOW is taken as the boot time, which follows clock
+# drift, and the rest is the export delay. Uptime wraps every 2^32 ms, an uptime more than RESTART_UPTIME behind the
+# last one is an agent restart and starts the baseline over.
+
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35 if sys.platform.startswith("linux") else None)
+TIMESPEC = Struct("@qq")
+
+SUB_BITS = 2
+BUCKETS = 256
+PERCENTILES = (50, 90, 99, 99.9)
+
+DELAY_WINDOW = 300  # seconds
+RESTART_UPTIME = 30000  # milliseconds
+
+WRAP = 1 << 32
+HALF = 1 << 31
+
+
+def bucket(value):
+    """Histogram bucket of a non negative value: exact below 8, then 4 buckets per power of two."""
+    if value < 1 << (SUB_BITS + 1):
+        return value if value > 0 else 0
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift << SUB_BITS) + (value >> shift)
+
+
+def bucket_value(index):
+    """Middle of the values of a bucket."""
+    if index < 1 << (SUB_BITS + 1):
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return ((index - (shift << SUB_BITS)) << shift) + (1 << shift >> 1)
+
+
+class sFlowLatencyHistogram:
+    """sFlowLatencyHistogram class:
+
+    counts:  Observations per bucket.
+    count:  Observations.
+    total:  Sum of the observations, nanoseconds.
+    maximum:  Largest observation, nanoseconds.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def __repr__(self):
+        percentiles = " ".join(f"p{p:g} {value / 1000:.0f}us" for p, value in zip(PERCENTILES, self.percentiles()))
+        return f"{self.count} mean {self.mean() / 1000:.0f}us {percentiles} max {self.maximum / 1000:.0f}us"
+
+    def add(self, nanoseconds):
+        if nanoseconds < 0:
+            nanoseconds = 0
+        self.counts[bucket(nanoseconds)] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if nanoseconds > self.maximum:
+            self.maximum = nanoseconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """Nanoseconds at or below which each percentage of the observations lie, to within a bucket."""
+        values = []
+        for percentile in percentiles:
+            rank = percentile / 100 * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    values.append(min(bucket_value(index), self.maximum))
+                    break
+            else:
+                values.append(0)
+        return values
+
+
+class sFlowTrace:
+    """sFlowTrace class:
+
+    kernel:  Kernel receive time, nanoseconds since the epoch.
+    marks:  (stage, nanoseconds since the epoch) as each stage finished.
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.marks = []
+
+
+class sFlowTracer:
+    """sFlowTracer class:
+
+    stages:  Stage: sFlowLatencyHistogram of the time spent in it.
+    total:  sFlowLatencyHistogram of kernel receive to the last stage.
+    agents:  Agent address: sFlowLatencyHistogram of kernel receive to the last stage.
+    exportDelay:  Agent address: sFlowLatencyHistogram of the export delay on the agent.
+    kernelTimestamps:  Datagrams stamped by the kernel, the others by recvmsg returning.
+    """
+
+    def __init__(self, delay_window=DELAY_WINDOW, restart_uptime=RESTART_UPTIME):
+        self.delay_window = delay_window
+        self.restart_uptime = restart_uptime
+        self.stages = {}
+        self.total = sFlowLatencyHistogram()
+        self.agents = {}
+        self.export_delay = {}
+        self.uptimes = {}
+        self.datagrams = 0
+        self.kernel_timestamps = 0
+
+    def __repr__(self):
+        stages = "".join(f"\n                {stage}: {histogram}" for stage, histogram in self.stages.items())
+        return f"""
+            Latency:
+                Datagrams: {self.datagrams}
+                Kernel Timestamps: {self.kernel_timestamps}{stages}
+                total: {self.total}
+        """
+
+    @staticmethod
+    def enable(sock):
+        """Asks the kernel to stamp the datagrams of sock, True when it will."""
+        if SO_TIMESTAMPNS is None:
+            return False
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError:
+            return False
+        return True
+
+    def receive(self, sock, size=3000):
+        """Receives a datagram, returning (datagram, address, sFlowTrace)."""
+        data, ancdata, flags, addr = sock.recvmsg(size, socket.CMSG_SPACE(TIMESPEC.size))
+        received = time.time_ns()
+        kernel = received
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(cdata) >= TIMESPEC.size:
+                seconds, nanoseconds = TIMESPEC.unpack_from(cdata)
+                kernel = seconds * 1000000000 + nanoseconds
+                self.kernel_timestamps += 1
+        trace = sFlowTrace(kernel)
+        trace.marks.append(("queue", received))
+        return data, addr, trace
+
+    def parse(self, data, trace):
+        """sflow.sFlow(data), with the trace carried on the decoded datagram."""
+        sflow_data = sflow.sFlow(data)
+        trace.marks.append(("parse", time.time_ns()))
+        sflow_data.trace = trace
+        return sflow_data
+
+    @staticmethod
+    def mark(trace, stage):
+        trace.marks.append((stage, time.time_ns()))
+
+    def finish(self, trace, agent_address=None, system_uptime=None):
+        """Adds a finished trace to the histograms, and its export delay when system_uptime is given."""
+        self.datagrams += 1
+        previous = trace.kernel
+        stages = self.stages
+        for stage, nanoseconds in trace.marks:
+            histogram = stages.get(stage)
+            if histogram is None:
+                histogram = stages[stage] = sFlowLatencyHistogram()
+            histogram.add(nanoseconds - previous)
+            previous = nanoseconds
+        self.total.add(previous - trace.kernel)
+        if agent_address is None:
+            return
+        histogram = self.agents.get(agent_address)
+        if histogram is None:
+            histogram = self.agents[agent_address] = sFlowLatencyHistogram()
+        histogram.add(previous - trace.kernel)
+        if system_uptime is not None:
+            self.delay(agent_address, system_uptime, trace.kernel)
+
+    def finish_datagram(self, sflow_data):
+        """finish() for a decoded datagram carrying its trace."""
+        self.finish(sflow_data.trace, sflow_data.agent_address, sflow_data.system_uptime)
+
+    def delay(self, agent_address, system_uptime, received):
+        """Adds the export delay of a datagram, from its system_uptime and its receive time in nanoseconds."""
+        uptime = system_uptime & 0xFFFFFFFF
+        received_ms = received // 1000000
+        state = self.uptimes.get(agent_address)
+        if state is None:
+            state = self.uptimes[agent_address] = [uptime, None, None, received_ms]
+        last_uptime, current, previous, window_start = state
+        gap = (uptime - last_uptime) % WRAP
+        if gap >= HALF:
+            gap -= WRAP
+        if gap < -self.restart_uptime:
+            last_uptime, current, previous, window_start, gap = uptime, None, None, received_ms, 0
+        # Uptime unwrapped against the latest of the agent, so it keeps counting past 2^32.
+        unwrapped = last_uptime + gap
+        if gap > 0:
+            last_uptime = unwrapped
+        offset = received_ms - unwrapped
+        if received_ms - window_start >= self.delay_window * 1000:
+            previous, current, window_start = current, None, received_ms
+        if current is None or offset < current:
+            current = offset
+        state[:] = last_uptime, current, previous, window_start
+        baseline = current if previous is None else min(current, previous)
+        histogram = self.export_delay.get(agent_address)
+        if histogram is None:
+            histogram = self.export_delay[agent_address] = sFlowLatencyHistogram()
+        histogram.add((offset - baseline) * 1000000)
+
+    def reset(self):
+        """Starts new histograms, keeping the export delay baselines."""
+        self.stages = {}
+        self.total = sFlowLatencyHistogram()
+        self.agents = {}
+        self.export_delay = {}
+        self.datagrams = 0
+        self.kernel_timestamps = 0
+
+    def report(self):
+        """{histogram name: (count, mean, percentiles, maximum)} in nanoseconds, for publishing."""
+        histograms = {f"stage.{stage}": histogram for stage, histogram in self.stages.items()}
+        histograms["total"] = self.total
+        histograms.update((f"agent.{agent}", histogram) for agent, histogram in self.agents.items())
+        histograms.update((f"export_delay.{agent}", histogram) for agent, histogram in self.export_delay.items())
+        return {
+            name: (histogram.count, histogram.mean(), histogram.percentiles(), histogram.maximum)
+            for name, histogram in histograms.items()
+        }
+
+
+def print_report(tracer):
+    print(tracer)
+    for agent, histogram in sorted(tracer.agents.items()):
+        delay = tracer.export_delay.get(agent)
+        print(f"    {agent}: {histogram}")
+        if delay is not None:
+            print(f"    {agent} export delay: {delay}")
+
+
+def benchmark(datagrams):
+    sample = sflow_synthetic.flow_sample([sflow_synthetic.sampled_header()])
+    boot = time.monotonic()
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tracer = sFlowTracer()
+    print(f"kernel timestamps: {tracer.enable(receiver)}")
+    start = time.perf_counter()
+    for i in range(datagrams):
+        uptime = int((time.monotonic() - boot) * 1000)
+        sender.sendto(sflow_synthetic.datagram([sample] * 4, system_uptime=uptime), receiver.getsockname())
+        received, addr, trace = tracer.receive(receiver)
+        sflow_data = tracer.parse(received, trace)
+        tracer.mark(trace, "aggregate")
+        tracer.finish_datagram(sflow_data)
+    elapsed = time.perf_counter() - start
+    print_report(tracer)
+    print(f"{datagrams} datagrams in {elapsed:.2f}s: {elapsed / datagrams * 1000000:.2f} us/datagram")
+
+    trace = sFlowTrace(time.time_ns())
+    start = time.perf_counter()
+    for i in range(datagrams):
+        tracer.mark(trace, "aggregate")
+    elapsed = time.perf_counter() - start
+    print(f"mark: {elapsed / datagrams * 1000000000:.0f} ns")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Per stage and per agent latency of sFlow datagrams from kernel receive.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6343)
+    parser.add_argument("--prefixes", help="CSV prefix file to enrich flows with")
+    parser.add_argument("--sqlite", help="SQLite database to sink flows and counters into")
+    parser.add_argument("--interval", type=int, default=10, help="seconds between reports")
+    parser.add_argument("--benchmark", type=int, metavar="DATAGRAMS", help="measure the cost per datagram and exit")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        tracer = sFlowTracer()
+        enricher = sflow_enrich.sFlowEnricher.load(args.prefixes) if args.prefixes else None
+        matrix = sflow_matrix.sFlowTrafficMatrix()
+        store = sflow_sqlite.sFlowSQLiteStore(args.sqlite) if args.sqlite else None
+        sock = socket.socket(socket.AF_INET6 if ":" in args.ip else socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((args.ip, args.port))
+        sock.settimeout(1)
+        if not tracer.enable(sock):
+            print("kernel timestamps unavailable, measuring from recvmsg")
+        report = time.monotonic() + args.interval
+        while True:
+            try:
+                data, addr, trace = tracer.receive(sock)
+                sflow_data = tracer.parse(data, trace)
+                if enricher is not None:
+                    enricher.enrich(sflow_data)
+                    tracer.mark(trace, "enrich")
+                matrix.add(sflow_data)
+                tracer.mark(trace, "aggregate")
+                if store is not None:
+                    store.write(sflow_data)
+                    tracer.mark(trace, "sink")
+                tracer.finish_datagram(sflow_data)
+            except socket.timeout:
+                pass
+            if time.monotonic() >= report:
+                print_report(tracer)
+                tracer.reset()
+                report = time.monotonic() + args.interval
@@ -0,0 +1,362 @@
+import argparse
+import os
+import time
+from struct import Struct
+
+import numpy as np
+
+import sflow
+import sflow_rows
+import sflow_synthetic
+
+# The sFlow Time Series Store keeps counter records compressed in an append only file.
+
+# A series is one counter record type of one data source: (agent_address, source_index, table) with the tables and
+# fields of sflow_rows. Points are buffered per series and written as a block once a series has CHUNK_POINTS points.
+
+# Each column of a block is reduced to small residuals and stored at the narrowest byte width (0, 1, 2, 4 or 8) that
+# holds every residual of the block, so a column decodes with one frombuffer and a cumulative sum or xor:
+#   timestamps          milliseconds, delta of delta, zigzag
+#   integer fields      delta, zigzag
+#   float fields        xor with the previous value, shifted right by the trailing zero bits common to the block
+
+# File layout
+#   {path}              blocks: block header, series key, column headers and column data
+#   {path}.idx          index: block offset, first and last timestamp and series key of every block
+# The index is only an accelerator: when it is missing or short, it is rebuilt from the block headers.
+
+CHUNK_POINTS = 240
+
+BLOCK_MAGIC = b"sFTS"
+BLOCK_HEADER = Struct("<4sIHIqqH")  # magic, block length, key length, points, first time, last time, columns
+COLUMN_HEADER = Struct("<BBBqqI")  # kind, width, shift, seed, second seed, data length
+INDEX_ENTRY = Struct("<QqqH")  # offset, first time, last time, key length
+
+TIMESTAMP, INTEGER, FLOAT = 0, 1, 2
+
+WIDTH_TYPES = {1: np.dtype("<u1"), 2: np.dtype("<u2"), 4: np.dtype("<u4"), 8: np.dtype("<u8")}
+
+
+def byte_width(maximum):
+    if maximum == 0:
+        return 0
+    for width in (1, 2, 4):
+        if maximum < 1 << (8 * width):
+            return width
+    return 8
+
+
+def zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values):
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def encode_column(kind, values):
+    """Returns the column header and data of an int64 (timestamps, integers) or float64 array."""
+    seed = second_seed = shift = 0
+    if kind == FLOAT:
+        bits = values.view(np.uint64)
+        seed = int(bits[0].view(np.int64))
+        residuals = bits[1:] ^ bits[:-1]
+        nonzero = residuals[residuals != 0]
+        if len(nonzero):
+            lowest = nonzero & (~nonzero + np.uint64(1))
+            shift = int(np.log2(lowest.astype(np.float64)).min())
+            residuals = residuals >> np.uint64(shift)
+    else:
+        seed = int(values[0])
+        if kind == TIMESTAMP:
+            if len(values) > 1:
+                second_seed = int(np.diff(values[:2])[0])
+            residuals = zigzag(np.diff(values, n=2))
+        else:
+            residuals = zigzag(np.diff(values))
+    width = byte_width(int(residuals.max()) if len(residuals) else 0)
+    data = residuals.astype(WIDTH_TYPES[width]).tobytes() if width else b""
+    return COLUMN_HEADER.pack(kind, width, shift, seed, second_seed, len(data)) + data
+
+
+def decode_column(buffer, offset, points):
+    """Returns (values, next offset) of the column at offset."""
+    kind, width, shift, seed, second_seed, length = COLUMN_HEADER.unpack_from(buffer, offset)
+    offset += COLUMN_HEADER.size
+    residual_count = points - (2 if kind == TIMESTAMP else 1)
+    if width:
+        residuals = np.frombuffer(buffer, WIDTH_TYPES[width], max(residual_count, 0), offset).astype(np.uint64)
+    else:
+        residuals = np.zeros(max(residual_count, 0), dtype=np.uint64)
+    offset += length
+
+    if kind == FLOAT:
+        bits = np.empty(points, dtype=np.uint64)
+        bits[0] = np.int64(seed).view(np.uint64)
+        bits[1:] = residuals << np.uint64(shift)
+        return np.bitwise_xor.accumulate(bits).view(np.float64), offset
+    values = np.empty(points, dtype=np.int64)
+    values[0] = seed
+    if kind == TIMESTAMP:
+        if points > 1:
+            deltas = np.empty(points - 1, dtype=np.int64)
+            deltas[0] = second_seed
+            deltas[1:] = unzigzag(residuals)
+            values[1:] = seed + np.cumsum(np.cumsum(deltas))
+    else:
+        values[1:] = unzigzag(residuals)
+        values = np.cumsum(values)
+    return values, offset
+
+
+def encode_block(key, timestamps, columns, kinds):
+    key = key.encode("utf-8")
+    data = [encode_column(TIMESTAMP, timestamps)]
+    data += [encode_column(kind, column) for kind, column in zip(kinds, columns)]
+    body = key + b"".join(data)
+    header = BLOCK_HEADER.pack(
+        BLOCK_MAGIC, BLOCK_HEADER.size + len(body), len(key), len(timestamps), timestamps[0], timestamps[-1], len(columns)
+    )
+    return header + body
+
+
+def decode_block(buffer, offset=0):
+    """Returns (key, timestamps, columns) of the block at offset."""
+    magic, _, key_length, points, _, _, column_count = BLOCK_HEADER.unpack_from(buffer, offset)
+    if magic != BLOCK_MAGIC:
+        raise ValueError(f"no block at offset {offset}")
+    offset += BLOCK_HEADER.size
+    key = bytes(buffer[offset : offset + key_length]).decode("utf-8")
+    offset += key_length
+    timestamps, offset = decode_column(buffer, offset, points)
+    columns = []
+    for _ in range(column_count):
+        column, offset = decode_column(buffer, offset, points)
+        columns.append(column)
+    return key, timestamps, columns
+
+
+def series_key(agent_address, source_index, table_name):
+    return f"{agent_address}|{source_index}|{table_name}"
+
+
+class sFlowSeriesBuffer:
+    """sFlowSeriesBuffer class:
+
+    Points of one series not yet written as a block.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.kinds = [FLOAT if field in sflow_rows.counter_float_fields else INTEGER for field in fields]
+        self.timestamps = []
+        self.rows = []
+
+    def columns(self, rows=None):
+        rows = self.rows if rows is None else rows
+        return [
+            np.array([row[i] for row in rows], dtype=np.float64 if kind == FLOAT else np.int64)
+            for i, kind in enumerate(self.kinds)
+        ]
+
+
+class sFlowTimeSeriesStore:
+    """sFlowTimeSeriesStore class:
+
+    path:  Block file, the index is kept in path.idx.
+    chunkPoints:  Points per block.
+    index:  Series key: list of (first time, last time, offset) of its blocks.
+    points:  Points appended.
+    bytes:  Bytes of blocks written.
+    """
+
+    def __init__(self, path, chunk_points=CHUNK_POINTS):
+        self.path = path
+        self.chunk_points = chunk_points
+        self.fields = {
+            table_name: sflow_rows.counter_fields[record_type]
+            for record_type, table_name in sflow_rows.counter_table_names.items()
+        }
+        self.buffers = {}
+        self.index = {}
+        self.points = 0
+        self.bytes = 0
+        self.load_index()
+        self.blocks = open(path, "ab")
+        self.index_file = open(f"{path}.idx", "ab")
+
+    def __repr__(self):
+        return f"""
+            Time Series Store:
+                Path: {self.path}
+                Series: {len(self.index)}
+                Points: {self.points}
+                Bytes: {self.bytes}
+        """
+
+    def load_index(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        indexed = 0
+        if os.path.exists(f"{self.path}.idx"):
+            with open(f"{self.path}.idx", "rb") as index_file:
+                data = index_file.read()
+            offset = 0
+            while offset + INDEX_ENTRY.size <= len(data):
+                block_offset, first_time, last_time, key_length = INDEX_ENTRY.unpack_from(data, offset)
+                offset += INDEX_ENTRY.size
+                key = data[offset : offset + key_length].decode("utf-8")
+                offset += key_length
+                self.index.setdefault(key, []).append((first_time, last_time, block_offset))
+                indexed = max(indexed, block_offset)
+        if size == 0:
+            return
+        with open(self.path, "rb") as blocks:
+            buffer = blocks.read()
+        # Blocks written after the last index entry, after a crash between the two writes, are indexed again.
+        offset = indexed
+        if indexed or self.index:
+            offset += BLOCK_HEADER.unpack_from(buffer, indexed)[1]
+        with open(f"{self.path}.idx", "ab") as index_file:
+            while offset + BLOCK_HEADER.size <= size:
+                magic, length, key_length, _, first_time, last_time, _ = BLOCK_HEADER.unpack_from(buffer, offset)
+                if magic != BLOCK_MAGIC or offset + length > size:
+                    break  # A torn block at the end of the file.
+                key = buffer[offset + BLOCK_HEADER.size : offset + BLOCK_HEADER.size + key_length]
+                index_file.write(INDEX_ENTRY.pack(offset, first_time, last_time, key_length) + key)
+                self.index.setdefault(key.decode("utf-8"), []).append((first_time, last_time, offset))
+                offset += length
+
+    def append(self, sflow_data, timestamp=None):
+        """Buffers the known counter records of a decoded datagram, writing the blocks that fill up."""
+        milliseconds = int((time.time() if timestamp is None else timestamp) * 1000)
+        for sample in sflow_data.samples:
+            if sample.sample_type not in (2, 4):
+                continue
+            for record in sample.records:
+                table_name = sflow_rows.counter_table_names.get(type(record.record))
+                if table_name is None:
+                    continue
+                key = series_key(sflow_data.agent_address, sample.source_index, table_name)
+                buffer = self.buffers.get(key)
+                if buffer is None:
+                    buffer = self.buffers[key] = sFlowSeriesBuffer(self.fields[table_name])
+                buffer.timestamps.append(milliseconds)
+                buffer.rows.append(tuple(getattr(record.record, field) for field in buffer.fields))
+                self.points += 1
+                if len(buffer.timestamps) >= self.chunk_points:
+                    self.write_block(key, buffer)
+
+    def write_block(self, key, buffer):
+        if not buffer.timestamps:
+            return
+        block = encode_block(key, np.array(buffer.timestamps, dtype=np.int64), buffer.columns(), buffer.kinds)
+        offset = self.blocks.tell()
+        self.blocks.write(block)
+        key_bytes = key.encode("utf-8")
+        self.index_file.write(INDEX_ENTRY.pack(offset, buffer.timestamps[0], buffer.timestamps[-1], len(key_bytes)) + key_bytes)
+        self.index.setdefault(key, []).append((buffer.timestamps[0], buffer.timestamps[-1], offset))
+        self.bytes += len(block)
+        buffer.timestamps = []
+        buffer.rows = []
+
+    def flush(self):
+        """Writes every partly filled series as a block."""
+        for key, buffer in self.buffers.items():
+            self.write_block(key, buffer)
+        self.blocks.flush()
+        self.index_file.flush()
+
+    def read(self, agent_address, source_index, table_name, start=None, end=None):
+        """Returns (timestamps in milliseconds, {field: values}) of a series between start and end, in seconds."""
+        key = series_key(agent_address, source_index, table_name)
+        start = -(1 << 62) if start is None else int(start * 1000)
+        end = 1 << 62 if end is None else int(end * 1000)
+        self.blocks.flush()
+        timestamps, columns = [], []
+        blocks = [offset for first_time, last_time, offset in self.index.get(key, ()) if last_time >= start and first_time <= end]
+        if blocks:
+            with open(self.path, "rb") as block_file:
+                for offset in blocks:
+                    block_file.seek(offset)
+                    length = BLOCK_HEADER.unpack(block_file.read(BLOCK_HEADER.size))[1]
+                    block_file.seek(offset)
+                    _, block_timestamps, block_columns = decode_block(block_file.read(length))
+                    timestamps.append(block_timestamps)
+                    columns.append(block_columns)
+        buffer = self.buffers.get(key)
+        if buffer is not None and buffer.timestamps:
+            timestamps.append(np.array(buffer.timestamps, dtype=np.int64))
+            columns.append(buffer.columns())
+        fields = self.fields[table_name]
+        if not timestamps:
+            return np.zeros(0, dtype=np.int64), {field: np.zeros(0) for field in fields}
+        timestamps_all = np.concatenate(timestamps)
+        selected = (timestamps_all >= start) & (timestamps_all <= end)
+        values = {field: np.concatenate([block[i] for block in columns])[selected] for i, field in enumerate(fields)}
+        return timestamps_all[selected], values
+
+    def close(self):
+        self.flush()
+        self.blocks.close()
+        self.index_file.close()
+
+
+def benchmark(path, polls, interfaces):
+    datagrams = []
+    octets = [0] * interfaces
+    packets = [0] * interfaces
+    for poll in range(polls):
+        samples = []
+        for interface in range(interfaces):
+            octets[interface] += 1000000 + (poll * 7919 + interface * 104729) % 250000
+            packets[interface] = (packets[interface] + 900 + (poll * 31 + interface) % 200) % (1 << 31)
+            samples.append(
+                sflow_synthetic.counter_sample(
+                    [
+                        sflow_synthetic.if_counters(
+                            index=interface,
+                            input_octets=octets[interface],
+                            input_packets=packets[interface],
+                            output_octets=octets[interface] // 3,
+                            output_packets=packets[interface] // 2,
+                        )
+                    ],
+                    sequence=poll,
+                    source_index=interface,
+                )
+            )
+        datagrams.append(sflow.sFlow(sflow_synthetic.datagram(samples, sequence_number=poll)))
+
+    for suffix in ("", ".idx"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    store = sFlowTimeSeriesStore(path)
+    start = time.perf_counter()
+    for poll, sflow_data in enumerate(datagrams):
+        store.append(sflow_data, 1700000000 + poll * 20)
+    store.flush()
+    encode = time.perf_counter() - start
+
+    fields = len(store.fields["if_counters"])
+    raw = store.points * (fields + 1) * 8
+    start = time.perf_counter()
+    decoded = 0
+    for interface in range(interfaces):
+        timestamps, _ = store.read("192.0.2.1", interface, "if_counters")
+        decoded += len(timestamps)
+    decode = time.perf_counter() - start
+    store.close()
+
+    print(f"{store.points} points, {fields} fields: {raw} bytes raw, {store.bytes} bytes stored, {raw / store.bytes:.1f}:1")
+    print(f"append {store.points / encode:.0f} points/s, read {decoded / decode:.0f} points/s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the compressed counter time series store.")
+    parser.add_argument("path")
+    parser.add_argument("--polls", type=int, default=2000)
+    parser.add_argument("--interfaces", type=int, default=48)
+    args = parser.parse_args()
+
+    benchmark(args.path, args.polls, args.interfaces)
@@ -0,0 +1,123 @@
+import time
+from collections import deque
+
+# The sFlow Key Window sums octets and packets per key in named tables over fixed windows, the bounded top N
+# accounting shared by sflow_asmatrix and sflow_mpls.
+
+# Tables are bounded: past max_keys keys in a table, further keys of the window are summed under OTHER.
+
+# Tuples many keys repeat, AS paths or label stacks, are interned: the first tuple seen is kept and later keys refer to
+# it, so it is stored once however many keys and windows use it. count(..., intern=True) interns a key, or its tuple
+# parts, only when the key enters its table, so keys summed under OTHER leave nothing behind. When the intern table
+# grows past max_interned it is rebuilt at the end of a window from the interned tuples the window's keys, or their
+# parts, still use.
+
+# Closed windows are passed to the on_snapshot callbacks and only the latest SNAPSHOTS are kept. Each may hold max_keys
+# keys per table, so history is for a callback to write to a sink, not for memory.
+
+SNAPSHOTS = 4
+
+OTHER = -1
+
+
+class sFlowKeyWindow:
+    """sFlowKeyWindow class:
+
+    window:  Seconds per snapshot.
+    tables:  Table name: {key: [octets, packets]} of the open window.
+    interned:  Interned tuples, tuple: tuple.
+    snapshots:  The latest snapshots, SNAPSHOTS windows deep.
+    overflows:  Keys summed under OTHER.
+    """
+
+    def __init__(self, window, table_names, max_keys, max_interned, snapshots=SNAPSHOTS):
+        self.window = window
+        self.table_names = table_names
+        self.max_keys = max_keys
+        self.max_interned = max_interned
+        self.tables = {name: {} for name in table_names}
+        self.interned = {}
+        self.snapshots = deque(maxlen=snapshots)
+        self.callbacks = []
+        self.window_start = None
+        self.samples = 0
+        self.window_samples = 0
+        self.overflows = 0
+
+    def on_snapshot(self, callback):
+        """Calls callback(snapshot) when a window ends."""
+        self.callbacks.append(callback)
+
+    def intern(self, value):
+        interned = self.interned.get(value)
+        if interned is None:
+            interned = self.interned[value] = value
+        return interned
+
+    def intern_key(self, key):
+        """Interns the tuple parts of a key of parts, or else the key itself."""
+        if any(type(part) is tuple for part in key):
+            return tuple(self.intern(part) if type(part) is tuple else part for part in key)
+        return self.intern(key)
+
+    def count(self, table, key, octets, packets, intern=False):
+        """Sums octets and packets under key, or under OTHER once the table is full. With intern, a key entering the
+        table is interned with intern_key."""
+        totals = table.get(key)
+        if totals is None:
+            if len(table) >= self.max_keys:
+                self.overflows += 1
+                key = OTHER
+                totals = table.get(key)
+            elif intern:
+                key = self.intern_key(key)
+            if totals is None:
+                table[key] = [octets, packets]
+                return
+        totals[0] += octets
+        totals[1] += packets
+
+    def advance(self, timestamp):
+        """Opens the first window, or closes the open one if timestamp is past it."""
+        if self.window_start is None:
+            self.window_start = timestamp // self.window * self.window
+        elif timestamp >= self.window_start + self.window:
+            self.close(timestamp)
+
+    def snapshot(self, start, end, samples, tables):
+        return (start, end, samples, tables)
+
+    def close(self, now=None):
+        """Publishes the snapshot of the window and opens the window holding now."""
+        if self.window_start is None:
+            return None
+        tables = self.tables
+        snapshot = self.snapshot(self.window_start, self.window_start + self.window, self.window_samples, tables)
+        self.snapshots.append(snapshot)
+        if len(self.interned) > self.max_interned:
+            self.reintern(tables)
+        self.tables = {name: {} for name in self.table_names}
+        self.window_samples = 0
+        self.window_start = (time.time() if now is None else now) // self.window * self.window
+        for callback in self.callbacks:
+            callback(snapshot)
+        return snapshot
+
+    def reintern(self, tables):
+        interned = self.interned
+        used = {}
+        for table in tables.values():
+            for key in table:
+                if type(key) is not tuple:
+                    continue
+                if key in interned:
+                    used[key] = key
+                for part in key:
+                    if type(part) is tuple and part in interned:
+                        used[part] = part
+        self.interned = used
+
+
+def top(table, n=10):
+    """The n keys of a snapshot table with the most octets, as (key, octets, packets)."""
+    return sorted(((key, octets, packets) for key, (octets, packets) in table.items()), key=lambda row: -row[1])[:n]